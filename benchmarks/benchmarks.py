@@ -0,0 +1,345 @@
+"""Benchmarks of the cyclic exchange, PDO access, SDO info and startup / recovery against the simulated bus"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'separate_thread'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+import pysoem
+
+from event_log import EventLog
+from fake_master import DEFAULT_LAYOUT, FakeMaster
+from od_cache import ODCache
+from process_image import ProcessImage
+from sdo_bulk import BulkSdoReader
+from separate_thread import ThreadingExample
+from signal_map import compile_signal_map
+from supervisor import SAFEOP_ERROR_STATE, SlaveSupervisor
+
+# Reference results of the simulated bus (baseline.json, committed). The times depend on the machine:
+# create a baseline of your own before comparing (python benchmarks.py --save, or --baseline <file> --save
+# to keep the committed one), and store it again after an intended change of a benchmark.
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Regression if a benchmark takes this much longer than its baseline (0.2 = 20 %)
+DEFAULT_THRESHOLD = 0.2
+
+# Every benchmark is run this often (rounds over all benchmarks), the fastest round counts.
+# A benchmark beyond the threshold is measured again that often before it is reported.
+DEFAULT_ROUNDS = 3
+
+# Simulated acyclic frame / mailbox round trips
+ACCESS_TIME_S = 0.0002
+MAILBOX_TIME_S = 0.0001
+
+
+# Line of n_slaves terminals (the example layout repeated)
+def _layout(n_slaves):
+    return (DEFAULT_LAYOUT * (n_slaves // len(DEFAULT_LAYOUT) + 1))[:n_slaves]
+
+
+# Master with all slaves in OP
+def _master_in_op(n_slaves=len(DEFAULT_LAYOUT), **kwargs):
+    master = FakeMaster(_layout(n_slaves), **kwargs)
+    master.config_init()
+    master.config_map()
+    master.state = pysoem.OP_STATE
+    master.write_state()
+    return master
+
+
+# Median of repeats runs of func (func returns its own measurement)
+def _median(func, repeats):
+    return statistics.median(func() for _ in range(repeats))
+
+
+# Fastest of repeats runs of func after one warm-up run: timer / scheduler noise only adds time,
+# so the minimum is the stable measure for short loops
+def _best(func, repeats):
+    func()
+    return min(func() for _ in range(repeats))
+
+
+# --- Benchmarks: each returns the median (or for the short loops the fastest) time in us ---
+
+def cycle_overhead(n_slaves, n_cycles=2000):
+    master = _master_in_op(n_slaves)
+    image = ProcessImage(master.slaves)
+
+    def run():
+        start = time.perf_counter_ns()
+        for _ in range(n_cycles):
+            image.commit()
+            master.send_processdata()
+            master.receive_processdata(2000)
+            image.refresh()
+        return (time.perf_counter_ns() - start) / n_cycles / 1000
+
+    return _best(run, 7)
+
+
+# Same line with the outputs of one slave changing per cycle and the inputs decoded through the signal map,
+# changed: commit / refresh / decode only the slaves that changed, otherwise all of them
+def cycle_overhead_decode(n_slaves, changed, n_cycles=2000):
+    master = _master_in_op(n_slaves)
+    image = ProcessImage(master.slaves)
+    signal_map = compile_signal_map(image, master.slaves)
+    outputs = [image.output_view(pos) for pos, slave in enumerate(master.slaves) if len(slave.output)]
+    commit = image.commit_changed if changed else image.commit
+    refresh = image.refresh_changed if changed else image.refresh
+
+    def run():
+        start = time.perf_counter_ns()
+        for i in range(n_cycles):
+            outputs[i % len(outputs)][0] = i & 0xFF
+            commit()
+            master.send_processdata()
+            master.receive_processdata(2000)
+            refresh()
+            signal_map.decode_inputs(skip_unchanged=changed)
+        return (time.perf_counter_ns() - start) / n_cycles / 1000
+
+    return _best(run, 7)
+
+
+# Outputs / inputs of all terminals of the example as in the original _pdo_update_loop
+def pdo_struct(n_cycles=20000):
+    master = _master_in_op()
+    el4008, el4114, el3144, el2624, el2872, el1872 = [master.slaves[pos] for pos in (1, 2, 3, 4, 5, 6)]
+    setpoints = [0x0CCD, 0x1999, 0x2666, 0x3332, 0x0CCD, 0x1999, 0x2666, 0x3332]
+
+    def run():
+        start = time.perf_counter_ns()
+        for _ in range(n_cycles):
+            el4008.output = struct.pack('8h', *setpoints)
+            el4114.output = struct.pack('4h', *setpoints[:4])
+            el2624.output = struct.pack('B', 0x05)
+            el2872.output = struct.pack('H', 0xAAAA)
+            values = struct.unpack('8h', el3144.input)
+            digital = struct.unpack('H', el1872.input)
+        return (time.perf_counter_ns() - start) / n_cycles / 1000
+
+    return _best(run, 7)
+
+
+def pdo_view(n_cycles=20000):
+    master = _master_in_op()
+    image = ProcessImage(master.slaves)
+    el4008 = image.output_view(1, 'h')
+    el4114 = image.output_view(2, 'h')
+    el3144 = image.input_view(3, 'h')
+    el2624 = image.output_view(4, 'B')
+    el2872 = image.output_view(5, 'H')
+    el1872 = image.input_view(6, 'H')
+    setpoints = array('h', [0x0CCD, 0x1999, 0x2666, 0x3332, 0x0CCD, 0x1999, 0x2666, 0x3332])
+    currents = setpoints[:4]
+
+    def run():
+        start = time.perf_counter_ns()
+        for _ in range(n_cycles):
+            el4008[:] = setpoints
+            el4114[:] = currents
+            el2624[0] = 0x05
+            el2872[0] = 0xAAAA
+            image.commit()
+            image.refresh()
+            value = el3144[1]
+            digital = el1872[0]
+        return (time.perf_counter_ns() - start) / n_cycles / 1000
+
+    return _best(run, 7)
+
+
+# Object dictionaries of a 21 slave line as in read_sdo_info(), without / with the OD cache
+def od_enumeration(warm):
+    def run():
+        master = _master_in_op(21, mailbox_time_s=MAILBOX_TIME_S)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            od_cache = ODCache(cache_dir)
+            if warm:
+                BulkSdoReader().read_ods(master.slaves, od_cache.get_od)
+            start = time.perf_counter_ns()
+            BulkSdoReader().read_ods(master.slaves, od_cache.get_od)
+            return (time.perf_counter_ns() - start) / 1000
+
+    return _median(run, 3)
+
+
+# config_init -> OP as in ThreadingExample.run()
+def startup_to_op():
+    def run():
+        start = time.perf_counter_ns()
+        master = FakeMaster(access_time_s=ACCESS_TIME_S)
+        master.open('fake')
+        master.config_init()
+        example = ThreadingExample('fake', master=master)
+        for pos, slave in enumerate(master.slaves):
+            if slave.id != example._expected_slave_layout[pos].product_code:
+                raise RuntimeError('Unexpected slaves layout')
+            slave.config_func = example._expected_slave_layout[pos].config_func
+        master.config_map()
+        master.state_check(pysoem.SAFEOP_STATE, 50000)
+        master.state = pysoem.OP_STATE
+        master.write_state()
+        for _ in range(40):
+            if master.state_check(pysoem.OP_STATE, 50000) == pysoem.OP_STATE:
+                break
+        return (time.perf_counter_ns() - start) / 1000
+
+    return _median(run, 5)
+
+
+# ThreadingExample._check_slave until the faulty slave is back in OP
+def check_slave_recovery(state, stuck=0):
+    def run():
+        master = _master_in_op(access_time_s=ACCESS_TIME_S)
+        slave = master.slaves[3]
+        master.inject_fault(3, state, stuck=stuck)
+        start = time.perf_counter_ns()
+        with contextlib.redirect_stdout(io.StringIO()):
+            while slave.state != pysoem.OP_STATE:
+                ThreadingExample._check_slave(slave, 3)
+        return (time.perf_counter_ns() - start) / 1000
+
+    return _median(run, 5)
+
+
+# SlaveSupervisor on a 100 slave line with three faulty slaves, WKC deficit -> all slaves in OP
+def supervisor_recovery():
+    def run():
+        master = _master_in_op(100, access_time_s=ACCESS_TIME_S)
+        supervisor = SlaveSupervisor(master, log=lambda message: None)
+        supervisor.start()
+        master.inject_fault(3, SAFEOP_ERROR_STATE)
+        master.inject_fault(40, pysoem.NONE_STATE, stuck=1)
+        master.inject_fault(90, pysoem.PREOP_STATE)
+        start = time.perf_counter_ns()
+        while True:
+            wkc = master.receive_processdata()
+            if wkc == master.expected_wkc:
+                break
+            supervisor.notify_wkc(wkc)
+            time.sleep(0.0001)
+        elapsed = (time.perf_counter_ns() - start) / 1000
+        supervisor.stop()
+        return elapsed
+
+    return _median(run, 3)
+
+
+# 1000 events posted to the event log (cost on the cycle thread, the queue is drained in between)
+def event_log_post():
+    events = EventLog(write=lambda line: None)
+
+    def run():
+        start = time.perf_counter_ns()
+        for i in range(1000):
+            events.wkc_mismatch(i & 7, 21)
+        elapsed = (time.perf_counter_ns() - start) / 1000
+        events.flush()
+        return elapsed
+
+    return _best(run, 7)
+
+
+# Name -> function, results in us (lower is better)
+BENCHMARKS = {
+    'cycle_overhead_10_slaves': lambda: cycle_overhead(10),
+    'cycle_overhead_50_slaves': lambda: cycle_overhead(50),
+    'cycle_overhead_100_slaves': lambda: cycle_overhead(100),
+    'cycle_overhead_200_slaves': lambda: cycle_overhead(200),
+    'cycle_overhead_full_100_slaves': lambda: cycle_overhead_decode(100, False),
+    'cycle_overhead_changed_100_slaves': lambda: cycle_overhead_decode(100, True),
+    'pdo_struct': pdo_struct,
+    'pdo_view': pdo_view,
+    'od_enumeration_cold': lambda: od_enumeration(False),
+    'od_enumeration_warm': lambda: od_enumeration(True),
+    'startup_to_op': startup_to_op,
+    'check_slave_recovery_safeop_error': lambda: check_slave_recovery(SAFEOP_ERROR_STATE),
+    'check_slave_recovery_lost': lambda: check_slave_recovery(pysoem.NONE_STATE, stuck=1),
+    'supervisor_recovery_100_slaves': supervisor_recovery,
+    'event_log_post_1000': event_log_post,
+}
+
+
+# Fastest result per benchmark over rounds runs of all of them (a slow phase of the machine hits one
+# round of every benchmark instead of all runs of one benchmark)
+def run_benchmarks(names, rounds=DEFAULT_ROUNDS):
+    results = {}
+    for _ in range(rounds):
+        for name in names:
+            value = BENCHMARKS[name]()
+            results[name] = min(value, results.get(name, value))
+    return results
+
+
+# Compare results with a baseline, returns [(name, result, baseline, ratio, regression)]
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    rows = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        ratio = value / reference if reference else None
+        rows.append((name, value, reference, ratio, ratio is not None and ratio > 1 + threshold))
+    return rows
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'host': platform.node(),
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2, sort_keys=True)
+
+
+# Main fct - exits with 1 if a benchmark regressed against the baseline
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks against the simulated EtherCAT bus')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all, substrings match)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file (JSON)')
+    parser.add_argument('--save', action='store_true', help='store the results as new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slowdown flagged as regression (default: 0.2)')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS,
+                        help='runs per benchmark, the fastest counts (default: {})'.format(DEFAULT_ROUNDS))
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.names or any(pattern in name for pattern in args.names)]
+    results = run_benchmarks(names, args.rounds)
+    baseline = load_baseline(args.baseline) if os.path.exists(args.baseline) else {}
+
+    # Measure the benchmarks beyond the threshold again before reporting them
+    suspects = [row[0] for row in compare(results, baseline, args.threshold) if row[4]]
+    if suspects:
+        for name, value in run_benchmarks(suspects, args.rounds).items():
+            results[name] = min(value, results[name])
+
+    regressions = 0
+    for name, value, reference, ratio, regression in compare(results, baseline, args.threshold):
+        if ratio is None:
+            print('{:36} {:12.1f} us'.format(name, value))
+        else:
+            print('{:36} {:12.1f} us  baseline {:12.1f} us  {:+6.1f} %{}'.format(
+                name, value, reference, (ratio - 1) * 100, '  REGRESSION' if regression else ''))
+        regressions += regression
+
+    if args.save:
+        save_baseline(args.baseline, dict(baseline, **results))
+        print('Baseline saved to {}'.format(args.baseline))
+    if regressions:
+        print('{} regression(s) beyond {:.0f} %'.format(regressions, args.threshold * 100))
+        sys.exit(1)
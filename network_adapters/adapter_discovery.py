@@ -0,0 +1,194 @@
+"""Finds the network adapter of an EtherCAT chain: probes the candidate adapters concurrently, caches the result per host"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pysoem
+
+# The topology fingerprint lives next to the separate_thread example
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'separate_thread'))
+from startup_snapshot import topology_fingerprint
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ethercat_adapters')
+
+# Result of probing one adapter
+# n_slaves: slaves found by config_init (0: no chain or adapter not usable, see error)
+# product_codes: product code per position, fingerprint: topology_fingerprint() of the chain
+AdapterProbe = namedtuple('AdapterProbe', 'name desc n_slaves product_codes fingerprint error elapsed')
+
+
+# Open the adapter, enumerate the slaves (config_init, the slaves end up in PREOP) and close it again.
+# Probing sends EtherCAT broadcasts and resets the chain on the port: never probe a port whose chain is run
+# by another master (e.g. a MasterPool segment) or an office / LAN port, only the candidates given.
+def probe_adapter(name, desc='', master_factory=pysoem.Master):
+    start = time.monotonic()
+    master = master_factory()
+    try:
+        master.open(name)
+    except (ConnectionError, OSError) as exc:
+        return AdapterProbe(name, desc, 0, [], None, str(exc), time.monotonic() - start)
+    try:
+        # Let the probes of different adapters overlap
+        master.always_release_gil = True
+        if master.config_init() > 0:
+            slaves = master.slaves
+            return AdapterProbe(name, desc, len(slaves), [slave.id for slave in slaves], topology_fingerprint(slaves),
+                                None, time.monotonic() - start)
+        return AdapterProbe(name, desc, 0, [], None, None, time.monotonic() - start)
+    finally:
+        master.close()
+
+
+# Probe the adapters (from pysoem.find_adapters()) concurrently, returns an AdapterProbe per adapter
+def probe_adapters(adapters, master_factory=pysoem.Master):
+    adapters = list(adapters)
+    if not adapters:
+        return []
+    with ThreadPoolExecutor(max_workers=len(adapters)) as executor:
+        return list(executor.map(lambda adapter: probe_adapter(adapter.name, _desc(adapter), master_factory), adapters))
+
+
+def _desc(adapter):
+    desc = adapter.desc
+    return desc.decode('utf-8', 'replace') if isinstance(desc, bytes) else desc
+
+
+# True if the probed chain is the expected one
+# expected: topology fingerprint (str) or list of product codes in bus order
+def matches(probe, expected):
+    if probe.n_slaves <= 0:
+        return False
+    if isinstance(expected, str):
+        return probe.fingerprint == expected
+    return probe.product_codes == list(expected)
+
+
+# Probe results of this host, stored as <directory>/<hostname>.json
+class AdapterCache:
+
+    # Constructor
+    # path: JSON file (None: kept in memory only)
+    def __init__(self, path=None):
+        self.path = path
+        self._probes = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self._probes = {name: AdapterProbe(**fields) for name, fields in json.load(f).items()}
+            except (OSError, ValueError, TypeError):
+                self._probes = {}
+
+    @classmethod
+    def for_host(cls, directory=DEFAULT_CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, '{}.json'.format(socket.gethostname())))
+
+    def get(self, name):
+        return self._probes.get(name)
+
+    def update(self, probes):
+        for probe in probes:
+            self._probes[probe.name] = probe
+
+    def clear(self):
+        self._probes = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump({name: probe._asdict() for name, probe in self._probes.items()}, f)
+        os.replace(tmp_path, self.path)
+
+
+# Name of the adapter whose chain matches expected (fingerprint or list of product codes).
+# candidates: names of the adapters that may be probed (ports reserved for EtherCAT)
+# The adapter of a match in the cache is probed alone and returned if its chain still matches, otherwise
+# (or with refresh) all candidates are probed concurrently and the cache is updated.
+# Raises AdapterDiscoveryError if no candidate has the expected chain.
+def find_ethercat_adapter(expected, candidates, cache=None, refresh=False, master_factory=pysoem.Master, adapters=None):
+    if cache is None:
+        cache = AdapterCache.for_host()
+    if adapters is None:
+        adapters = pysoem.find_adapters()
+    adapters = [adapter for adapter in adapters if adapter.name in candidates]
+    if not refresh:
+        for adapter in adapters:
+            probe = cache.get(adapter.name)
+            if probe is not None and matches(probe, expected):
+                # Cabling may have changed since: check the cached adapter before using it
+                probe = probe_adapter(adapter.name, _desc(adapter), master_factory)
+                cache.update([probe])
+                if matches(probe, expected):
+                    cache.save()
+                    return adapter.name
+                break
+    probes = probe_adapters(adapters, master_factory)
+    cache.update(probes)
+    cache.save()
+    for probe in probes:
+        if matches(probe, expected):
+            return probe.name
+    raise AdapterDiscoveryError('No adapter with the expected chain: {}'.format(
+        ', '.join('{} ({} slaves)'.format(probe.name, probe.n_slaves) for probe in probes) or 'no candidate adapters'))
+
+
+# Separate class for errors
+class AdapterDiscoveryError(Exception):
+    def __init__(self, message):
+        super(AdapterDiscoveryError, self).__init__(message)
+        self.message = message
+
+
+# Probe the adapters given as arguments, or with "fake": sequential vs. concurrent probing, a cached start
+# and a start after recabling on 8 simulated ports (no NIC required)
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'fake':
+        import tempfile
+
+        from fake_master import DEFAULT_LAYOUT, FakeMaster
+
+        Adapter = namedtuple('Adapter', 'name desc')
+        adapters = [Adapter('eth{}'.format(i), 'Port {}'.format(i)) for i in range(8)]
+        chains = {'eth5': DEFAULT_LAYOUT, 'eth2': DEFAULT_LAYOUT[:3]}
+        expected = [product_code for _, product_code, _, _ in DEFAULT_LAYOUT]
+
+        # config_init takes ~0.3 s, longer on ports without slaves (SOEM waits for the timeouts)
+        class PortMaster(FakeMaster):
+            def open(self, ifname, ioMapSize=4096):
+                self._layout = chains.get(ifname, [])
+
+            def config_init(self, usetable=False):
+                time.sleep(0.3 if self._layout else 0.5)
+                return super().config_init(usetable) or -1
+
+        candidates = [adapter.name for adapter in adapters]
+        start = time.perf_counter()
+        for adapter in adapters:
+            probe_adapter(adapter.name, adapter.desc, PortMaster)
+        print('sequential probing: {:.0f} ms'.format((time.perf_counter() - start) * 1000))
+        with tempfile.TemporaryDirectory() as directory:
+            for label in ('first start (probing)', 'later start (cached)', 'after recabling'):
+                if label == 'after recabling':
+                    chains = {'eth3': DEFAULT_LAYOUT}
+                start = time.perf_counter()
+                name = find_ethercat_adapter(expected, candidates, AdapterCache.for_host(directory),
+                                             master_factory=PortMaster, adapters=adapters)
+                print('{}: {} in {:.0f} ms'.format(label, name, (time.perf_counter() - start) * 1000))
+    elif len(sys.argv) > 1:
+        for probe in probe_adapters(adapter for adapter in pysoem.find_adapters() if adapter.name in sys.argv[1:]):
+            print('{} ({}): {} slaves{}{}'.format(probe.name, probe.desc, probe.n_slaves,
+                                                  ', fingerprint {}'.format(probe.fingerprint) if probe.fingerprint else '',
+                                                  ', {}'.format(probe.error) if probe.error else ''))
+    else:
+        print('Usage: adapter_discovery ifname [ifname ...] | fake')
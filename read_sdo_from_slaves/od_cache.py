@@ -0,0 +1,252 @@
+"""Persistent cache of slave object dictionaries keyed by vendor id / product code / revision"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pysoem
+
+from od_index import ODIndex
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ethercat_od')
+
+# Cache files not used for this long are removed (90 days)
+DEFAULT_MAX_AGE_S = 90 * 24 * 3600
+
+# File layout (little endian):
+#   header:  magic, format version, flags, number of objects
+#   object:  index, object_code, data_type, bit_length, obj_access, number of entries, name
+#   entry:   data_type, bit_length, obj_access, name
+#   name:    uint16 length + UTF-8 bytes
+_MAGIC = b'ODC1'
+_VERSION = 1
+_FLAG_NO_SDO_INFO = 0x01
+_HEADER = struct.Struct('<4sHHI')
+_OBJECT = struct.Struct('<HBHHHH')
+_ENTRY = struct.Struct('<HHH')
+_NAME_LENGTH = struct.Struct('<H')
+
+
+# Object entry with the attributes of pysoem's CdefCoeObjectEntry
+class CachedEntry:
+
+    __slots__ = ('name', 'data_type', 'bit_length', 'obj_access')
+
+    # Constructor
+    def __init__(self, name, data_type, bit_length, obj_access):
+        self.name = name
+        self.data_type = data_type
+        self.bit_length = bit_length
+        self.obj_access = obj_access
+
+
+# Object with the attributes of pysoem's CdefCoeObject
+class CachedObject:
+
+    __slots__ = ('index', 'object_code', 'data_type', 'bit_length', 'obj_access', 'name', 'entries')
+
+    # Constructor
+    def __init__(self, index, object_code, data_type, bit_length, obj_access, name, entries):
+        self.index = index
+        self.object_code = object_code
+        self.data_type = data_type
+        self.bit_length = bit_length
+        self.obj_access = obj_access
+        self.name = name
+        self.entries = entries
+
+
+# Serialize an object dictionary (None: slave has no SDO info)
+def dump_od(od):
+    chunks = [_HEADER.pack(_MAGIC, _VERSION, _FLAG_NO_SDO_INFO if od is None else 0, len(od or ()))]
+    for obj in od or ():
+        chunks.append(_OBJECT.pack(obj.index, obj.object_code, obj.data_type, obj.bit_length, obj.obj_access, len(obj.entries)))
+        chunks.append(_pack_name(obj.name))
+        for entry in obj.entries:
+            chunks.append(_ENTRY.pack(entry.data_type, entry.bit_length, entry.obj_access))
+            chunks.append(_pack_name(entry.name))
+    return b''.join(chunks)
+
+
+# Deserialize an object dictionary from a buffer (bytes or mmap), returns None for slaves without SDO info
+def load_od(buffer):
+    magic, version, flags, n_objects = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('not an object dictionary cache file')
+    if flags & _FLAG_NO_SDO_INFO:
+        return None
+    offset = _HEADER.size
+    od = []
+    for _ in range(n_objects):
+        index, object_code, data_type, bit_length, obj_access, n_entries = _OBJECT.unpack_from(buffer, offset)
+        name, offset = _unpack_name(buffer, offset + _OBJECT.size)
+        entries = []
+        for _ in range(n_entries):
+            entry_type, entry_bits, entry_access = _ENTRY.unpack_from(buffer, offset)
+            entry_name, offset = _unpack_name(buffer, offset + _ENTRY.size)
+            entries.append(CachedEntry(entry_name, entry_type, entry_bits, entry_access))
+        od.append(CachedObject(index, object_code, data_type, bit_length, obj_access, name, entries))
+    return od
+
+
+def _pack_name(name):
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    encoded = name.encode('utf-8')
+    return _NAME_LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_name(buffer, offset):
+    length = _NAME_LENGTH.unpack_from(buffer, offset)[0]
+    start = offset + _NAME_LENGTH.size
+    return bytes(buffer[start:start + length]).decode('utf-8'), start + length
+
+
+# Object dictionaries read once per terminal type and stored in cache_dir (None: kept in memory only).
+# Identical terminals (same vendor / product / revision) share one parsed dictionary, every revision
+# has its own file (a line may mix revisions of a terminal, several processes may share the cache).
+# A cache hit refreshes the modification time of the file; files not used for max_age_s are removed
+# whenever a new file is stored.
+class ODCache:
+
+    # Constructor
+    # cache_dir: directory of the cache files (e.g. DEFAULT_CACHE_DIR), None: no cache files
+    # max_age_s: remove cache files not used for this long (None: keep all files)
+    def __init__(self, cache_dir=None, max_age_s=DEFAULT_MAX_AGE_S):
+        self.cache_dir = cache_dir
+        self.max_age_s = max_age_s
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._indices = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(slave):
+        return (slave.man, slave.id, slave.rev)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{:08x}_{:08x}_{:08x}.od'.format(*key))
+
+    # Object dictionary of a slave - raises pysoem.SdoInfoError like slave.od if the slave has no SDO info.
+    # Thread safe: identical terminals requested concurrently are read from the bus only once.
+    def get_od(self, slave):
+        key = self.key(slave)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            self._fill(key, slave)
+        od = self._loaded[key]
+        if od is None:
+            raise pysoem.SdoInfoError('no SDO info for {}'.format(slave.name))
+        return od
+
+    # ODIndex of the object dictionary of a slave, one per terminal type (built on the first lookup)
+    def get_index(self, slave):
+        key = self.key(slave)
+        index = self._indices.get(key)
+        if index is None:
+            index = self._indices.setdefault(key, ODIndex(self.get_od(slave)))
+        return index
+
+    def _fill(self, key, slave):
+        if key not in self._loaded:
+            od = self._load_file(key)
+            if od is False:
+                self.misses += 1
+                try:
+                    od = slave.od
+                except pysoem.SdoInfoError:
+                    od = None
+                try:
+                    self._store_file(key, od)
+                except OSError:
+                    # Read-only or full disk: keep working without the cache file
+                    pass
+            else:
+                self.hits += 1
+            self._loaded[key] = od
+
+    # Returns False if there is no (valid) cache file
+    def _load_file(self, key):
+        if self.cache_dir is None:
+            return False
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    od = load_od(buffer)
+        except (OSError, ValueError, struct.error, UnicodeDecodeError):
+            return False
+        # Mark the file as used (keeps it from being pruned)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return od
+
+    def _store_file(self, key, od):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._prune()
+        # Write to a temporary file first, so an interrupted start never leaves a truncated cache file
+        path = self._path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(dump_od(od))
+        os.replace(tmp_path, path)
+
+    # Remove the cache files (and leftover temporary files) not used for max_age_s
+    def _prune(self):
+        if self.max_age_s is None:
+            return
+        oldest = time.time() - self.max_age_s
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.od') or name.endswith('.tmp'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    if os.path.getmtime(path) < oldest:
+                        os.remove(path)
+                except OSError:
+                    # Removed or replaced by another process meanwhile
+                    pass
+
+    # Remove all cache files
+    def clear(self):
+        self._loaded.clear()
+        self._indices.clear()
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.od'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+# Startup time with a cold vs. a warm cache, using the object dictionaries recorded in log.txt
+if __name__ == '__main__':
+
+    import sys
+    import tempfile
+
+    from recorded_od import recorded_slaves
+
+    mailbox_latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0005
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ('cold', 'warm'):
+            slaves = recorded_slaves(mailbox_latency=mailbox_latency)
+            cache = ODCache(cache_dir)
+            start = time.perf_counter()
+            n_objects = 0
+            for slave in slaves:
+                try:
+                    n_objects += len(cache.get_od(slave))
+                except pysoem.SdoInfoError:
+                    pass
+            elapsed = time.perf_counter() - start
+            print('{} cache: {:.1f} ms, {} objects, {} mailbox transactions'.format(
+                run, elapsed * 1000, n_objects, sum(slave.mailbox_transactions for slave in slaves)))
@@ -0,0 +1,307 @@
+"""Index of an object dictionary: O(1) lookup by (index, subindex) or name and typed SDO value codecs"""
+
+import struct
+
+
+# CoE basic data types (ETG.1000.6)
+BOOLEAN = 0x0001
+INTEGER8 = 0x0002
+INTEGER16 = 0x0003
+INTEGER32 = 0x0004
+UNSIGNED8 = 0x0005
+UNSIGNED16 = 0x0006
+UNSIGNED32 = 0x0007
+REAL32 = 0x0008
+VISIBLE_STRING = 0x0009
+OCTET_STRING = 0x000A
+UNICODE_STRING = 0x000B
+DOMAIN = 0x000F
+REAL64 = 0x0011
+BIT1 = 0x0030
+BIT8 = 0x0037
+
+# Integer types: data type -> signed
+INTEGER_TYPES = {INTEGER8: True, INTEGER16: True, INTEGER32: True, 0x0010: True, 0x0012: True, 0x0013: True,
+                 0x0014: True, 0x0015: True,
+                 UNSIGNED8: False, UNSIGNED16: False, UNSIGNED32: False, 0x0016: False, 0x0018: False, 0x0019: False,
+                 0x001A: False, 0x001B: False, 0x002D: False, 0x002E: False, 0x002F: False}
+
+# Bit length of the fixed size types (for values without an object dictionary entry, e.g. in SDO writes)
+BIT_LENGTHS = {BOOLEAN: 1, INTEGER8: 8, INTEGER16: 16, INTEGER32: 32, UNSIGNED8: 8, UNSIGNED16: 16, UNSIGNED32: 32,
+               REAL32: 32, 0x0010: 24, REAL64: 64, 0x0012: 40, 0x0013: 48, 0x0014: 56, 0x0015: 64,
+               0x0016: 24, 0x0018: 40, 0x0019: 48, 0x001A: 56, 0x001B: 64}
+
+_STRUCT_FORMATS = {(1, True): 'b', (2, True): 'h', (4, True): 'i', (8, True): 'q',
+                   (1, False): 'B', (2, False): 'H', (4, False): 'I', (8, False): 'Q'}
+
+
+# Integers (also BITn and manufacturer specific enumerations): little endian, bit_length bits
+class IntCodec:
+
+    __slots__ = ('size', 'signed', 'mask', '_struct')
+
+    # Constructor
+    def __init__(self, bit_length, signed=False):
+        self.size = max(1, (bit_length + 7) // 8)
+        self.signed = signed
+        self.mask = (1 << bit_length) - 1 if bit_length % 8 else None
+        fmt = _STRUCT_FORMATS.get((self.size, signed))
+        self._struct = struct.Struct('<' + fmt) if fmt is not None and self.mask is None else None
+
+    def decode(self, data):
+        if self._struct is not None:
+            return self._struct.unpack_from(data)[0]
+        value = int.from_bytes(data[:self.size], 'little', signed=self.signed)
+        return value & self.mask if self.mask is not None else value
+
+    def encode(self, value):
+        if self._struct is not None:
+            return self._struct.pack(value)
+        if self.mask is not None:
+            value &= self.mask
+        return int(value).to_bytes(self.size, 'little', signed=self.signed)
+
+
+class BoolCodec:
+
+    __slots__ = ()
+    size = 1
+
+    def decode(self, data):
+        return bool(data[0] & 1)
+
+    def encode(self, value):
+        return b'\x01' if value else b'\x00'
+
+
+class RealCodec:
+
+    __slots__ = ('size', '_struct')
+
+    # Constructor
+    def __init__(self, fmt):
+        self._struct = struct.Struct('<' + fmt)
+        self.size = self._struct.size
+
+    def decode(self, data):
+        return self._struct.unpack_from(data)[0]
+
+    def encode(self, value):
+        return self._struct.pack(value)
+
+
+# VISIBLE_STRING / UNICODE_STRING, trailing NUL bytes are removed
+class StringCodec:
+
+    __slots__ = ('encoding',)
+    size = 0
+
+    # Constructor
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def decode(self, data):
+        return bytes(data).decode(self.encoding, 'replace').rstrip('\x00')
+
+    def encode(self, value):
+        return value.encode(self.encoding)
+
+
+# OCTET_STRING, DOMAIN and unknown types: the raw bytes
+class BytesCodec:
+
+    __slots__ = ()
+    size = 0
+
+    def decode(self, data):
+        return bytes(data)
+
+    def encode(self, value):
+        return bytes(value)
+
+
+_codecs = {}
+
+
+# Codec of a data type / bit length, shared by all entries of the same type
+# (bit_length None: the length of a fixed size type, see BIT_LENGTHS)
+def codec_for(data_type, bit_length=None):
+    if bit_length is None:
+        bit_length = BIT_LENGTHS[data_type]
+    key = (data_type, bit_length)
+    codec = _codecs.get(key)
+    if codec is None:
+        if data_type == BOOLEAN:
+            codec = BoolCodec()
+        elif data_type == REAL32:
+            codec = RealCodec('f')
+        elif data_type == REAL64:
+            codec = RealCodec('d')
+        elif data_type == VISIBLE_STRING:
+            codec = StringCodec('latin-1')
+        elif data_type == UNICODE_STRING:
+            codec = StringCodec('utf-16-le')
+        elif data_type in INTEGER_TYPES:
+            codec = IntCodec(bit_length, INTEGER_TYPES[data_type])
+        elif BIT1 <= data_type <= BIT8 or (data_type >= 0x0800 and 0 < bit_length <= 64):
+            # BITn and manufacturer specific (enumeration) types
+            codec = IntCodec(bit_length)
+        else:
+            codec = BytesCodec()
+        _codecs[key] = codec
+    return codec
+
+
+# One object entry (the entry of a VAR object has subindex 0 and the object's name)
+class ODEntry:
+
+    __slots__ = ('index', 'subindex', 'name', 'data_type', 'bit_length', 'obj_access', 'object_name', 'codec')
+
+    # Constructor
+    def __init__(self, index, subindex, name, data_type, bit_length, obj_access, object_name):
+        self.index = index
+        self.subindex = subindex
+        self.name = name
+        self.data_type = data_type
+        self.bit_length = bit_length
+        self.obj_access = obj_access
+        self.object_name = object_name
+        self.codec = codec_for(data_type, bit_length)
+
+    def __repr__(self):
+        return 'ODEntry({:#06x}:{:02x} {!r})'.format(self.index, self.subindex, self.name)
+
+    # Value of an SDO read of this entry
+    def decode(self, data):
+        return self.codec.decode(data)
+
+    def encode(self, value):
+        return self.codec.encode(value)
+
+    def read(self, slave):
+        return self.codec.decode(slave.sdo_read(self.index, self.subindex))
+
+    def write(self, slave, value):
+        slave.sdo_write(self.index, self.subindex, self.codec.encode(value))
+
+
+# Lookup tables over an object dictionary (slave.od, ODCache.get_od() or a recorded one).
+# Keys: (index, subindex), index (subindex 0), 'Object name' (VAR objects) or 'Object name/Entry name'.
+# Objects with the same name (e.g. 'AI Inputs' of every channel) are also found as
+# 'Object name Ch.<n>' (n-th object of that name), the plain name finds the first one.
+# The tables are built on the first lookup, entries with data type 0 (gaps) are left out.
+class ODIndex:
+
+    # Constructor
+    def __init__(self, od):
+        self.od = od
+        self._by_key = None
+        self._by_name = None
+
+    def _build(self):
+        by_key = {}
+        by_name = {}
+        occurrences = {}
+        for obj in self.od:
+            count = occurrences[obj.name] = occurrences.get(obj.name, 0) + 1
+            object_names = [obj.name, '{} Ch.{}'.format(obj.name, count)]
+            if count > 1:
+                object_names = object_names[1:]
+            if obj.entries:
+                for subindex, raw in enumerate(obj.entries):
+                    if raw.data_type == 0 and raw.bit_length == 0:
+                        continue
+                    entry = ODEntry(obj.index, subindex, raw.name, raw.data_type, raw.bit_length, raw.obj_access, obj.name)
+                    by_key[(obj.index, subindex)] = entry
+                    for object_name in object_names:
+                        by_name.setdefault('{}/{}'.format(object_name, raw.name), entry)
+            else:
+                entry = ODEntry(obj.index, 0, obj.name, obj.data_type, obj.bit_length, obj.obj_access, obj.name)
+                by_key[(obj.index, 0)] = entry
+                for object_name in object_names:
+                    by_name.setdefault(object_name, entry)
+        self._by_name = by_name
+        self._by_key = by_key
+
+    # Entry by (index, subindex), index or name, raises KeyError
+    def __getitem__(self, key):
+        if self._by_key is None:
+            self._build()
+        if isinstance(key, str):
+            return self._by_name[key]
+        if isinstance(key, int):
+            key = (key, 0)
+        return self._by_key[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        if self._by_key is None:
+            self._build()
+        return len(self._by_key)
+
+    def __iter__(self):
+        if self._by_key is None:
+            self._build()
+        return iter(self._by_key.values())
+
+    # All names usable as key
+    def names(self):
+        if self._by_key is None:
+            self._build()
+        return list(self._by_name)
+
+
+# Lookup time of a linear scan over slave.od vs. the index for growing dictionaries, and decoding (no NIC required)
+if __name__ == '__main__':
+
+    import time
+
+    from recorded_od import RecordedObject, parse_log
+
+    n_lookups = 20000
+
+    def scan(od, index, subindex):
+        for obj in od:
+            if obj.index == index:
+                return obj.entries[subindex] if obj.entries else obj
+
+    el3144 = parse_log()['EL3144']
+    for n_copies in (1, 10, 100):
+        # Dictionary of n_copies times the EL3144 objects at distinct indices
+        od = [RecordedObject(obj.index + 0x10000 * copy, obj.object_code, obj.data_type, obj.bit_length, obj.obj_access,
+                             obj.name, obj.entries) for copy in range(n_copies) for obj in el3144]
+        last = od[-1].index
+        start = time.perf_counter()
+        for _ in range(n_lookups):
+            scan(od, last, 0)
+        scan_time = (time.perf_counter() - start) / n_lookups
+        od_index = ODIndex(od)
+        od_index[(last, 0)]
+        start = time.perf_counter()
+        for _ in range(n_lookups):
+            od_index[(last, 0)]
+        index_time = (time.perf_counter() - start) / n_lookups
+        print('{:5} objects: linear scan {:8.2f} us, index {:.3f} us'.format(len(od), scan_time * 1e6, index_time * 1e6))
+
+    od_index = ODIndex(el3144)
+    serial = od_index['Identity/Serial number']
+    channel_2 = od_index['AI Inputs Ch.2/Underrange']
+    data = struct.pack('<I', 123456)
+    start = time.perf_counter()
+    for _ in range(n_lookups):
+        struct.unpack('<I', data)[0]
+    struct_time = (time.perf_counter() - start) / n_lookups
+    start = time.perf_counter()
+    for _ in range(n_lookups):
+        serial.decode(data)
+    codec_time = (time.perf_counter() - start) / n_lookups
+    print('{} = {}, {} ({}), decode: struct.unpack {:.3f} us, codec {:.3f} us'.format(
+        serial, serial.decode(data), channel_2, channel_2.decode(b'\x01'), struct_time * 1e6, codec_time * 1e6))
@@ -3,19 +3,28 @@
 import sys
 import pysoem
 
+from od_cache import ODCache
+from sdo_bulk import BulkSdoReader
 
-def read_sdo_info(ifname):
+
+# cache_dir: optionally keep the object dictionaries in this directory (e.g. od_cache.DEFAULT_CACHE_DIR),
+#            they are read from the slaves only once per vendor / product / revision
+def read_sdo_info(ifname, cache_dir=None):
     master = pysoem.Master()
+    od_cache = ODCache(cache_dir)
     
     master.open(ifname)
+    # Let the mailbox transfers of different slaves overlap
+    master.always_release_gil = True
     
     if master.config_init() > 0:
+
+        # Read all object dictionaries concurrently (one worker per slave), print them in bus order
+        ods = BulkSdoReader().read_ods(master.slaves, od_cache.get_od)
     
-        for slave in master.slaves:
-            try:
-                od = slave.od
-            except pysoem.SdoInfoError:
-                print('no SDO info for {}'.format(slave.name))
+        for slave, (od, error) in zip(master.slaves, ods):
+            if error is not None:
+                print('no SDO info for {} ({!r})'.format(slave.name, error))
             else:
                 print(slave.name)
 
@@ -47,6 +56,6 @@ if __name__ == '__main__':
     print('script started')
 
     if len(sys.argv) > 1:
-        read_sdo_info(sys.argv[1])
+        read_sdo_info(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
     else:
-        print('give ifname as script argument')
\ No newline at end of file
+        print('give ifname [OD cache directory] as script arguments')
\ No newline at end of file
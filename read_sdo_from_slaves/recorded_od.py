@@ -0,0 +1,137 @@
+"""Object dictionaries recorded with read_sdo_from_slaves.py (log.txt) and a fake slave serving them"""
+
+import os
+import re
+import time
+
+import pysoem
+
+
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log.txt')
+
+BECKHOFF_VENDOR_ID = 0x0002
+
+# Product codes of the terminals in log.txt
+PRODUCT_CODES = {'EK1100': 0x044c2c52,
+                 'EL4008': 0x0FA83052,
+                 'EL4114': 0x10123052,
+                 'EL3144': 0x0C483052,
+                 'EL2624': 0x0A403052,
+                 'EL2872': 0x0B383052,
+                 'EL1872': 0x07503052}
+
+_OBJECT_LINE = re.compile(r' Idx: 0x([0-9a-f]+); Code: (\d+); Type: (\d+); BitSize: (\d+); Access: 0x([0-9a-f]+); Name: "(.*)"$')
+_ENTRY_LINE = re.compile(r'  Subindex (\d+); Type: (\d+); BitSize: (\d+); Access: 0x([0-9a-f]+) Name: "(.*)"$')
+_NO_INFO_LINE = re.compile(r'no SDO info for (\S+)$')
+
+
+# Object entry with the attributes of pysoem's CdefCoeObjectEntry
+class RecordedEntry:
+
+    __slots__ = ('name', 'data_type', 'bit_length', 'obj_access')
+
+    # Constructor
+    def __init__(self, name='', data_type=0, bit_length=0, obj_access=0):
+        self.name = name
+        self.data_type = data_type
+        self.bit_length = bit_length
+        self.obj_access = obj_access
+
+
+# Object with the attributes of pysoem's CdefCoeObject (entries are indexed by subindex)
+class RecordedObject:
+
+    __slots__ = ('index', 'object_code', 'data_type', 'bit_length', 'obj_access', 'name', 'entries')
+
+    # Constructor
+    def __init__(self, index, object_code, data_type, bit_length, obj_access, name, entries=None):
+        self.index = index
+        self.object_code = object_code
+        self.data_type = data_type
+        self.bit_length = bit_length
+        self.obj_access = obj_access
+        self.name = name
+        self.entries = entries if entries is not None else []
+
+
+# Parse the output of read_sdo_info(), returns {slave name: [RecordedObject] or None (no SDO info)}
+# in the order of the bus. Subindices that were not printed are filled with empty entries.
+def parse_log(path=LOG_FILE):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text = raw.decode('utf-16') if raw[:2] in (b'\xff\xfe', b'\xfe\xff') else raw.decode('utf-8')
+
+    slaves = {}
+    objects = None
+    for line in text.splitlines():
+        match = _ENTRY_LINE.match(line)
+        if match:
+            subindex = int(match.group(1))
+            entries = objects[-1].entries
+            while len(entries) < subindex:
+                entries.append(RecordedEntry())
+            entries.append(RecordedEntry(match.group(5), int(match.group(2)), int(match.group(3)), int(match.group(4), 16)))
+            continue
+        match = _OBJECT_LINE.match(line)
+        if match:
+            objects.append(RecordedObject(int(match.group(1), 16), int(match.group(2)), int(match.group(3)),
+                                          int(match.group(4)), int(match.group(5), 16), match.group(6)))
+            continue
+        match = _NO_INFO_LINE.match(line)
+        if match:
+            slaves[match.group(1)] = None
+            continue
+        if line and not line.startswith(' ') and line != 'script started':
+            objects = []
+            slaves[line] = objects
+    return slaves
+
+
+# Fake slave whose slave.od costs one simulated mailbox round trip per object and per entry
+# (like the SDO info services behind pysoem's slave.od)
+class RecordedSlave:
+
+    # Constructor
+    # objects: list of RecordedObject or None (slave without SDO info)
+    def __init__(self, name, objects, man=BECKHOFF_VENDOR_ID, product_code=None, rev=0, mailbox_latency=0.0005):
+        self.name = name
+        self.man = man
+        self.id = product_code if product_code is not None else PRODUCT_CODES.get(name, 0)
+        self.rev = rev
+        self.mailbox_latency = mailbox_latency
+        self.mailbox_transactions = 0
+        self._objects = objects
+        self._by_index = {obj.index: obj for obj in objects or ()}
+
+    def _mailbox_round_trip(self, count=1):
+        self.mailbox_transactions += count
+        if self.mailbox_latency:
+            time.sleep(self.mailbox_latency * count)
+
+    @property
+    def od(self):
+        self._mailbox_round_trip()
+        if self._objects is None:
+            raise pysoem.SdoInfoError('SDO info not supported by {}'.format(self.name))
+        for obj in self._objects:
+            self._mailbox_round_trip(1 + len(obj.entries))
+        return list(self._objects)
+
+    # Returns zeros of the entry's size (the values were not recorded)
+    def sdo_read(self, index, subindex, size=0, ca=False):
+        self._mailbox_round_trip()
+        obj = self._by_index.get(index)
+        if obj is None:
+            raise pysoem.SdoError(0, index, subindex, 0x06020000, 'The object does not exist in the object directory')
+        if obj.entries:
+            if subindex >= len(obj.entries) or obj.entries[subindex].data_type == 0:
+                raise pysoem.SdoError(0, index, subindex, 0x06090011, 'Subindex does not exist')
+            bit_length = obj.entries[subindex].bit_length
+        else:
+            bit_length = obj.bit_length
+        return bytes(size or (bit_length + 7) // 8)
+
+
+# Fake slaves in bus order as recorded in log.txt
+def recorded_slaves(path=LOG_FILE, mailbox_latency=0.0005):
+    return [RecordedSlave(name, objects, mailbox_latency=mailbox_latency) for name, objects in parse_log(path).items()]
@@ -0,0 +1,144 @@
+"""Bulk SDO and object dictionary reads, overlapping the mailboxes of different slaves"""
+
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pysoem
+
+
+# Result of one request: data is None if error is set
+SdoResult = namedtuple('SdoResult', 'slave index subindex data error elapsed')
+
+# Errors of a single SDO transfer that are reported per request instead of aborting the bulk read
+SDO_ERRORS = (pysoem.SdoError, pysoem.MailboxError, pysoem.WkcError, pysoem.PacketError, pysoem.SdoInfoError)
+
+
+# Reads lists of (slave, index, subindex) in one call.
+# Each slave has one mailbox, so the requests of a slave are sent back to back by one worker,
+# while the workers of different slaves run concurrently. pysoem releases the GIL during the
+# mailbox transfer if master.always_release_gil is set.
+class BulkSdoReader:
+
+    # Constructor
+    # max_workers: number of slaves served concurrently (default: one worker per slave)
+    # timeout: default per-request timeout [s], measured from the start of the bulk call. It only limits
+    #          waiting: a request is not sent after its deadline and a response after the deadline is
+    #          discarded, but a running mailbox transfer is not aborted (SOEM ends it with its own
+    #          mailbox timeouts), so a bulk read can take longer than timeout.
+    def __init__(self, max_workers=None, timeout=1.0):
+        self._max_workers = max_workers
+        self.timeout = timeout
+
+    # requests: iterable of (slave, index, subindex) or (slave, index, subindex, timeout)
+    # Returns a list of SdoResult in the order of the requests. A request whose deadline has passed
+    # before its slave's mailbox was free is not sent and reported with a TimeoutError, as is a
+    # response that arrived after the deadline (the transfer itself ran to its end).
+    def read(self, requests):
+        requests = list(requests)
+        per_slave = {}
+        for pos, request in enumerate(requests):
+            per_slave.setdefault(id(request[0]), []).append(pos)
+        results = [None] * len(requests)
+        start = time.monotonic()
+
+        def serve(positions):
+            for pos in positions:
+                request = requests[pos]
+                slave, index, subindex = request[:3]
+                timeout = request[3] if len(request) > 3 else self.timeout
+                t0 = time.monotonic()
+                if t0 - start > timeout:
+                    results[pos] = SdoResult(slave, index, subindex, None, TimeoutError('mailbox busy until deadline'), 0.0)
+                    continue
+                try:
+                    data = slave.sdo_read(index, subindex)
+                    error = None
+                except SDO_ERRORS as exc:
+                    data = None
+                    error = exc
+                elapsed = time.monotonic() - t0
+                if error is None and t0 + elapsed - start > timeout:
+                    error = TimeoutError('response after deadline ({:.1f} ms)'.format(elapsed * 1000))
+                    data = None
+                results[pos] = SdoResult(slave, index, subindex, data, error, elapsed)
+
+        self._run(serve, list(per_slave.values()))
+        return results
+
+    # Read the object dictionaries of several slaves concurrently
+    # get_od: function slave -> od (default: slave.od, e.g. ODCache.get_od to go through the cache)
+    # Returns a list of (od, error) in the order of the slaves
+    def read_ods(self, slaves, get_od=None):
+        if get_od is None:
+            get_od = _slave_od
+        slaves = list(slaves)
+        results = [None] * len(slaves)
+
+        def serve(positions):
+            for pos in positions:
+                try:
+                    results[pos] = (get_od(slaves[pos]), None)
+                except SDO_ERRORS as exc:
+                    results[pos] = (None, exc)
+
+        self._run(serve, [[pos] for pos in range(len(slaves))])
+        return results
+
+    def _run(self, serve, groups):
+        if not groups:
+            return
+        workers = min(self._max_workers or len(groups), len(groups))
+        if workers == 1:
+            for group in groups:
+                serve(group)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(serve, group) for group in groups]:
+                future.result()
+
+
+def _slave_od(slave):
+    return slave.od
+
+
+# Requests for every object entry of an object dictionary: [(slave, index, subindex)]
+def od_requests(slave, od):
+    requests = []
+    for obj in od:
+        if obj.entries:
+            for subindex, entry in enumerate(obj.entries):
+                if entry.data_type > 0 and entry.bit_length > 0:
+                    requests.append((slave, obj.index, subindex))
+        else:
+            requests.append((slave, obj.index, 0))
+    return requests
+
+
+# Throughput with a simulated mailbox latency for 1..n slaves (no NIC required)
+if __name__ == '__main__':
+
+    import sys
+
+    from recorded_od import parse_log, RecordedSlave
+
+    mailbox_latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.001
+    max_slaves = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    el3144_od = parse_log()['EL3144']
+    reader = BulkSdoReader(timeout=60.0)
+    n_slaves = 1
+    while n_slaves <= max_slaves:
+        slaves = [RecordedSlave('EL3144', el3144_od, mailbox_latency=mailbox_latency) for _ in range(n_slaves)]
+        requests = []
+        for slave in slaves:
+            requests += od_requests(slave, el3144_od)[:50]
+        for label, bulk_reader in (('sequential', BulkSdoReader(max_workers=1, timeout=60.0)), ('parallel', reader)):
+            start = time.perf_counter()
+            results = bulk_reader.read(requests)
+            elapsed = time.perf_counter() - start
+            errors = sum(1 for result in results if result.error is not None)
+            print('{:2} slaves {:10}: {:7.0f} SDOs/s ({} requests, {} errors)'.format(
+                n_slaves, label, len(requests) / elapsed, len(requests), errors))
+        n_slaves *= 2
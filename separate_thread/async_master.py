@@ -0,0 +1,170 @@
+"""Asyncio front end for the master lifecycle, state machine and SDO access"""
+
+import asyncio
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pysoem
+
+from cycle_timer import CycleTimer
+
+
+# Wraps a pysoem.Master for use in an asyncio event loop.
+# All blocking pysoem calls (config, state changes, SDOs) run in one dedicated executor thread,
+# the cyclic process data exchange runs in its own thread with a deadline driven cycle timer.
+# Several AsyncMasters (EtherCAT segments) can thus be supervised from a single event loop.
+class AsyncMaster:
+
+    # Constructor
+    # master: pysoem.Master or a stand-in (e.g. fake_master.FakeMaster)
+    def __init__(self, master=None):
+        self.master = master if master is not None else pysoem.Master()
+        # SDO transfers and config_init release the GIL during the mailbox round trip, so the processdata
+        # thread keeps its cycle while the executor waits for a slave
+        self.master.always_release_gil = True
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ethercat-mailbox')
+        self._pd_thread = None
+        self._pd_stop_event = threading.Event()
+        self.cycle_timer = None
+        self.actual_wkc = 0
+        self.cycle_count = 0
+
+    # Run a blocking function in the master's executor
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self, ifname):
+        await self._call(self.master.open, ifname)
+
+    async def config_init(self):
+        return await self._call(self.master.config_init)
+
+    async def config_map(self):
+        return await self._call(self.master.config_map)
+
+    async def close(self):
+        self.stop_processdata()
+        await self._call(self.master.close)
+        self._executor.shutdown(wait=True)
+
+    def _write_state(self, state):
+        self.master.state = state
+        return self.master.write_state()
+
+    # Slaves that are not in the given state as list of (position, name, state, AL status text)
+    def _failed_slaves(self, state):
+        self.master.read_state()
+        return [(pos, slave.name, slave.state, pysoem.al_status_code_to_string(slave.al_status))
+                for pos, slave in enumerate(self.master.slaves) if slave.state != state]
+
+    # Request a state for all slaves and wait until they reached it.
+    # The state is polled with short state_check() calls, so the event loop is never blocked.
+    # Raises AsyncMasterError with the slaves that did not follow after timeout seconds.
+    async def to_state(self, state, timeout=2.0, poll_interval=0.005):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        await self._call(self._write_state, state)
+        while True:
+            if await self._call(self.master.state_check, state, 1000) == state:
+                return
+            if loop.time() > deadline:
+                failed = await self._call(self._failed_slaves, state)
+                raise AsyncMasterError('Not all slaves reached state {:#x}: {}'.format(state, failed))
+            await asyncio.sleep(poll_interval)
+
+    async def sdo_read(self, slave_pos, index, subindex, size=0):
+        return await self._call(self.master.slaves[slave_pos].sdo_read, index, subindex, size)
+
+    async def sdo_write(self, slave_pos, index, subindex, data):
+        return await self._call(self.master.slaves[slave_pos].sdo_write, index, subindex, data)
+
+    # Start the cyclic send / receive thread
+    def start_processdata(self, cycle_time_ns=1000000, cpu=None, rt_priority=None):
+        if self._pd_thread is not None:
+            return
+        self.cycle_timer = CycleTimer(cycle_time_ns)
+        self._pd_stop_event.clear()
+        self._pd_thread = threading.Thread(target=self._processdata_thread, args=(cpu, rt_priority), daemon=True)
+        self._pd_thread.start()
+
+    def stop_processdata(self):
+        if self._pd_thread is None:
+            return
+        self._pd_stop_event.set()
+        self._pd_thread.join()
+        self._pd_thread = None
+
+    def _processdata_thread(self, cpu, rt_priority):
+        CycleTimer.setup_realtime(cpu, rt_priority)
+        self.cycle_timer.start()
+        while not self._pd_stop_event.is_set():
+            self.cycle_timer.wait_next()
+            self.master.send_processdata()
+            self.actual_wkc = self.master.receive_processdata(10000)
+            self.cycle_count += 1
+            self.cycle_timer.cycle_done()
+
+    # Wait until the cyclic exchange returns the expected WKC for n_cycles consecutive cycles
+    async def wait_wkc_ok(self, timeout=1.0, n_cycles=3):
+        if self._pd_thread is None:
+            raise AsyncMasterError('Process data exchange not running')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        poll_interval = self.cycle_timer.period_ns / 1e9
+        ok_since = None
+        while True:
+            if self.actual_wkc == self.master.expected_wkc:
+                if ok_since is None:
+                    ok_since = self.cycle_count
+                elif self.cycle_count - ok_since >= n_cycles:
+                    return
+            else:
+                ok_since = None
+            if loop.time() > deadline:
+                raise AsyncMasterError('WKC {} instead of {}'.format(self.actual_wkc, self.master.expected_wkc))
+            await asyncio.sleep(poll_interval)
+
+
+# Separate class for errors
+class AsyncMasterError(Exception):
+    def __init__(self, message):
+        super(AsyncMasterError, self).__init__(message)
+        self.message = message
+
+
+# Bring one segment to OP, let it run and shut it down again
+async def run_segment(ifname, run_time=5.0, master=None):
+    segment = AsyncMaster(master)
+    await segment.open(ifname)
+    try:
+        if await segment.config_init() <= 0:
+            raise AsyncMasterError('No slaves found')
+        await segment.config_map()
+        await segment.to_state(pysoem.SAFEOP_STATE)
+        segment.start_processdata()
+        await segment.to_state(pysoem.OP_STATE)
+        await segment.wait_wkc_ok()
+        print('{}: OP, {} slaves'.format(ifname, len(segment.master.slaves)))
+        await asyncio.sleep(run_time)
+        print('{}: {}'.format(ifname, segment.cycle_timer.stats()))
+        await segment.to_state(pysoem.INIT_STATE)
+    finally:
+        await segment.close()
+
+
+# Main fct - one or more ifnames, all segments run in one event loop
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        async def main():
+            await asyncio.gather(*(run_segment(ifname) for ifname in sys.argv[1:]))
+        try:
+            asyncio.run(main())
+        except AsyncMasterError as expt:
+            print('Async master failed: ' + expt.message)
+            sys.exit(1)
+    else:
+        print('Usage: async_master ifname [ifname ...]')
+        sys.exit(1)
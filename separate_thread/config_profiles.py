@@ -0,0 +1,138 @@
+"""Declarative per-product slave configuration, applied to all slaves concurrently"""
+
+import os
+import sys
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pysoem
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+from od_index import UNSIGNED8, UNSIGNED16, codec_for
+
+
+# Errors of a single SDO write that are reported per slave instead of aborting the configuration
+_SDO_ERRORS = (pysoem.SdoError, pysoem.MailboxError, pysoem.WkcError, pysoem.PacketError)
+
+
+# One SDO write: value is encoded with the codec of the CoE data type (e.g. od_index.UNSIGNED16)
+class SdoWrite(namedtuple('SdoWrite', 'index subindex data_type value')):
+
+    __slots__ = ()
+
+    @property
+    def data(self):
+        return codec_for(self.data_type).encode(self.value)
+
+
+# Writes that assign a list of PDOs to a sync manager (0x1C12 / 0x1C13): clear, assign, set count
+def pdo_assignment(assign_index, pdo_indices):
+    return ([SdoWrite(assign_index, 0, UNSIGNED8, 0)] +
+            [SdoWrite(assign_index, i + 1, UNSIGNED16, pdo_index) for i, pdo_index in enumerate(pdo_indices)] +
+            [SdoWrite(assign_index, 0, UNSIGNED8, len(pdo_indices))])
+
+
+# Configuration of all slaves with one product code
+# sdo_writes: list of SdoWrite, written in this order
+# dc_sync: None or (sync0_cycle_time[, sync0_shift_time[, sync1_cycle_time]]) in ns, activates SYNC0
+ConfigProfile = namedtuple('ConfigProfile', 'sdo_writes dc_sync')
+ConfigProfile.__new__.__defaults__ = ((), None)
+
+# Outcome per slave
+ProfileResult = namedtuple('ProfileResult', 'slave written errors elapsed')
+
+
+# Applies the profiles of all slaves in PREOP (before config_map).
+# The writes of one slave run back to back in one worker (one mailbox per slave), the slaves are
+# configured concurrently, the mailbox transfers release the GIL (release_gil=True).
+class ProfileEngine:
+
+    # Constructor
+    # profiles: {product code: ConfigProfile}
+    # max_workers: number of slaves configured concurrently (default: one worker per slave)
+    def __init__(self, profiles, max_workers=None):
+        self.profiles = profiles
+        self._max_workers = max_workers
+
+    # Writes of a profile grouped per object (consecutive writes to the same index)
+    @staticmethod
+    def _groups(sdo_writes):
+        groups = []
+        for write in sdo_writes:
+            if groups and groups[-1][0].index == write.index:
+                groups[-1].append(write)
+            else:
+                groups.append([write])
+        return groups
+
+    # Apply the profile of one slave, a failed write skips the remaining writes to the same object
+    def apply_slave(self, pos, slave):
+        start = time.monotonic()
+        profile = self.profiles.get(slave.id)
+        written = 0
+        errors = []
+        if profile is None:
+            return ProfileResult(pos, 0, errors, 0.0)
+        for group in self._groups(profile.sdo_writes):
+            for write in group:
+                try:
+                    slave.sdo_write(write.index, write.subindex, write.data, release_gil=True)
+                except _SDO_ERRORS as exc:
+                    errors.append((write, exc))
+                    break
+                written += 1
+        if profile.dc_sync is not None:
+            slave.dc_sync(1, *profile.dc_sync)
+        return ProfileResult(pos, written, errors, time.monotonic() - start)
+
+    # Apply the profiles of all slaves, returns a ProfileResult per slave with a profile
+    def apply(self, slaves):
+        slaves = [(pos, slave) for pos, slave in enumerate(slaves) if slave.id in self.profiles]
+        if not slaves:
+            return []
+        workers = min(self._max_workers or len(slaves), len(slaves))
+        if workers == 1:
+            results = [self.apply_slave(pos, slave) for pos, slave in slaves]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda item: self.apply_slave(*item), slaves))
+        return results
+
+    # Reapply the profile when SOEM reconfigures a slave, e.g. after recovery
+    def install(self, slaves):
+        for pos, slave in enumerate(slaves):
+            if slave.id in self.profiles:
+                slave.config_func = lambda slave_pos, slave=slave: self.apply_slave(slave_pos, slave)
+
+
+# Configuration time of 28 slaves: one slave after the other and concurrently
+if __name__ == '__main__':
+
+    import sys
+
+    from fake_master import FakeMaster
+    from od_index import BOOLEAN, INTEGER16
+
+    mailbox_time_s = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0005
+
+    # EL3144: filter and limits of all 4 channels (0x8000 + 0x10 * ch)
+    el3144_writes = []
+    for ch in range(4):
+        index = 0x8000 + 0x10 * ch
+        el3144_writes += [SdoWrite(index, 0x06, BOOLEAN, True), SdoWrite(index, 0x15, UNSIGNED16, 0),
+                          SdoWrite(index, 0x07, BOOLEAN, True), SdoWrite(index, 0x13, INTEGER16, 0x4000)]
+    profiles = {0x0C483052: ConfigProfile(el3144_writes),
+                0x0B383052: ConfigProfile(dc_sync=(10000000,))}
+    layout = [('EL3144', 0x0C483052, 16, 0), ('EL2872', 0x0B383052, 0, 2)] * 14
+
+    for label, engine in (('sequential', ProfileEngine(profiles, max_workers=1)),
+                          ('concurrent', ProfileEngine(profiles))):
+        master = FakeMaster(layout, mailbox_time_s=mailbox_time_s)
+        master.config_init()
+        start = time.perf_counter()
+        results = engine.apply(master.slaves)
+        elapsed = time.perf_counter() - start
+        print('{:10}: {:7.1f} ms ({} written, {} errors)'.format(label, elapsed * 1000, sum(r.written for r in results),
+                                                                sum(len(r.errors) for r in results)))
@@ -0,0 +1,190 @@
+"""Application stages run by the processdata thread every cycle, each within a declared time budget"""
+
+import time
+
+from collections import namedtuple
+
+
+# Stage order within a cycle
+INPUT = 0
+CONTROL = 1
+OUTPUT = 2
+
+# Statistics of one stage (times in us)
+StageStats = namedtuple('StageStats', 'name phase budget_us every runs overruns demotions deferred errors disabled last_us max_us')
+
+
+# One registered stage
+class Stage:
+
+    __slots__ = ('name', 'func', 'phase', 'budget_ns', 'every', 'min_every', 'slot', 'runs', 'overruns', 'demotions',
+                 'deferred', 'errors', 'disabled', 'last_ns', 'max_ns', '_over', '_within')
+
+    # Constructor
+    def __init__(self, name, func, phase, budget_ns, every, slot):
+        self.name = name
+        self.func = func
+        self.phase = phase
+        self.budget_ns = budget_ns
+        self.every = every
+        self.min_every = every
+        self.slot = slot
+        self.runs = 0
+        self.overruns = 0
+        self.demotions = 0
+        self.deferred = 0
+        self.errors = 0
+        self.disabled = False
+        self.last_ns = 0
+        self.max_ns = 0
+        self._over = 0
+        self._within = 0
+
+
+# Ordered stages called by the processdata thread between receive_processdata and the next send,
+# so all stages of a cycle see the inputs of the same frame and their outputs go out with the next one:
+#   INPUT stages (e.g. decode the input image) -> CONTROL stages (application) -> OUTPUT stages (commit outputs)
+# Every stage is called as func(cycle) and timed against its budget.
+# A CONTROL stage that exceeds its budget in overrun_limit consecutive runs is demoted: it then runs only
+# every 2, 4, .. max_every cycles (demoted stages are spread over the cycles). After promote_after runs
+# within half its budget it is promoted again, step by step. A CONTROL stage whose budget does not fit
+# before the deadline of the cycle is deferred to the next cycle. INPUT / OUTPUT stages always run.
+# A stage that raises an exception is disabled (logged, the other stages and the cycle continue).
+class CyclePipeline:
+
+    # Constructor
+    # overrun_limit: consecutive runs over budget until a stage is demoted
+    # max_every: longest interval [cycles] of a demoted stage
+    # promote_after: runs within half the budget until a demoted stage is promoted
+    # log: function for messages (default: print)
+    def __init__(self, overrun_limit=3, max_every=64, promote_after=100, log=print):
+        self.overrun_limit = overrun_limit
+        self.max_every = max_every
+        self.promote_after = promote_after
+        self._log = log
+        self.stages = []
+        self._slots = 0
+
+    # Register a stage, stages of the same phase run in the order they were added
+    # budget_us: time the stage may take per run, every: run every n cycles (lower limit for promotion)
+    def add_stage(self, name, func, budget_us, phase=CONTROL, every=1):
+        if phase not in (INPUT, CONTROL, OUTPUT):
+            raise ValueError('Unknown phase {}'.format(phase))
+        if any(stage.name == name for stage in self.stages):
+            raise ValueError('Stage {} already exists'.format(name))
+        stage = Stage(name, func, phase, int(budget_us * 1000), every, self._slots)
+        self._slots += 1
+        self.stages.append(stage)
+        self.stages.sort(key=lambda stage: stage.phase)
+        return stage
+
+    def remove_stage(self, name):
+        self.stages = [stage for stage in self.stages if stage.name != name]
+
+    # Called once per cycle by the processdata thread
+    # deadline_ns: end of the cycle (time.monotonic_ns, e.g. CycleTimer.next_deadline_ns), None: no deferral
+    def run(self, cycle, deadline_ns=None):
+        for stage in self.stages:
+            if stage.disabled:
+                continue
+            control = stage.phase == CONTROL
+            if control:
+                if stage.every > 1 and cycle % stage.every != stage.slot % stage.every:
+                    continue
+                if deadline_ns is not None and time.monotonic_ns() + stage.budget_ns > deadline_ns:
+                    stage.deferred += 1
+                    continue
+            start = time.perf_counter_ns()
+            try:
+                stage.func(cycle)
+            except Exception as exc:
+                stage.errors += 1
+                stage.disabled = True
+                self._log('ERROR : Stage {} failed ({!r}), disabled'.format(stage.name, exc))
+                continue
+            elapsed = time.perf_counter_ns() - start
+            stage.runs += 1
+            stage.last_ns = elapsed
+            if elapsed > stage.max_ns:
+                stage.max_ns = elapsed
+            if elapsed > stage.budget_ns:
+                stage.overruns += 1
+                stage._over += 1
+                stage._within = 0
+                if control and stage._over >= self.overrun_limit and stage.every < self.max_every:
+                    stage.every = min(2 * stage.every, self.max_every)
+                    stage.demotions += 1
+                    stage._over = 0
+                    self._log('WARNING : Stage {} over budget ({:.0f} us > {:.0f} us), now every {} cycles'.format(
+                        stage.name, elapsed / 1000, stage.budget_ns / 1000, stage.every))
+            else:
+                stage._over = 0
+                if 2 * elapsed <= stage.budget_ns:
+                    stage._within += 1
+                    if stage.every > stage.min_every and stage._within >= self.promote_after:
+                        stage.every = max(stage.every // 2, stage.min_every)
+                        stage._within = 0
+                        self._log('MESSAGE : Stage {} within budget again, now every {} cycles'.format(stage.name, stage.every))
+
+    def stats(self):
+        return [StageStats(stage.name, stage.phase, stage.budget_ns / 1000, stage.every, stage.runs, stage.overruns,
+                           stage.demotions, stage.deferred, stage.errors, stage.disabled, stage.last_ns / 1000,
+                           stage.max_ns / 1000)
+                for stage in self.stages]
+
+
+# A 1 ms cycle with a fast control stage and a slow one (2 ms of work against a 200 us budget): the slow
+# stage is demoted instead of pushing every cycle past its deadline (fake slaves, no NIC)
+if __name__ == '__main__':
+
+    import sys
+
+    import pysoem
+
+    from cycle_timer import CycleTimer
+    from fake_master import FakeMaster
+    from process_image import ProcessImage
+    from signal_map import compile_signal_map
+
+    n_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    def run(budgeted):
+        master = FakeMaster()
+        master.config_init()
+        master.config_map()
+        master.state = pysoem.OP_STATE
+        master.write_state()
+        image = ProcessImage(master.slaves)
+        signal_map = compile_signal_map(image, master.slaves)
+        el3144_ch1 = signal_map.input_index('EL3144.ch1.value')
+        el4008_outputs = image.output_view(1, 'h')
+        values = signal_map.values
+
+        def control(cycle):
+            el4008_outputs[0] = int(values[el3144_ch1]) // 2
+
+        def diagnostics(cycle):
+            end = time.perf_counter_ns() + 2000000
+            while time.perf_counter_ns() < end:
+                pass
+
+        pipeline = CyclePipeline(max_every=128 if budgeted else 1, log=lambda message: None)
+        pipeline.add_stage('inputs', lambda cycle: (image.refresh_changed(), signal_map.decode_inputs(True)), 100, INPUT)
+        pipeline.add_stage('control', control, 100)
+        pipeline.add_stage('diagnostics', diagnostics, 200)
+        pipeline.add_stage('outputs', lambda cycle: image.commit_changed(), 100, OUTPUT)
+        timer = CycleTimer(1000000)
+        timer.start()
+        for _ in range(n_cycles):
+            timer.wait_next()
+            master.send_processdata()
+            master.receive_processdata(10000)
+            pipeline.run(timer.cycles, timer.next_deadline_ns if budgeted else None)
+            timer.cycle_done()
+        return timer.stats(), pipeline.stats()
+
+    for label, budgeted in (('no budget', False), ('budgeted', True)):
+        timer_stats, stage_stats = run(budgeted)
+        print('{:9}: overruns {}, missed cycles {}, {}'.format(label, timer_stats['overruns'], timer_stats['missed_cycles'],
+                                                             ', '.join('{} every {} ({} runs)'.format(s.name, s.every, s.runs)
+                                                                       for s in stage_stats)))
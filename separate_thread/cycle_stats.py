@@ -0,0 +1,225 @@
+"""Cycle time, jitter and WKC instrumentation with Prometheus text export"""
+
+import threading
+import time
+
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Log-linear histogram of non-negative integer values (HDR style): 16 buckets per power of two,
+# i.e. about 6 % resolution from 1 ns to ~18 min. Buckets are preallocated, record() is O(1).
+class Histogram:
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    MAX_SHIFT = 36
+
+    # Constructor
+    def __init__(self):
+        self._counts = array('q', bytes(8 * (self.MAX_SHIFT + 2) * self.SUB_BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            index = value
+        else:
+            if shift > self.MAX_SHIFT:
+                shift = self.MAX_SHIFT
+                value = (2 * self.SUB_BUCKETS - 1) << shift
+            index = shift * self.SUB_BUCKETS + (value >> shift)
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Lowest value that falls into bucket index
+    @classmethod
+    def _lower_bound(cls, index):
+        shift = max(0, index // cls.SUB_BUCKETS - 1)
+        return (index - shift * cls.SUB_BUCKETS) << shift
+
+    # Value below which the given fraction of the recorded values lies (bucket resolution)
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return self._lower_bound(index)
+        return self.max
+
+    # Number of values < bound (bound must be a power of two)
+    def count_below(self, bound):
+        index = 0
+        if bound > 1:
+            shift = max(0, bound.bit_length() - self.SUB_BUCKET_BITS - 1)
+            index = shift * self.SUB_BUCKETS + (bound >> shift)
+        return sum(self._counts[:index])
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+# Instrumentation of the processdata / check threads.
+# Only integer additions and histogram increments happen in the cycle thread,
+# the text export is computed on demand (snapshot thread or HTTP request).
+class CycleStats:
+
+    # Histogram buckets exported to Prometheus: 1 us .. ~1 s (powers of two, in ns)
+    EXPORT_BOUNDS = [1 << k for k in range(10, 31)]
+
+    # Constructor
+    # cycle_timer: optional CycleTimer whose overrun counters are exported as well
+    # interval_s: length of the interval for the WKC mismatch rate
+    # dc_controller: optional DcController whose phase offset / drift are exported as well
+    def __init__(self, cycle_timer=None, interval_s=1.0, dc_controller=None):
+        self.cycle_timer = cycle_timer
+        self.dc_controller = dc_controller
+        self.period = Histogram()
+        self.latency = Histogram()
+        self.jitter = Histogram()
+        self.recovery = Histogram()
+        self.cycles = 0
+        self.wkc_mismatches = 0
+        self.recoveries = 0
+        self._interval_ns = int(interval_s * 1e9)
+        self._interval_start = 0
+        self._interval_mismatches = 0
+        self.last_interval_mismatches = 0
+        self._last_send = 0
+
+    # Called by the processdata thread once per cycle
+    # send_ns: monotonic time of send_processdata(), latency_ns: send -> receive, jitter_ns: wake-up lateness
+    def record_cycle(self, send_ns, latency_ns, jitter_ns, wkc_ok):
+        if self._last_send:
+            self.period.record(send_ns - self._last_send)
+        else:
+            self._interval_start = send_ns
+        self._last_send = send_ns
+        self.latency.record(latency_ns)
+        self.jitter.record(jitter_ns)
+        self.cycles += 1
+        if not wkc_ok:
+            self.wkc_mismatches += 1
+            self._interval_mismatches += 1
+        if send_ns - self._interval_start >= self._interval_ns:
+            self.last_interval_mismatches = self._interval_mismatches
+            self._interval_mismatches = 0
+            self._interval_start = send_ns
+
+    # Called by the slave supervisor with the duration of one recovery episode
+    def record_recovery(self, duration_ns):
+        self.recovery.record(duration_ns)
+        self.recoveries += 1
+
+    # Short summary (values in us)
+    def snapshot(self):
+        summary = {'cycles': self.cycles,
+                   'wkc_mismatches': self.wkc_mismatches,
+                   'wkc_mismatches_last_interval': self.last_interval_mismatches,
+                   'recoveries': self.recoveries}
+        if self.cycle_timer is not None:
+            summary['overruns'] = self.cycle_timer.overruns
+            summary['missed_cycles'] = self.cycle_timer.missed_cycles
+        if self.dc_controller is not None:
+            summary.update(self.dc_controller.stats())
+        for name, histogram in (('period', self.period), ('latency', self.latency),
+                                ('jitter', self.jitter), ('recovery', self.recovery)):
+            summary[name + '_mean_us'] = round(histogram.mean() / 1000, 3)
+            for label, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+                summary['{}_{}_us'.format(name, label)] = histogram.percentile(fraction) / 1000
+            summary[name + '_max_us'] = histogram.max / 1000
+        return summary
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix='ethercat'):
+        lines = []
+
+        def metric(name, kind, value, help_text):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+
+        metric('cycles_total', 'counter', self.cycles, 'Process data cycles')
+        metric('wkc_mismatch_total', 'counter', self.wkc_mismatches, 'Cycles with unexpected working counter')
+        metric('wkc_mismatch_last_interval', 'gauge', self.last_interval_mismatches,
+               'Cycles with unexpected working counter in the last interval')
+        metric('recoveries_total', 'counter', self.recoveries, 'Slave recovery episodes of the supervisor')
+        if self.cycle_timer is not None:
+            metric('overruns_total', 'counter', self.cycle_timer.overruns, 'Cycles that ran past their deadline')
+            metric('missed_cycles_total', 'counter', self.cycle_timer.missed_cycles, 'Skipped cycle deadlines')
+        histograms = [('cycle_period_seconds', self.period, 'Time between two sends'),
+                      ('latency_seconds', self.latency, 'send_processdata to receive_processdata'),
+                      ('jitter_seconds', self.jitter, 'Wake-up lateness of the cycle thread'),
+                      ('recovery_seconds', self.recovery, 'Time spent in slave recovery')]
+        if self.dc_controller is not None:
+            dc = self.dc_controller
+            metric('dc_locked', 'gauge', int(dc.locked), 'Cycle locked to the SYNC0 period of the distributed clocks')
+            metric('dc_lock_losses_total', 'counter', dc.lock_losses, 'Times the cycle lost the SYNC0 lock')
+            metric('dc_offset_seconds', 'gauge', dc.last_offset_ns / 1e9, 'Phase of the last frame relative to its target')
+            metric('dc_drift_ppm', 'gauge', dc.drift_ppm, 'Drift of the DC reference clock against the host clock')
+            histograms.append(('dc_phase_error_seconds', dc.offset, 'Absolute phase error of the frames in the SYNC0 period'))
+
+        for name, histogram, help_text in histograms:
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            for bound in self.EXPORT_BOUNDS:
+                lines.append('{}_{}_bucket{{le="{:g}"}} {}'.format(prefix, name, bound / 1e9, histogram.count_below(bound)))
+            lines.append('{}_{}_bucket{{le="+Inf"}} {}'.format(prefix, name, histogram.count))
+            lines.append('{}_{}_sum {}'.format(prefix, name, histogram.total / 1e9))
+            lines.append('{}_{}_count {}'.format(prefix, name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    # Serve the Prometheus text on http://host:port/metrics (daemon thread), returns the server
+    def serve(self, port, host=''):
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = stats.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Overhead of record_cycle() (no NIC required)
+if __name__ == '__main__':
+
+    n_cycles = 200000
+    stats = CycleStats()
+    start = time.perf_counter_ns()
+    now = time.monotonic_ns()
+    for i in range(n_cycles):
+        stats.record_cycle(now + i * 1000000, 20000 + (i & 0xFF), i & 0x3FF, i % 1000 != 0)
+    elapsed = time.perf_counter_ns() - start
+    print('record_cycle(): {:.2f} us'.format(elapsed / n_cycles / 1000))
+    print(stats.snapshot())
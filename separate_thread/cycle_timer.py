@@ -0,0 +1,178 @@
+"""Deadline driven cycle timer for the processdata thread"""
+
+import os
+import time
+
+from array import array
+
+
+# Fixed size ring buffer for int64 samples (no allocations after construction)
+class RingBuffer:
+
+    # Constructor
+    def __init__(self, size):
+        self._data = array('q', bytes(8 * size))
+        self._size = size
+        self._pos = 0
+        self.count = 0
+
+    # Append one sample, overwriting the oldest one if the buffer is full
+    def append(self, value):
+        self._data[self._pos] = value
+        self._pos += 1
+        if self._pos == self._size:
+            self._pos = 0
+        self.count += 1
+
+    # Return the stored samples (oldest first) as a list
+    def values(self):
+        if self.count < self._size:
+            return self._data[:self._pos].tolist()
+        return self._data[self._pos:].tolist() + self._data[:self._pos].tolist()
+
+    def __len__(self):
+        return min(self.count, self._size)
+
+
+# Sleeps to absolute CLOCK_MONOTONIC deadlines instead of a relative time.sleep(),
+# so the cycle period does not stretch by the time spent in send/receive.
+# Usage per cycle:
+#   timer.start()
+#   while ...:
+#       timer.wait_next()
+#       master.send_processdata()
+#       master.receive_processdata(...)
+#       timer.cycle_done()
+class CycleTimer:
+
+    # Default: spin the last 200 us before the deadline (sleep() wakes up too late on most kernels)
+    DEFAULT_SPIN_NS = 200000
+    DEFAULT_HISTORY = 4096
+
+    # Constructor
+    # period_ns: cycle period in nanoseconds (e.g. 1000000 for 1 ms, 500000 for 500 us)
+    # spin_ns: busy wait this long before each deadline (0 disables spinning)
+    # history: number of cycles kept in the jitter / latency ring buffers
+    def __init__(self, period_ns, spin_ns=DEFAULT_SPIN_NS, history=DEFAULT_HISTORY):
+        if period_ns <= 0:
+            raise ValueError('period_ns must be positive')
+        self.period_ns = int(period_ns)
+        self.spin_ns = min(int(spin_ns), self.period_ns)
+        # Wake-up lateness relative to the deadline [ns]
+        self.jitter = RingBuffer(history)
+        # Time from wake-up to cycle_done() [ns]
+        self.latency = RingBuffer(history)
+        self.cycles = 0
+        self.overruns = 0
+        self.missed_cycles = 0
+        self._deadline = 0
+        self._wakeup = 0
+
+    # Try to pin the calling thread to one CPU and run it with SCHED_FIFO priority.
+    # Returns a tuple (pinned, realtime) - both are False if the OS or the permissions do not allow it.
+    @staticmethod
+    def setup_realtime(cpu=None, priority=None):
+        pinned = False
+        realtime = False
+        if cpu is not None and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, {cpu})
+                pinned = True
+            except OSError:
+                pass
+        if priority is not None and hasattr(os, 'sched_setscheduler'):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+                realtime = True
+            except OSError:
+                pass
+        return pinned, realtime
+
+    # Set the first deadline one period from now
+    def start(self):
+        self._deadline = time.monotonic_ns() + self.period_ns
+        self._wakeup = 0
+
+    # Block until the next deadline, returns the wake-up lateness in ns.
+    # If the previous cycle ran past the deadline it counts as overrun and the
+    # missed deadlines are skipped (no burst of catch-up cycles).
+    def wait_next(self):
+        deadline = self._deadline
+        now = time.monotonic_ns()
+        if now > deadline:
+            self.overruns += 1
+            missed = (now - deadline) // self.period_ns
+            self.missed_cycles += missed
+            deadline += missed * self.period_ns
+        else:
+            remaining = deadline - now - self.spin_ns
+            if remaining > 0:
+                time.sleep(remaining / 1e9)
+            while time.monotonic_ns() < deadline:
+                pass
+        self._wakeup = time.monotonic_ns()
+        lateness = self._wakeup - deadline
+        self.jitter.append(lateness)
+        self._deadline = deadline + self.period_ns
+        self.cycles += 1
+        return lateness
+
+    # Next deadline (time.monotonic_ns), i.e. the end of the current cycle
+    @property
+    def next_deadline_ns(self):
+        return self._deadline
+
+    # Shift the next deadline by offset_ns (e.g. the correction of a DcController, > 0: later)
+    def adjust(self, offset_ns):
+        self._deadline += offset_ns
+
+    # Mark the end of the work done in this cycle (records the cycle latency)
+    def cycle_done(self):
+        if self._wakeup:
+            self.latency.append(time.monotonic_ns() - self._wakeup)
+
+    # Summary of the recorded history (values in us)
+    def stats(self):
+        jitter = sorted(self.jitter.values())
+        latency = sorted(self.latency.values())
+        return {'cycles': self.cycles,
+                'overruns': self.overruns,
+                'missed_cycles': self.missed_cycles,
+                'jitter_max_us': jitter[-1] / 1000 if jitter else 0.0,
+                'jitter_p99_us': _percentile(jitter, 0.99) / 1000,
+                'latency_mean_us': sum(latency) / len(latency) / 1000 if latency else 0.0,
+                'latency_max_us': latency[-1] / 1000 if latency else 0.0}
+
+
+# Percentile of an already sorted list
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+# Benchmark of the timing logic against the fake master (no EtherCAT NIC required)
+if __name__ == '__main__':
+
+    import sys
+
+    from fake_master import FakeMaster
+
+    period_us = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    master = FakeMaster(exchange_time_ns=50000)
+    master.config_init()
+    master.config_map()
+
+    timer = CycleTimer(period_us * 1000)
+    print('Realtime setup (pinned, SCHED_FIFO): {}'.format(CycleTimer.setup_realtime(0, 50)))
+    timer.start()
+    for _ in range(n_cycles):
+        timer.wait_next()
+        master.send_processdata()
+        master.receive_processdata(10000)
+        timer.cycle_done()
+
+    for key, value in timer.stats().items():
+        print('{}: {}'.format(key, value))
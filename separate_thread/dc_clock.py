@@ -0,0 +1,189 @@
+"""Locks the cycle of the processdata thread to the SYNC0 period of the distributed clocks"""
+
+from cycle_stats import Histogram
+
+
+# PI controller on the phase of the process data frame within the SYNC0 period.
+# The reference clock (master.dc_time, latched by the frame of every cycle) tells where in the
+# SYNC0 period the frame passed the slaves. The controller shifts the next deadline of the
+# CycleTimer so that the frame always passes at the same phase, well away from the SYNC0 edge,
+# and compensates the drift between the host clock and the reference clock with its integral part.
+# Usage per cycle (after receive_processdata):
+#   timer.adjust(controller.update(master.dc_time, lateness_ns) if wkc > 0 else controller.hold())
+# A lost frame (wkc <= 0) leaves master.dc_time at the sample of an earlier cycle: hold() keeps the
+# drift compensation without feeding that stale sample to the controller.
+# lateness_ns (the return value of CycleTimer.wait_next()) is taken out of the phase error: a late
+# wake-up moves the frame of this cycle only, the controller steers the phase of the deadlines.
+class DcController:
+
+    # Consecutive cycles within lock_window_ns until the controller reports locked
+    LOCK_CYCLES = 100
+
+    # Constructor
+    # period_ns: SYNC0 cycle time (= period of the CycleTimer)
+    # shift_ns: SYNC0 shift time of the slaves (sync0_shift_time of dc_sync)
+    # phase_ns: target position of the frame in the SYNC0 period (default: half a period, the most margin to both edges)
+    # kp / ki: proportional / integral gain per cycle
+    # max_step_ns: largest deadline correction per cycle once locked (default: 1/10 of the period)
+    # lock_window_ns: phase error considered locked (default: 1/20 of the period)
+    def __init__(self, period_ns, shift_ns=0, phase_ns=None, kp=0.1, ki=0.005, max_step_ns=None, lock_window_ns=None):
+        if period_ns <= 0:
+            raise ValueError('period_ns must be positive')
+        self.period_ns = int(period_ns)
+        self.shift_ns = int(shift_ns)
+        self.phase_ns = int(phase_ns) if phase_ns is not None else self.period_ns // 2
+        self.kp = kp
+        self.ki = ki
+        self.max_step_ns = int(max_step_ns) if max_step_ns is not None else self.period_ns // 10
+        self.lock_window_ns = int(lock_window_ns) if lock_window_ns is not None else self.period_ns // 20
+        # Absolute phase error [ns] of every cycle
+        self.offset = Histogram()
+        self.reset()
+
+    def reset(self):
+        self._integral = 0
+        self._started = False
+        self._in_window = 0
+        self.offset.reset()
+        self.last_offset_ns = 0
+        self.last_correction_ns = 0
+        self.locked = False
+        self.lock_losses = 0
+        self.held = 0
+
+    # Phase error of a reference clock sample: > 0 if the frame passed later than the target phase
+    def phase_error(self, dc_time):
+        error = (dc_time - self.shift_ns - self.phase_ns) % self.period_ns
+        if error >= self.period_ns // 2:
+            error -= self.period_ns
+        return error
+
+    # Called once per cycle with master.dc_time, returns the correction of the next deadline [ns]
+    def update(self, dc_time, lateness_ns=0):
+        frame_error = self.phase_error(dc_time)
+        self.last_offset_ns = frame_error
+        self.offset.record(abs(frame_error))
+        error = self.phase_error(dc_time - lateness_ns)
+        if not self._started:
+            # First sample: jump to the target phase, the PI part takes over from there
+            self._started = True
+            self.last_correction_ns = -error
+            return -error
+        if abs(error) <= self.lock_window_ns:
+            self._in_window += 1
+            if self._in_window >= self.LOCK_CYCLES:
+                self.locked = True
+        else:
+            self._in_window = 0
+            if self.locked:
+                self.locked = False
+                self.lock_losses += 1
+        self._integral += error
+        correction = -int(self.kp * error + self.ki * self._integral)
+        correction = max(-self.max_step_ns, min(self.max_step_ns, correction))
+        self.last_correction_ns = correction
+        return correction
+
+    # Called instead of update() in a cycle without a reference clock sample (lost frame), returns the
+    # correction of the next deadline [ns]: the integral part only (drift), the phase is left as it is
+    def hold(self):
+        self.held += 1
+        if not self._started:
+            return 0
+        correction = -int(self.ki * self._integral)
+        correction = max(-self.max_step_ns, min(self.max_step_ns, correction))
+        self.last_correction_ns = correction
+        return correction
+
+    # Drift of the reference clock against the host clock (> 0: reference clock is faster), taken
+    # from the integral part, which settles at the correction needed every cycle
+    @property
+    def drift_ppm(self):
+        return self.ki * self._integral / self.period_ns * 1e6
+
+    # Summary (values in us)
+    def stats(self):
+        return {'dc_locked': self.locked,
+                'dc_lock_losses': self.lock_losses,
+                'dc_held': self.held,
+                'dc_offset_us': self.last_offset_ns / 1000,
+                'dc_offset_p99_us': self.offset.percentile(0.99) / 1000,
+                'dc_offset_max_us': self.offset.max / 1000,
+                'dc_drift_ppm': round(self.drift_ppm, 3)}
+
+
+# SYNC0 errors of a free running and a DC locked cycle against a drifting reference clock (no NIC required)
+# dc_clock [period_us [drift_ppm [cycles [live]]]]
+# Default: simulated host clock with random wake-up lateness (reproducible, independent of the scheduler
+# of the machine). live: real CycleTimer against the fake master (needs an idle core for meaningful results).
+if __name__ == '__main__':
+
+    import random
+    import sys
+
+    import pysoem
+
+    from cycle_timer import CycleTimer
+    from fake_master import FakeMaster
+
+    period_us = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    drift_ppm = float(sys.argv[2]) if len(sys.argv) > 2 else 100.0
+    n_cycles = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    live = len(sys.argv) > 4 and sys.argv[4] == 'live'
+    period_ns = period_us * 1000
+
+    # Same rule as FakeMaster._check_sync0
+    def count_sync_errors(dc_times):
+        errors = 0
+        last_interval = None
+        for dc_time in dc_times:
+            interval, phase = divmod(dc_time, period_ns)
+            if last_interval is not None and (interval != last_interval + 1 or
+                                              phase > period_ns - FakeMaster.SYNC0_MARGIN_NS):
+                errors += 1
+            last_interval = interval
+        return errors
+
+    def simulate(controller):
+        rng = random.Random(1)
+        rate = 1.0 + drift_ppm * 1e-6
+        deadline = rng.randrange(period_ns)
+        dc_times = []
+        for _ in range(n_cycles):
+            # Wake-up lateness: mostly a few us, sometimes a few hundred
+            lateness_ns = int(rng.expovariate(1 / 5000)) + (int(rng.expovariate(1 / 100000)) if rng.random() < 0.01 else 0)
+            dc_time = int((deadline + lateness_ns + 30000) * rate)
+            dc_times.append(dc_time)
+            deadline += period_ns
+            if controller is not None:
+                deadline += controller.update(dc_time, lateness_ns)
+        return count_sync_errors(dc_times)
+
+    def run_live(controller):
+        master = FakeMaster(dc_drift_ppm=drift_ppm, seed=1)
+        master.config_init()
+        master.config_dc()
+        for slave in master.slaves:
+            if len(slave.output) > 0:
+                slave.dc_sync(1, period_ns)
+        master.config_map()
+        master.state = pysoem.OP_STATE
+        master.write_state()
+        timer = CycleTimer(period_ns)
+        timer.start()
+        for _ in range(n_cycles):
+            lateness_ns = timer.wait_next()
+            master.send_processdata()
+            wkc = master.receive_processdata(10000)
+            if controller is not None:
+                timer.adjust(controller.update(master.dc_time, lateness_ns) if wkc > 0 else controller.hold())
+            timer.cycle_done()
+        return master.sync_errors
+
+    print('{} cycles of {} us, reference clock drift {} ppm ({})'.format(
+        n_cycles, period_us, drift_ppm, 'live' if live else 'simulated host clock'))
+    for label, controller in (('free running', None), ('DC locked', DcController(period_ns))):
+        errors = run_live(controller) if live else simulate(controller)
+        print('{:12}: {} SYNC0 errors'.format(label, errors))
+        if controller is not None:
+            print('{:12}  {}'.format('', controller.stats()))
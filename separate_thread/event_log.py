@@ -0,0 +1,300 @@
+"""Non-blocking event log: cycle and supervisor threads queue records, a background thread writes them"""
+
+import threading
+import time
+
+from collections import deque
+
+import pysoem
+
+
+# Event kinds
+MESSAGE = 0
+WKC_MISMATCH = 1
+STATE_CHANGE = 2
+AL_STATUS = 3
+RECOVERY = 4
+
+# Levels (prefix of the written line, as used by the print() messages so far)
+ERROR = 'ERROR'
+WARNING = 'WARNING'
+INFO = 'MESSAGE'
+
+STATE_NAMES = {pysoem.NONE_STATE: 'NONE', pysoem.INIT_STATE: 'INIT', pysoem.PREOP_STATE: 'PREOP',
+               pysoem.BOOT_STATE: 'BOOT', pysoem.SAFEOP_STATE: 'SAFEOP', pysoem.OP_STATE: 'OP'}
+
+
+def state_name(state):
+    name = STATE_NAMES.get(state & 0x0F, '{:#04x}'.format(state & 0x0F))
+    return name + ' + ERROR' if state & pysoem.STATE_ERROR else name
+
+
+# One queued event, preallocated (the fields are overwritten for every event)
+class _EventRecord:
+
+    __slots__ = ('kind', 'level', 'timestamp_ns', 'slave', 'a', 'b', 'text')
+
+    # Constructor
+    def __init__(self):
+        self.kind = MESSAGE
+        self.level = INFO
+        self.timestamp_ns = 0
+        self.slave = -1
+        self.a = 0
+        self.b = 0
+        self.text = None
+
+
+# Event log for the threads that must not block on console / file output:
+#   events = EventLog()
+#   events.start()
+#   events.wkc_mismatch(wkc, master.expected_wkc)     # in the cycle: a few attribute writes, no I/O
+#   supervisor = SlaveSupervisor(master, log=events.message)
+# - The records are allocated once. Posting takes a free record, fills it and appends it to the queue
+#   (deque pop / append are atomic, no lock, no wakeup of the writer): bounded cost, no allocation.
+#   With all records in use the event is dropped and counted.
+# - The writer thread drains the queue every interval_s and formats the records
+#   (state names, AL status text via al_status_code_to_string) outside the posting thread.
+# - Repeats of the same event within dedupe_s are counted instead of written ("repeated n times").
+# - Written lines are rate limited (rate_per_s, bursts up to burst lines), the rest is counted and
+#   reported as suppressed.
+class EventLog:
+
+    # Constructor
+    # capacity: preallocated records (events queued and not yet written)
+    # write: function for the formatted lines (default: print)
+    # interval_s: time between two drains of the queue
+    # dedupe_s: window in which repeats of an event are only counted
+    # rate_per_s / burst: lines written per second / at once
+    def __init__(self, capacity=1024, write=print, interval_s=0.05, dedupe_s=1.0, rate_per_s=50, burst=100):
+        self.capacity = capacity
+        self._write = write
+        self.interval_s = interval_s
+        self._dedupe_ns = int(dedupe_s * 1e9)
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self._free = deque(_EventRecord() for _ in range(capacity))
+        self._queue = deque()
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Writer state (writer thread only)
+        self._tokens = float(burst)
+        self._refill_ns = 0
+        self._last_key = None
+        self._last_ns = 0
+        self._repeats = 0
+        self._suppressed_pending = 0
+        # Statistics
+        self.events = 0
+        self.written = 0
+        self.deduped = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._writer_thread, name='ethercat-events', daemon=True)
+        self._thread.start()
+
+    # Stop the writer after writing all queued events
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    # Queued events
+    def __len__(self):
+        return len(self._queue)
+
+    # Queue one event (callable from any thread)
+    def post(self, kind, level, slave=-1, a=0, b=0, text=None):
+        try:
+            record = self._free.pop()
+        except IndexError:
+            self.dropped += 1
+            return
+        record.kind = kind
+        record.level = level
+        record.timestamp_ns = time.monotonic_ns()
+        record.slave = slave
+        record.a = a
+        record.b = b
+        record.text = text
+        self._queue.append(record)
+
+    # Preformatted message, e.g. 'WARNING : ...' (drop-in for the log= parameters)
+    def message(self, text):
+        self.post(MESSAGE, INFO, text=text)
+
+    # WKC of a cycle differs from the expected WKC
+    def wkc_mismatch(self, wkc, expected_wkc):
+        self.post(WKC_MISMATCH, WARNING, -1, wkc, expected_wkc)
+
+    # Slave pos changed from state old to state new
+    def state_change(self, pos, old, new):
+        self.post(STATE_CHANGE, INFO if new == pysoem.OP_STATE else WARNING, pos, old, new)
+
+    # Slave pos reports AL status code al_status in state
+    def al_status(self, pos, state, al_status):
+        self.post(AL_STATUS, ERROR, pos, state, al_status)
+
+    # Recovery action (e.g. 'ack', 'reconfig', 'recover') on slave pos, ok: the action succeeded
+    def recovery(self, pos, action, ok):
+        self.post(RECOVERY, INFO if ok else WARNING, pos, 1 if ok else 0, 0, action)
+
+    @staticmethod
+    def format(record):
+        kind = record.kind
+        if kind == MESSAGE:
+            return record.text
+        if kind == WKC_MISMATCH:
+            text = 'Incorrect WKC ({} instead of {})'.format(record.a, record.b)
+        elif kind == STATE_CHANGE:
+            text = 'Slave {} changed from {} to {}'.format(record.slave, state_name(record.a), state_name(record.b))
+        elif kind == AL_STATUS:
+            text = 'Slave {} in {}, AL status {:#06x} ({})'.format(record.slave, state_name(record.a), record.b,
+                                                                  pysoem.al_status_code_to_string(record.b))
+        elif kind == RECOVERY:
+            text = 'Slave {} {} {}'.format(record.slave, record.text, 'done' if record.a else 'failed')
+        else:
+            text = 'Event {} (slave {}, {}, {})'.format(kind, record.slave, record.a, record.b)
+        return '{} : {}'.format(record.level, text)
+
+    def _writer_thread(self):
+        while not self._stop_event.wait(self.interval_s):
+            self.flush()
+
+    # Write all queued events (writer thread, or after stop)
+    def flush(self):
+        queue = self._queue
+        free = self._free
+        while True:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                break
+            key = (record.kind, record.slave, record.a, record.b, record.text)
+            timestamp_ns = record.timestamp_ns
+            line = None
+            if key == self._last_key and timestamp_ns - self._last_ns < self._dedupe_ns:
+                self._repeats += 1
+                self.deduped += 1
+            else:
+                self._end_repeats()
+                self._last_key = key
+                self._last_ns = timestamp_ns
+                line = self.format(record)
+            self.events += 1
+            # The record is free again once its fields are read
+            free.append(record)
+            if line is not None:
+                self._emit(line)
+        if self._repeats and time.monotonic_ns() - self._last_ns >= self._dedupe_ns:
+            self._end_repeats()
+            self._last_key = None
+        if self._suppressed_pending and self._take_token():
+            self._output('WARNING : {} events suppressed (more than {} per second)'.format(self._suppressed_pending,
+                                                                                         self.rate_per_s))
+            self._suppressed_pending = 0
+        if self.dropped != self._dropped_reported and self._take_token():
+            self._output('WARNING : {} events dropped (event queue full)'.format(self.dropped - self._dropped_reported))
+            self._dropped_reported = self.dropped
+
+    def _end_repeats(self):
+        if self._repeats:
+            self._emit('MESSAGE : last event repeated {} times'.format(self._repeats))
+            self._repeats = 0
+
+    def _take_token(self):
+        now = time.monotonic_ns()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._refill_ns) * self.rate_per_s / 1e9)
+        self._refill_ns = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    def _emit(self, line):
+        if self._take_token():
+            self._output(line)
+        else:
+            self.suppressed += 1
+            self._suppressed_pending += 1
+
+    def _output(self, line):
+        self.written += 1
+        self._write(line)
+
+    def stats(self):
+        return {'log_events': self.events,
+                'log_written': self.written,
+                'log_deduped': self.deduped,
+                'log_suppressed': self.suppressed,
+                'log_dropped': self.dropped,
+                'log_queued': len(self._queue)}
+
+
+# Cost of an event on the cycle thread, and a 1 ms cycle with a WKC mismatch in every cycle written to a
+# slow console (1 ms per line): print() in the cycle vs. the event log (fake slaves, no NIC)
+if __name__ == '__main__':
+
+    import sys
+
+    from cycle_timer import CycleTimer
+    from fake_master import FakeMaster
+
+    n_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    console_time_s = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+
+    def console(line):
+        time.sleep(console_time_s)
+
+    # Posting only (the queue is drained between the batches, as the writer thread would)
+    events = EventLog(write=lambda line: None)
+    costs = []
+    for i in range(200):
+        for j in range(500):
+            start = time.perf_counter_ns()
+            events.wkc_mismatch(j & 7, 21)
+            costs.append(time.perf_counter_ns() - start)
+        events.flush()
+    costs.sort()
+    print('post: median {} ns, 99.9 % {} ns, max {} ns ({} events)'.format(
+        costs[len(costs) // 2], costs[int(len(costs) * 0.999)], costs[-1], events.events))
+
+    def run(use_event_log):
+        master = FakeMaster()
+        master.config_init()
+        master.config_map()
+        master.state = pysoem.OP_STATE
+        master.write_state()
+        master.inject_fault(1, pysoem.SAFEOP_STATE + pysoem.STATE_ERROR, 0x001B)
+        events = EventLog(write=console)
+        events.start()
+        timer = CycleTimer(1000000)
+        timer.start()
+        for _ in range(n_cycles):
+            timer.wait_next()
+            master.send_processdata()
+            wkc = master.receive_processdata(10000)
+            if wkc != master.expected_wkc:
+                if use_event_log:
+                    events.wkc_mismatch(wkc, master.expected_wkc)
+                else:
+                    console('Incorrect WKC')
+            timer.cycle_done()
+        events.stop()
+        return timer.stats(), events.stats()
+
+    print('{} cycles of 1 ms, console {} ms per line'.format(n_cycles, console_time_s * 1000))
+    for label, use_event_log in (('print', False), ('event log', True)):
+        timer_stats, log_stats = run(use_event_log)
+        print('{:9}: overruns {}, missed cycles {}, latency max {:.0f} us{}'.format(
+            label, timer_stats['overruns'], timer_stats['missed_cycles'], timer_stats['latency_max_us'],
+            ', {}'.format(log_stats) if use_event_log else ''))
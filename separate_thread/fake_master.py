@@ -0,0 +1,551 @@
+"""Simulated EtherCAT bus with the pysoem.Master surface to exercise the cyclic code without an EtherCAT NIC"""
+
+import os
+import random
+import struct
+import sys
+import time
+
+import pysoem
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+from recorded_od import parse_log
+
+
+# Same values as the pysoem / SOEM constants
+NONE_STATE = 0x00
+INIT_STATE = 0x01
+PREOP_STATE = 0x02
+BOOT_STATE = 0x03
+SAFEOP_STATE = 0x04
+OP_STATE = 0x08
+STATE_ACK = 0x10
+STATE_ERROR = 0x10
+
+BECKHOFF_VENDOR_ID = 0x0002
+
+# Terminal layout of the separate_thread example: name, product code, input bytes, output bytes
+DEFAULT_LAYOUT = [('EK1100', 0x044c2c52, 0, 0),
+                  ('EL4008', 0x0FA83052, 0, 16),
+                  ('EL4114', 0x10123052, 0, 8),
+                  ('EL3144', 0x0C483052, 16, 0),
+                  ('EL2624', 0x0A403052, 0, 1),
+                  ('EL2872', 0x0B383052, 0, 2),
+                  ('EL1872', 0x07503052, 2, 0)]
+
+
+# PDO entries as (index, subindex, bit length) per product code
+def _el3144_standard_channel(ch):
+    index = 0x6000 + 0x10 * ch
+    return [(index, 0x01, 1), (index, 0x02, 1), (index, 0x03, 2), (index, 0x05, 2), (index, 0x07, 1),
+            (0x0000, 0x00, 1), (0x0000, 0x00, 5), (index, 0x0E, 1), (index, 0x0F, 1), (index, 0x10, 1),
+            (index, 0x11, 16)]
+
+
+PDO_MAPPING = {
+    # EL4008: RxPDO 0x1600..0x1607, one analog output per channel
+    0x0FA83052: {0x1C12: [(0x1600 + ch, [(0x7000 + 0x10 * ch, 0x01, 16)]) for ch in range(8)],
+                 0x1C13: []},
+    # EL4114: RxPDO 0x1600..0x1603
+    0x10123052: {0x1C12: [(0x1600 + ch, [(0x7000 + 0x10 * ch, 0x01, 16)]) for ch in range(4)],
+                 0x1C13: []},
+    # EL3144: TxPDO 0x1A00, 0x1A02, 0x1A04, 0x1A06 (standard mapping, status word + value)
+    0x0C483052: {0x1C12: [],
+                 0x1C13: [(0x1A00 + 2 * ch, _el3144_standard_channel(ch)) for ch in range(4)]},
+}
+
+# EL3144: a new sample every cycle, i.e. the TxPDO Toggle bit (bit 15 of each status word) flips
+def _el3144_model(data):
+    status_high_bytes = range(1, len(data), 4)
+
+    def update():
+        for offset in status_high_bytes:
+            data[offset] ^= 0x80
+
+    return update
+
+
+# Functions input bytearray -> update function called every cycle, per product code
+INPUT_MODELS = {0x0C483052: _el3144_model}
+
+# Busy wait inside a single C call: like a pysoem call that does not release the GIL, no other Python
+# thread (e.g. the processdata thread) runs meanwhile
+_sum_per_s = None
+
+
+def _hold_gil(duration_s):
+    global _sum_per_s
+    if _sum_per_s is None:
+        start = time.perf_counter()
+        sum(range(1000000))
+        _sum_per_s = 1000000 / (time.perf_counter() - start)
+    sum(range(int(duration_s * _sum_per_s)))
+
+
+# Object dictionaries recorded with read_sdo_from_slaves.py (log.txt), parsed on first use
+_recorded_ods = None
+
+
+def recorded_od(name):
+    global _recorded_ods
+    if _recorded_ods is None:
+        try:
+            _recorded_ods = parse_log()
+        except OSError:
+            _recorded_ods = {}
+    return _recorded_ods.get(name)
+
+
+class FakeSlave:
+
+    # Constructor
+    # The object dictionary (slave.od) is the one recorded for a terminal of the same name
+    def __init__(self, master, name, product_code, input_size, output_size, man=BECKHOFF_VENDOR_ID, rev=0):
+        self._master = master
+        self.name = name
+        self.man = man
+        self.id = product_code
+        self.rev = rev
+        self._state = NONE_STATE
+        self.al_status = 0
+        # Scripted fault: number of recovery requests the slave ignores and the state it stays in meanwhile
+        self.stuck = 0
+        self._fault_state = NONE_STATE
+        # Hot plug: a terminal of another type is now at this position (recover() refuses it like SOEM)
+        self.replaced = False
+        # Dropout: the slave does not answer until this time (monotonic)
+        self._offline_until = 0.0
+        self.dc_sync_settings = None
+        # SYNC0 supervision: SYNC0 interval of the last frame and the sync error counter (0x10F1:03)
+        self._sync_interval = None
+        self._sync_error_counter = 0
+        self.is_lost = False
+        self.config_func = None
+        # Part of the IOmap owned by this slave - like pysoem, the getters return a copy
+        # and the output setter copies into the IOmap
+        self._input = bytearray(input_size)
+        self._output = bytearray(output_size)
+        # CoE object values {(index, subindex): bytes} (PDO mapping) and SDO info (None: no SDO info support)
+        self.sdo = {}
+        self.od_objects = recorded_od(name)
+        self._objects = {obj.index: obj for obj in self.od_objects or ()}
+        self.sdo_reads = 0
+        self._fill_pdo_mapping(product_code)
+
+    # Fill the PDO assignment / mapping objects of known terminals
+    def _fill_pdo_mapping(self, product_code):
+        for assign_index, pdos in PDO_MAPPING.get(product_code, {}).items():
+            self.sdo[(assign_index, 0)] = struct.pack('<B', len(pdos))
+            for i, (pdo_index, entries) in enumerate(pdos):
+                self.sdo[(assign_index, i + 1)] = struct.pack('<H', pdo_index)
+                self.sdo[(pdo_index, 0)] = struct.pack('<B', len(entries))
+                for j, (index, subindex, bit_length) in enumerate(entries):
+                    self.sdo[(pdo_index, j + 1)] = struct.pack('<I', (index << 16) | (subindex << 8) | bit_length)
+
+    # Size in bytes of an object entry of the recorded object dictionary (None: does not exist)
+    def _entry_size(self, index, subindex):
+        obj = self._objects.get(index)
+        if obj is None:
+            return None
+        if obj.entries:
+            if subindex >= len(obj.entries) or obj.entries[subindex].data_type == 0:
+                return None
+            return (obj.entries[subindex].bit_length + 7) // 8
+        return (obj.bit_length + 7) // 8 if subindex == 0 else None
+
+    # Like pysoem: one mailbox round trip for the list, plus one per object and per entry
+    @property
+    def od(self):
+        self._master._mailbox(1)
+        if self.od_objects is None:
+            raise pysoem.SdoInfoError('no SDO info for {}'.format(self.name))
+        for obj in self.od_objects:
+            self._master._mailbox(1 + len(obj.entries))
+        return list(self.od_objects)
+
+    # Values that were not recorded read as zeros of the entry's size
+    def sdo_read(self, index, subindex, size=0, ca=False, *, release_gil=None):
+        self._master._mailbox(1, release_gil)
+        self.sdo_reads += 1
+        if self.offline:
+            raise pysoem.WkcError()
+        value = self.sdo.get((index, subindex))
+        if value is None:
+            entry_size = self._entry_size(index, subindex)
+            if entry_size is None:
+                raise pysoem.SdoError(0, index, subindex, 0x06020000, 'The object does not exist in the object directory')
+            value = bytes(entry_size)
+        return value[:size] if size else value
+
+    def sdo_write(self, index, subindex, data, ca=False, *, release_gil=None):
+        self._master._mailbox(1, release_gil)
+        if self.offline:
+            raise pysoem.WkcError()
+        if (index, subindex) not in self.sdo and self._entry_size(index, subindex) is None:
+            raise pysoem.SdoError(0, index, subindex, 0x06020000, 'The object does not exist in the object directory')
+        self.sdo[(index, subindex)] = bytes(data)
+
+    @property
+    def offline(self):
+        return self._offline_until > 0.0 and time.monotonic() < self._offline_until
+
+    @property
+    def input(self):
+        return bytes(self._input)
+
+    # Simulate new input data from the terminal
+    def set_input(self, value):
+        self._input[:] = value
+
+    @property
+    def output(self):
+        return bytes(self._output)
+
+    @output.setter
+    def output(self, value):
+        if len(value) != len(self._output):
+            raise AttributeError('output must be {} bytes'.format(len(self._output)))
+        self._output[:] = value
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        self._master._wkc = None
+
+    # WKC contribution of the slave in its current state (outputs count twice, inputs once)
+    def wkc(self):
+        state = self._state & 0x0F
+        if state == OP_STATE:
+            return (2 if self._output else 0) + (1 if self._input else 0)
+        if state == SAFEOP_STATE:
+            return 1 if self._input else 0
+        return 0
+
+    # Ignore a recovery request if a scripted fault or a dropout is still active
+    def _refuse(self):
+        if self.offline:
+            self.state = NONE_STATE
+            return True
+        if self.stuck > 0:
+            self.stuck -= 1
+            self.state = self._fault_state
+            return True
+        return False
+
+    def state_check(self, expected_state, timeout=2000):
+        self._master._access(1, reads=1)
+        if self.offline:
+            self.state = NONE_STATE
+        return self.state
+
+    def write_state(self):
+        self._master._access(1, writes=1)
+        if self._refuse():
+            return 1
+        if self.state & STATE_ACK:
+            self.state &= ~STATE_ACK
+        return 1
+
+    # Like SOEM: reconfigure the slave (INIT -> PREOP -> config_func -> SAFEOP), returns the new state
+    def reconfig(self, timeout=500):
+        self._master._access(self._master.RECONFIG_ACCESSES, reads=1, writes=2)
+        if self._refuse():
+            return 0
+        if self.config_func is not None:
+            self.config_func(self._master.slaves.index(self))
+        self.state = SAFEOP_STATE
+        return self.state
+
+    def recover(self, timeout=500):
+        self._master._access(self._master.RECONFIG_ACCESSES, reads=2, writes=1)
+        if self._refuse():
+            return 0
+        if self.replaced:
+            # Vendor / product / revision at this position differ from the configured slave
+            self.state = NONE_STATE
+            return 0
+        self.state = INIT_STATE
+        return 1
+
+    # Configured address read of an ESC register, only the DL status (0x0110) is modelled:
+    # link / communication on port 1 if a slave is connected behind this one
+    def _fprd(self, address, size, timeout_us=2000):
+        self._master._access(1, reads=1)
+        if self.offline or self._state == NONE_STATE:
+            raise pysoem.WkcError()
+        value = 0
+        if address == 0x0110:
+            # Port 0: link + communication, port 1: link + communication or loop closed
+            value = 0x0210 | (0x0820 if self._master._behind(self) else 0x0400)
+        return value.to_bytes(2, 'little').ljust(size, b'\x00')[:size]
+
+    def dc_sync(self, act, sync0_cycle_time, sync0_shift_time=0, sync1_cycle_time=None):
+        self.dc_sync_settings = (act, sync0_cycle_time, sync0_shift_time, sync1_cycle_time)
+        self._sync_interval = None
+        if act and self not in self._master._sync0_slaves:
+            self._master._sync0_slaves.append(self)
+        elif not act and self in self._master._sync0_slaves:
+            self._master._sync0_slaves.remove(self)
+
+
+class FakeMaster:
+
+    # Bus accesses of a reconfig / recover (state requests and checks of the sequence INIT -> SAFEOP)
+    RECONFIG_ACCESSES = 5
+
+    # Outputs have to pass a slave with SYNC0 at least this long before the SYNC0 edge
+    SYNC0_MARGIN_NS = 20000
+    # Like the Beckhoff terminals: +3 per missed SYNC0, -1 per good cycle, SAFEOP + ERROR above the limit (0x10F1:02)
+    SYNC_ERROR_LIMIT = 4
+
+    # Constructor
+    # layout: list of (name, product code, input bytes, output bytes) in bus order
+    # exchange_time_ns: simulated duration of send_processdata + receive_processdata (busy wait)
+    # access_time_s: simulated round trip of one acyclic frame (state read / write, sleeps without the GIL)
+    # mailbox_time_s: simulated round trip of one mailbox transaction (SDO, SDO info), like pysoem SDO
+    #                 transfers hold the GIL unless release_gil / always_release_gil is set
+    # packet_loss: probability that the process data frame of a cycle is lost (receive returns -1)
+    # seed: seed of the packet loss and the reference clock start (None: random)
+    # dc_drift_ppm: drift of the DC reference clock against the host clock (> 0: reference clock is faster)
+    def __init__(self, layout=DEFAULT_LAYOUT, exchange_time_ns=0, access_time_s=0.0, mailbox_time_s=0.0,
+                 packet_loss=0.0, seed=None, dc_drift_ppm=0.0):
+        self._layout = layout
+        self.exchange_time_ns = exchange_time_ns
+        self.access_time_s = access_time_s
+        self.mailbox_time_s = mailbox_time_s
+        self.always_release_gil = False
+        self.packet_loss = packet_loss
+        self._random = random.Random(seed)
+        self.slaves = []
+        self.state = NONE_STATE
+        self.expected_wkc = 0
+        self.frames_sent = 0
+        self.frames_lost = 0
+        # Acyclic bus load: state reads / writes (frames) and mailbox transactions
+        self.bus_reads = 0
+        self.bus_writes = 0
+        self.mailbox_transactions = 0
+        # Input models updated every cycle: (slave, function)
+        self._models = []
+        # Force the next receive_processdata() to return this WKC (None: WKC of the current slave states)
+        self.next_wkc = None
+        self._wkc = None
+        # Distributed clocks: reference clock time latched by the last process data frame (after config_dc)
+        self.dc_time = 0
+        self._dc_rate = 1.0 + dc_drift_ppm * 1e-6
+        self._dc_start = None
+        self._dc_base = 0
+        self._sync0_slaves = []
+        self.sync_errors = 0
+        # Hot plugged slaves behind the configured chain, see plug()
+        self.unconfigured = []
+
+    def _access(self, n_frames, reads=0, writes=0):
+        self.bus_reads += reads
+        self.bus_writes += writes
+        if self.access_time_s:
+            time.sleep(n_frames * self.access_time_s)
+
+    def _mailbox(self, n_transactions, release_gil=None):
+        self.mailbox_transactions += n_transactions
+        if self.mailbox_time_s:
+            if release_gil or (release_gil is None and self.always_release_gil):
+                time.sleep(n_transactions * self.mailbox_time_s)
+            else:
+                _hold_gil(n_transactions * self.mailbox_time_s)
+
+    # Scripted fault: put slave pos into state (e.g. SAFEOP_STATE + STATE_ERROR, NONE_STATE = lost)
+    # stuck: number of recovery requests the slave ignores before it follows again
+    def inject_fault(self, pos, state, al_status=0, stuck=0):
+        slave = self.slaves[pos]
+        slave.state = state
+        slave.al_status = al_status
+        slave.stuck = stuck
+        slave._fault_state = state
+
+    # Slave pos (and all slaves behind it if downstream is set, e.g. a broken cable) stops answering
+    # for duration_s seconds. Afterwards the slaves are back in NONE state and have to be recovered.
+    def dropout(self, pos, duration_s, downstream=False):
+        until = time.monotonic() + duration_s
+        for slave in self.slaves[pos:] if downstream else [self.slaves[pos]]:
+            slave._offline_until = until
+            slave.state = NONE_STATE
+
+    # Hot plug: the slave at pos is replaced by a terminal of another type (stops answering, recover() fails)
+    def replace(self, pos):
+        slave = self.slaves[pos]
+        slave.state = NONE_STATE
+        slave.replaced = True
+
+    # Hot plug: a new slave is connected behind the last one (not configured, not part of the IO map)
+    def plug(self, name, product_code, input_size=0, output_size=0):
+        self.unconfigured.append((name, product_code, input_size, output_size))
+
+    # True if a (configured or new) slave is connected behind the given one
+    def _behind(self, slave):
+        return slave is not self.slaves[-1] or bool(self.unconfigured)
+
+    # Loop the outputs of slave output_pos back to the inputs of slave input_pos (e.g. EL2872 -> EL1872)
+    def wire(self, output_pos, input_pos):
+        source = self.slaves[output_pos]._output
+        target = self.slaves[input_pos]._input
+        n_bytes = min(len(source), len(target))
+
+        def loopback():
+            target[:n_bytes] = source[:n_bytes]
+
+        self._models.append((self.slaves[input_pos], loopback))
+
+    def open(self, ifname, ioMapSize=4096):
+        pass
+
+    def close(self):
+        pass
+
+    def config_init(self, usetable=False):
+        self._sync0_slaves = []
+        self._layout = list(self._layout) + self.unconfigured
+        self.unconfigured = []
+        self.slaves = [FakeSlave(self, name, product_code, input_size, output_size)
+                       for name, product_code, input_size, output_size in self._layout]
+        self._models = []
+        for slave in self.slaves:
+            slave.state = PREOP_STATE
+            model = INPUT_MODELS.get(slave.id)
+            if model is not None:
+                self._models.append((slave, model(slave._input)))
+        self.state = PREOP_STATE
+        return len(self.slaves)
+
+    # Like SOEM: measure the propagation delays and start the reference clock, True if there are DC slaves
+    def config_dc(self):
+        self._access(4, reads=2, writes=2)
+        if not self.slaves:
+            return False
+        self._dc_start = time.monotonic_ns()
+        self._dc_base = self._random.randrange(1 << 40)
+        self.dc_time = self._dc_base
+        return True
+
+    # SYNC0 supervision of the slaves with active SYNC0: every frame has to arrive in the SYNC0
+    # interval after the one of the previous frame, at least SYNC0_MARGIN_NS before the edge
+    def _check_sync0(self):
+        for slave in self._sync0_slaves:
+            if slave._state != OP_STATE:
+                slave._sync_interval = None
+                continue
+            act, cycle_time, shift_time, sync1_cycle_time = slave.dc_sync_settings
+            interval, phase = divmod(self.dc_time - shift_time, cycle_time)
+            if slave._sync_interval is None or (interval == slave._sync_interval + 1 and
+                                                phase <= cycle_time - self.SYNC0_MARGIN_NS):
+                slave._sync_error_counter = max(0, slave._sync_error_counter - 1)
+            else:
+                self.sync_errors += 1
+                slave._sync_error_counter += 3
+                if slave._sync_error_counter > self.SYNC_ERROR_LIMIT:
+                    slave._sync_error_counter = 0
+                    slave.state = SAFEOP_STATE + STATE_ERROR
+                    slave.al_status = 0x002C
+            slave._sync_interval = interval
+
+    def config_map(self):
+        for pos, slave in enumerate(self.slaves):
+            if slave.config_func is not None:
+                slave.config_func(pos)
+            slave.state = SAFEOP_STATE
+        self.state = SAFEOP_STATE
+        # Same rule as SOEM: outputs are counted twice (read + write), inputs once
+        n_outputs = sum(1 for slave in self.slaves if len(slave.output) > 0)
+        n_inputs = sum(1 for slave in self.slaves if len(slave.input) > 0)
+        self.expected_wkc = 2 * n_outputs + n_inputs
+        return sum(len(slave.input) + len(slave.output) for slave in self.slaves)
+
+    # Like SOEM: one broadcast read, plus one read per slave if the states differ
+    def read_state(self):
+        states = [slave.state for slave in self.slaves]
+        n_frames = 1 if len(set(states)) <= 1 else 1 + len(states)
+        self._access(n_frames, reads=n_frames)
+        return min(states, default=NONE_STATE)
+
+    def write_state(self):
+        self._access(1, writes=1)
+        for slave in self.slaves:
+            if not slave.offline:
+                slave.state = self.state
+        return 1
+
+    def state_check(self, expected_state, timeout=50000):
+        self._access(1, reads=1)
+        self.state = min((slave.state for slave in self.slaves), default=NONE_STATE)
+        return self.state
+
+    def send_processdata(self):
+        self.frames_sent += 1
+        return 1
+
+    def receive_processdata(self, timeout=2000):
+        if self.exchange_time_ns:
+            end = time.monotonic_ns() + self.exchange_time_ns
+            while time.monotonic_ns() < end:
+                pass
+        if self.packet_loss and self._random.random() < self.packet_loss:
+            self.frames_lost += 1
+            return -1
+        if self._dc_start is not None:
+            self.dc_time = self._dc_base + int((time.monotonic_ns() - self._dc_start) * self._dc_rate)
+            if self._sync0_slaves:
+                self._check_sync0()
+        for slave, update in self._models:
+            if slave._state & 0x0F >= SAFEOP_STATE:
+                update()
+        if self.next_wkc is not None:
+            wkc = self.next_wkc
+            self.next_wkc = None
+            return wkc
+        if self._wkc is None:
+            self._wkc = sum(slave.wkc() for slave in self.slaves)
+        return self._wkc
+
+
+# 100 slave line at 10 kHz: cost of send / receive and achieved cycle rate (no NIC required)
+if __name__ == '__main__':
+
+    from cycle_timer import CycleTimer
+
+    n_slaves = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    period_ns = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    duration = 2.0
+
+    master = FakeMaster((DEFAULT_LAYOUT * (n_slaves // len(DEFAULT_LAYOUT) + 1))[:n_slaves], packet_loss=0.0001, seed=1)
+    master.config_init()
+    master.config_map()
+    master.state = OP_STATE
+    master.write_state()
+    # EL2872 -> EL1872 of every group
+    for pos, slave in enumerate(master.slaves[:-1]):
+        if slave.name == 'EL2872' and master.slaves[pos + 1].name == 'EL1872':
+            master.wire(pos, pos + 1)
+
+    timer = CycleTimer(period_ns)
+    n_cycles = int(duration * 1e9 / period_ns)
+    exchange_ns = 0
+    wkc_errors = 0
+    timer.start()
+    for _ in range(n_cycles):
+        timer.wait_next()
+        t0 = time.perf_counter_ns()
+        master.send_processdata()
+        wkc = master.receive_processdata(2000)
+        exchange_ns += time.perf_counter_ns() - t0
+        if wkc != master.expected_wkc:
+            wkc_errors += 1
+        timer.cycle_done()
+    stats = timer.stats()
+    print('{} slaves, {} us period: send + receive {:.1f} us/cycle, {} overruns, {} WKC errors ({} frames lost)'.format(
+        len(master.slaves), period_ns // 1000, exchange_ns / n_cycles / 1000, stats['overruns'], wkc_errors,
+        master.frames_lost))
+    print('SDO info: {}'.format({slave.name: len(slave.od_objects) for slave in master.slaves[:7] if slave.od_objects}))
@@ -0,0 +1,313 @@
+"""Pool of EtherCAT segments, one worker process per network adapter"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import pysoem
+
+from cycle_stats import CycleStats
+from cycle_timer import CycleTimer
+from process_image import ProcessImage
+from shm_image import ShmProcessImage
+from supervisor import SlaveSupervisor
+
+
+# One segment inside its worker process: own master, cycle thread, statistics and supervisor.
+# Every worker has its own interpreter, so the cycle threads of different segments do not share a GIL.
+class _Segment:
+
+    # Constructor
+    def __init__(self, ifname, master, cycle_time_ns, cpu, rt_priority, shm_name):
+        self.ifname = ifname
+        self.master = master
+        # The mailbox transfers of the command loop (sdo_read / sdo_write) release the GIL, so the cycle thread
+        # keeps running while they wait for the slave. read_state() (states) holds it for one frame.
+        self.master.always_release_gil = True
+        self.timer = CycleTimer(cycle_time_ns)
+        self.stats = CycleStats(self.timer)
+        self.supervisor = SlaveSupervisor(master, stats=self.stats, log=lambda message: None)
+        self._cpu = cpu
+        self._rt_priority = rt_priority
+        self._shm_name = shm_name
+        self._shm = None
+        self._image = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.actual_wkc = 0
+
+    # Bring the segment to OP, returns the number of slaves
+    def start(self):
+        self.master.open(self.ifname)
+        n_slaves = self.master.config_init()
+        if n_slaves <= 0:
+            self.master.close()
+            raise MasterPoolError('{}: no slaves found'.format(self.ifname))
+        self.master.config_map()
+        if self.master.state_check(pysoem.SAFEOP_STATE, 50000) != pysoem.SAFEOP_STATE:
+            self.master.close()
+            raise MasterPoolError('{}: not all slaves reached SAFEOP state'.format(self.ifname))
+        if self._shm_name is not None:
+            self._image = ProcessImage(self.master.slaves)
+            self._shm = ShmProcessImage.create(self._shm_name, len(self._image.inputs), len(self._image.outputs))
+        self._thread = threading.Thread(target=self._cycle_thread, daemon=True)
+        self._thread.start()
+        self.master.state = pysoem.OP_STATE
+        self.master.write_state()
+        for _ in range(40):
+            if self.master.state_check(pysoem.OP_STATE, 50000) == pysoem.OP_STATE:
+                self.supervisor.start()
+                return n_slaves
+        self.stop()
+        raise MasterPoolError('{}: not all slaves reached OP state'.format(self.ifname))
+
+    def stop(self):
+        self.supervisor.stop()
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        self.master.state = pysoem.INIT_STATE
+        self.master.write_state()
+        self.master.close()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def _cycle_thread(self):
+        CycleTimer.setup_realtime(self._cpu, self._rt_priority)
+        timer = self.timer
+        master = self.master
+        timer.start()
+        while not self._stop_event.is_set():
+            lateness_ns = timer.wait_next()
+            send_ns = time.monotonic_ns()
+            master.send_processdata()
+            self.actual_wkc = master.receive_processdata(10000)
+            receive_ns = time.monotonic_ns()
+            if self._shm is not None:
+                self._image.refresh_changed()
+                self._shm.publish_inputs(self._image.inputs, timer.cycles, self.actual_wkc, receive_ns)
+                if self._shm.take_outputs(self._image.outputs):
+                    self._image.commit_changed()
+            wkc_ok = self.actual_wkc == master.expected_wkc
+            if not wkc_ok:
+                self.supervisor.notify_wkc(self.actual_wkc)
+            else:
+                self.supervisor.notify_ok()
+            self.stats.record_cycle(send_ns, receive_ns - send_ns, lateness_ns, wkc_ok)
+            timer.cycle_done()
+
+    # Slave states as list of (position, name, state, AL status text)
+    def states(self):
+        self.master.read_state()
+        return [(pos, slave.name, slave.state, pysoem.al_status_code_to_string(slave.al_status))
+                for pos, slave in enumerate(self.master.slaves)]
+
+    def telemetry(self):
+        snapshot = self.stats.snapshot()
+        snapshot['slaves'] = len(self.master.slaves)
+        snapshot['wkc'] = self.actual_wkc
+        snapshot['expected_wkc'] = self.master.expected_wkc
+        snapshot['recovery_episodes'] = self.supervisor.episodes
+        return snapshot
+
+
+# Entry point of a worker process: start the segment, then serve the commands of the pool over conn
+# Only the cycle thread is pinned to the core of the segment, the command loop and the supervisor run on
+# the other cores.
+def _segment_worker(ifname, conn, cycle_time_ns, cpu, rt_priority, shm_name, master_factory):
+    # The threads started from here inherit the affinity, the cycle thread pins itself to cpu
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        others = os.sched_getaffinity(0) - {cpu}
+        if others:
+            os.sched_setaffinity(0, others)
+    segment = _Segment(ifname, master_factory() if master_factory is not None else pysoem.Master(),
+                       cycle_time_ns, cpu, rt_priority, shm_name)
+    try:
+        conn.send(('ok', segment.start()))
+    except (MasterPoolError, OSError) as exc:
+        conn.send(('error', str(exc)))
+        return
+    commands = {'telemetry': segment.telemetry,
+                'states': segment.states,
+                'sdo_read': lambda pos, index, subindex: segment.master.slaves[pos].sdo_read(index, subindex),
+                'sdo_write': lambda pos, index, subindex, data: segment.master.slaves[pos].sdo_write(index, subindex, data),
+                'check': segment.supervisor.request_check}
+    while True:
+        command, args = conn.recv()
+        if command == 'stop':
+            segment.stop()
+            conn.send(('ok', None))
+            return
+        try:
+            conn.send(('ok', commands[command](*args)))
+        except Exception as exc:
+            conn.send(('error', '{}: {}'.format(type(exc).__name__, exc)))
+
+
+# Runs one segment per network adapter, each in its own process with its cycle thread pinned to its own core,
+# and offers one control / telemetry API for all of them.
+class MasterPool:
+
+    # Constructor
+    # ifnames: adapters to use (default: all adapters of pysoem.find_adapters())
+    # cpus: core per segment (default: one core per segment, core 0 is left to the parent if possible)
+    # rt_priority: SCHED_FIFO priority of the cycle threads (None: normal scheduling)
+    # shm_prefix: publish the process image of each segment as shared memory <shm_prefix><n>, see shm_image.py
+    # master_factory: picklable function returning a master (default: pysoem.Master, e.g. fake_master.FakeMaster)
+    def __init__(self, ifnames=None, cycle_time_ns=1000000, cpus=None, rt_priority=None, shm_prefix=None,
+                 master_factory=None, start_timeout=30.0):
+        if ifnames is None:
+            ifnames = [adapter.name for adapter in pysoem.find_adapters()]
+        self.ifnames = list(ifnames)
+        self.cycle_time_ns = cycle_time_ns
+        self.cpus = cpus if cpus is not None else self._default_cpus(len(self.ifnames))
+        self.rt_priority = rt_priority
+        self.shm_prefix = shm_prefix
+        self.master_factory = master_factory
+        self.start_timeout = start_timeout
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = {}
+        self._locks = {}
+        # Segments that could not be started: {ifname: message}
+        self.failed = {}
+
+    @staticmethod
+    def _default_cpus(n_segments):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        if len(cpus) > 1:
+            cpus = cpus[1:]
+        return [cpus[i % len(cpus)] for i in range(n_segments)]
+
+    # Segments running in OP
+    @property
+    def segments(self):
+        return list(self._workers)
+
+    # Start all segments concurrently, returns {ifname: number of slaves} of the segments in OP
+    def start(self):
+        pending = {}
+        for n, (ifname, cpu) in enumerate(zip(self.ifnames, self.cpus)):
+            parent_conn, child_conn = self._context.Pipe()
+            shm_name = '{}{}'.format(self.shm_prefix, n) if self.shm_prefix is not None else None
+            process = self._context.Process(target=_segment_worker, name='ethercat-{}'.format(ifname), daemon=True,
+                                            args=(ifname, child_conn, self.cycle_time_ns, cpu, self.rt_priority,
+                                                  shm_name, self.master_factory))
+            process.start()
+            pending[ifname] = (process, parent_conn)
+        started = {}
+        deadline = time.monotonic() + self.start_timeout
+        for ifname, (process, conn) in pending.items():
+            if conn.poll(max(0.0, deadline - time.monotonic())):
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    status, result = 'error', 'worker exited with code {}'.format(process.exitcode)
+            else:
+                status, result = 'error', 'no answer within {} s'.format(self.start_timeout)
+            if status == 'ok':
+                self._workers[ifname] = (process, conn)
+                self._locks[ifname] = threading.Lock()
+                started[ifname] = result
+            else:
+                self.failed[ifname] = result
+                process.terminate()
+                process.join()
+        return started
+
+    def _request(self, ifname, command, *args):
+        process, conn = self._workers[ifname]
+        with self._locks[ifname]:
+            conn.send((command, args))
+            try:
+                status, result = conn.recv()
+            except EOFError:
+                process.join(1.0)
+                raise MasterPoolError('{}: worker exited with code {}'.format(ifname, process.exitcode))
+        if status != 'ok':
+            raise MasterPoolError('{}: {}'.format(ifname, result))
+        return result
+
+    # Cycle statistics and WKC of all segments: {ifname: dict}
+    def telemetry(self):
+        return {ifname: self._request(ifname, 'telemetry') for ifname in self._workers}
+
+    # Slave states of all segments: {ifname: [(position, name, state, AL status text)]}
+    def states(self):
+        return {ifname: self._request(ifname, 'states') for ifname in self._workers}
+
+    def sdo_read(self, ifname, slave_pos, index, subindex):
+        return self._request(ifname, 'sdo_read', slave_pos, index, subindex)
+
+    def sdo_write(self, ifname, slave_pos, index, subindex, data):
+        return self._request(ifname, 'sdo_write', slave_pos, index, subindex, bytes(data))
+
+    # Let the supervisors of all segments check all slave states
+    def check(self):
+        for ifname in self._workers:
+            self._request(ifname, 'check')
+
+    # Bring all segments to INIT and stop the workers
+    def stop(self):
+        for ifname in list(self._workers):
+            process, conn = self._workers.pop(ifname)
+            try:
+                conn.send(('stop', ()))
+                conn.recv()
+            except (EOFError, OSError):
+                pass
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+# Separate class for errors
+class MasterPoolError(Exception):
+    def __init__(self, message):
+        super(MasterPoolError, self).__init__(message)
+        self.message = message
+
+
+# Main fct
+# master_pool ifname [ifname ...]: run the given segments (all: every adapter of find_adapters())
+# master_pool fake N: jitter of 1..N simulated segments (no NIC required)
+if __name__ == '__main__':
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'fake':
+        from fake_master import FakeMaster
+
+        max_segments = int(sys.argv[2])
+        n_segments = 1
+        while n_segments <= max_segments:
+            pool = MasterPool(['fake{}'.format(n) for n in range(n_segments)], master_factory=FakeMaster)
+            pool.start()
+            time.sleep(2.0)
+            telemetry = pool.telemetry()
+            pool.stop()
+            print('{} segments: jitter p99 {} us, max {} us, overruns {}'.format(
+                n_segments,
+                max(t['jitter_p99_us'] for t in telemetry.values()),
+                max(t['jitter_max_us'] for t in telemetry.values()),
+                sum(t['overruns'] for t in telemetry.values())))
+            n_segments *= 2
+    elif len(sys.argv) > 1:
+        pool = MasterPool(None if sys.argv[1:] == ['all'] else sys.argv[1:])
+        print('Segments in OP: {}'.format(pool.start()))
+        for ifname, message in pool.failed.items():
+            print('{} failed: {}'.format(ifname, message))
+        try:
+            while pool.segments:
+                time.sleep(5)
+                for ifname, telemetry in pool.telemetry().items():
+                    print('{}: {}'.format(ifname, telemetry))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.stop()
+    else:
+        print('Usage: master_pool ifname [ifname ...] | all | fake N')
+        sys.exit(1)
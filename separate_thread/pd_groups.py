@@ -0,0 +1,225 @@
+"""Process data groups: slaves exchanged with the processdata thread at different periods"""
+
+from collections import namedtuple
+from math import gcd
+
+import pysoem
+
+
+# Statistics of one group
+GroupStats = namedtuple('GroupStats', 'name period_ns phase slaves expected_wkc exchanges faults faulted')
+
+
+# Slaves that share one period
+class PdGroup:
+
+    # Constructor
+    # positions: slave positions of the group
+    # period: in base cycles of the processdata thread, phase: base cycle within the period
+    def __init__(self, name, positions, period, phase, slaves, image):
+        self.name = name
+        self.positions = tuple(positions)
+        self.period = period
+        self.phase = phase
+        self.selection = image.select(self.positions)
+        # WKC of the group with all slaves in OP (LRW: 2 per slave with outputs, 1 per slave with inputs)
+        self.expected_wkc = sum(_wkc_share(slaves[pos], pysoem.OP_STATE) for pos in self.positions)
+        # Process image bytes copied per exchange
+        self.size = sum(len(slaves[pos].input) + len(slaves[pos].output) for pos in self.positions)
+        self.faulted = False
+        self.exchanges = 0
+        self.faults = 0
+
+
+# WKC a slave contributes in the given state
+def _wkc_share(slave, state):
+    state &= 0x0F
+    if state == pysoem.OP_STATE:
+        return (2 if len(slave.output) else 0) + (1 if len(slave.input) else 0)
+    if state == pysoem.SAFEOP_STATE:
+        return 1 if len(slave.input) else 0
+    return 0
+
+
+# Runs the process image work of every group at the group's own period inside the processdata thread,
+# e.g. {'fast': ((1, 3, 5, 6), 1000000), 'relays': ((2, 4), 20000000)}.
+# The groups are interleaved: the phase of every slower group is chosen so that the bytes copied per
+# base cycle are spread as evenly as possible over its period.
+# Every cycle (after receive_processdata) exchange() copies inputs / outputs of the due groups only.
+# With application code between input and output (e.g. a CyclePipeline), call refresh() after
+# receive_processdata and commit() after the application instead, so its outputs go out with the next frame.
+# Fault handling per group: a group whose slaves (states as last read, e.g. by the SlaveSupervisor)
+# deliver less than its expected WKC is faulted: its inputs keep the last good values and its outputs
+# are held, the other groups continue. on_fault(group, faulted) is called on every change.
+# A lost frame (WKC < 0), or a WKC deficit that the slave states do not explain yet (states not read since
+# the fault), holds all groups for that cycle (counted in held_cycles).
+# Note: pysoem exchanges the complete IO map with every frame, groups only cut the host work.
+class GroupScheduler:
+
+    # Constructor
+    # master: mapped pysoem.Master (or stand-in), image: ProcessImage of master.slaves
+    # groups: {name: (positions, period_ns)}, slaves with process data that are not listed are exchanged
+    #         every base cycle (group 'default')
+    # base_period_ns: period of the processdata thread, all group periods must be multiples of it
+    def __init__(self, master, image, groups, base_period_ns, on_fault=None):
+        self._master = master
+        self._image = image
+        self.base_period_ns = base_period_ns
+        self._on_fault = on_fault
+        slaves = master.slaves
+        assigned = set()
+        periods = {}
+        for name, (positions, period_ns) in groups.items():
+            if period_ns < base_period_ns or period_ns % base_period_ns:
+                raise ValueError('Period of group {} ({} ns) is not a multiple of the base period ({} ns)'.format(
+                    name, period_ns, base_period_ns))
+            if name == 'default':
+                raise ValueError('Group name default is reserved for the slaves not in a group')
+            for pos in positions:
+                if pos in assigned or not 0 <= pos < len(slaves):
+                    raise ValueError('Slave {} of group {} is unknown or already in a group'.format(pos, name))
+                assigned.add(pos)
+            periods[name] = period_ns // base_period_ns
+        groups = dict(groups)
+        rest = [pos for pos, slave in enumerate(slaves)
+                if pos not in assigned and (len(slave.input) or len(slave.output))]
+        if rest:
+            groups['default'] = (rest, base_period_ns)
+            periods['default'] = 1
+
+        # Hyperperiod (base cycles) and bytes per base cycle, slowest and largest groups placed first
+        hyperperiod = 1
+        for period in periods.values():
+            hyperperiod = hyperperiod * period // gcd(hyperperiod, period)
+        load = [0] * hyperperiod
+        self.groups = []
+        order = sorted(groups, key=lambda name: (-periods[name], -sum(len(slaves[pos].input) + len(slaves[pos].output)
+                                                                      for pos in groups[name][0])))
+        for name in order:
+            period = periods[name]
+            size = sum(len(slaves[pos].input) + len(slaves[pos].output) for pos in groups[name][0])
+            phase = min(range(period), key=lambda phase: (max(load[phase::period]), phase))
+            for cycle in range(phase, hyperperiod, period):
+                load[cycle] += size
+            self.groups.append(PdGroup(name, groups[name][0], period, phase, slaves, image))
+        self.groups.sort(key=lambda group: group.period)
+        self._by_name = {group.name: group for group in self.groups}
+        # Due groups per base cycle of the hyperperiod
+        self._schedule = [[group for group in self.groups if cycle % group.period == group.phase]
+                          for cycle in range(hyperperiod)]
+        self.cycles = 0
+        self.held_cycles = 0
+        self._refreshed = []
+        self.max_cycle_bytes = max(load)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    # Groups due in the given base cycle
+    def due(self, cycle):
+        return self._schedule[cycle % len(self._schedule)]
+
+    # Called once per base cycle after receive_processdata with its WKC: refresh() and commit(),
+    # returns the groups exchanged
+    def exchange(self, wkc):
+        groups = self.refresh(wkc)
+        self.commit()
+        return groups
+
+    # Inputs of the groups due in this base cycle (called once per base cycle after receive_processdata
+    # with its WKC), returns the groups refreshed. commit() writes the outputs of these groups.
+    def refresh(self, wkc):
+        groups = self._schedule[self.cycles % len(self._schedule)]
+        self.cycles += 1
+        wkc_ok = wkc == self._master.expected_wkc
+        self._refreshed = []
+        if not wkc_ok and (wkc < 0 or not any(self._state_wkc(group) < group.expected_wkc for group in self.groups)):
+            self.held_cycles += 1
+            return ()
+        for group in groups:
+            # Group WKC from the slave states as last read (no bus access in the cycle)
+            faulted = not wkc_ok and self._state_wkc(group) < group.expected_wkc
+            if faulted != group.faulted:
+                group.faulted = faulted
+                if faulted:
+                    group.faults += 1
+                if self._on_fault is not None:
+                    self._on_fault(group, faulted)
+            if faulted:
+                continue
+            self._image.refresh_slaves(group.selection)
+            self._refreshed.append(group)
+            group.exchanges += 1
+        return self._refreshed
+
+    # Outputs of the groups refreshed in this base cycle, sent with the next frame
+    def commit(self):
+        for group in self._refreshed:
+            self._image.commit_slaves(group.selection)
+
+    # WKC of a group from the slave states as last read
+    def _state_wkc(self, group):
+        slaves = self._master.slaves
+        return sum(_wkc_share(slaves[pos], slaves[pos].state) for pos in group.positions)
+
+    # Statistics per group
+    def stats(self):
+        return [GroupStats(group.name, group.period * self.base_period_ns, group.phase, group.positions,
+                           group.expected_wkc, group.exchanges, group.faults, group.faulted) for group in self.groups]
+
+
+# Host time per base cycle: all slaves every cycle vs. groups (fast I/O every cycle, the rest every 20 cycles)
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    from fake_master import DEFAULT_LAYOUT, FakeMaster
+    from process_image import ProcessImage
+
+    n_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_segments = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+
+    master = FakeMaster(DEFAULT_LAYOUT * n_segments)
+    master.config_init()
+    master.config_map()
+    master.state = pysoem.OP_STATE
+    master.write_state()
+    image = ProcessImage(master.slaves)
+    # Fast: EL3144 and the digital I/O of every segment, slow: EL4008 / EL4114 / EL2624 (20 ms)
+    fast = [pos for pos, slave in enumerate(master.slaves) if slave.name in ('EL3144', 'EL2872', 'EL1872')]
+    slow = [pos for pos, slave in enumerate(master.slaves) if slave.name in ('EL4008', 'EL4114', 'EL2624')]
+    scheduler = GroupScheduler(master, image, {'fast': (fast, 1000000), 'slow': (slow, 20000000)}, 1000000)
+
+    # The application writes new output values every cycle
+    outputs = [image.output_view(pos) for pos, slave in enumerate(master.slaves) if len(slave.output)]
+
+    def all_slaves():
+        master.send_processdata()
+        master.receive_processdata()
+        image.refresh_changed()
+        image.commit_changed()
+
+    def grouped():
+        master.send_processdata()
+        scheduler.exchange(master.receive_processdata())
+
+    results = []
+    for cycle in (all_slaves, grouped):
+        start = time.perf_counter()
+        for i in range(n_cycles):
+            for view in outputs:
+                view[0] = i & 0xFF
+            cycle()
+        results.append((time.perf_counter() - start) / n_cycles * 1e6)
+    print('{} slaves: all every cycle {:.1f} us/cycle, groups {:.1f} us/cycle'.format(len(master.slaves), *results))
+    for group in scheduler.stats():
+        print('  {}: {} slaves every {} ms (phase {}), expected WKC {}, {} exchanges'.format(
+            group.name, len(group.slaves), group.period_ns / 1e6, group.phase, group.expected_wkc, group.exchanges))
+
+    # A relay terminal fails: only the slow group is held, the fast group keeps running
+    master.inject_fault(slow[0], pysoem.SAFEOP_STATE + pysoem.STATE_ERROR, stuck=1)
+    scheduler.exchange(master.receive_processdata())
+    for _ in range(40):
+        grouped()
+    print('after fault of slave {}: {}'.format(slow[0], [(group.name, group.faulted, group.faults) for group in scheduler.stats()]))
@@ -0,0 +1,331 @@
+"""Process image with typed views on preallocated input / output buffers"""
+
+import struct
+
+
+# Read / write access to single bits of a digital terminal (e.g. EL2872, EL1872)
+class BitField:
+
+    # Constructor
+    # view: memoryview cast to 'B' on the slave's part of the image
+    def __init__(self, view):
+        self._view = view
+        self.width = 8 * len(view)
+
+    def __getitem__(self, bit):
+        return (self._view[bit >> 3] >> (bit & 7)) & 1
+
+    def __setitem__(self, bit, value):
+        if value:
+            self._view[bit >> 3] |= 1 << (bit & 7)
+        else:
+            self._view[bit >> 3] &= ~(1 << (bit & 7)) & 0xFF
+
+    def __len__(self):
+        return self.width
+
+
+# One bytearray for all outputs and one for all inputs of the configured slaves.
+# The application works on typed memoryviews into these buffers (no struct.pack / unpack per cycle),
+# commit() copies all outputs to the IOmap and refresh() copies all inputs from it, once per cycle.
+# For slow-changing I/O, commit_changed() only writes the slaves whose outputs changed since the last
+# commit and refresh_changed() flags the slaves whose inputs changed, so decoding can be skipped.
+# Per cycle the views are not faster than struct on a small line: both copy the same slaves to / from
+# the IOmap, the views add the writes into the image and the shadow copy for commit_changed()
+# (microbenchmark below: 3.4 - 4.9 us vs. 2.6 - 4.1 us per cycle, 282 vs. 258 bytes of transient heap).
+# They pay off by sharing one image with the signal map, recorder and shared memory, and with
+# commit_changed() / refresh_changed() on lines with many slaves: 100 slaves of the example line
+# (benchmarks.py cycle_overhead_full / _changed, with the simulated frame exchange and half of the input
+# terminals changing per cycle) take about 50 us vs. 35 us per cycle for commit, refresh and decode, with static
+# inputs and without the frame exchange (microbenchmark below) 73 us vs. 24 us.
+class ProcessImage:
+
+    # Constructor - slaves must be mapped already (call after master.config_map())
+    def __init__(self, slaves):
+        self._slaves = slaves
+        self._out_offsets = []
+        self._in_offsets = []
+        out_size = 0
+        in_size = 0
+        for slave in slaves:
+            n_out = len(slave.output)
+            n_in = len(slave.input)
+            self._out_offsets.append((out_size, out_size + n_out))
+            self._in_offsets.append((in_size, in_size + n_in))
+            out_size += n_out
+            in_size += n_in
+        self.outputs = bytearray(out_size)
+        self.inputs = bytearray(in_size)
+        self._outputs_view = memoryview(self.outputs)
+        self._inputs_view = memoryview(self.inputs)
+        # Only slaves with outputs / inputs take part in commit() / refresh()
+        self._out_slices = [(slave, self._outputs_view[a:b]) for slave, (a, b) in zip(slaves, self._out_offsets) if b > a]
+        self._in_slices = [(slave, a, b) for slave, (a, b) in zip(slaves, self._in_offsets) if b > a]
+        self._out_slice_offsets = [(a, b) for a, b in self._out_offsets if b > a]
+        # Change detection: shadow of the outputs as last written to the IOmap, last inputs per slave
+        self._committed = bytearray(out_size)
+        committed_view = memoryview(self._committed)
+        # (per slave position for select(), e.g. the slaves of a process data group)
+        self._out_by_pos = {pos: (slave, self._outputs_view[a:b], committed_view[a:b])
+                            for pos, (slave, (a, b)) in enumerate(zip(slaves, self._out_offsets)) if b > a}
+        self._out_tracked = list(self._out_by_pos.values())
+        self._in_tracked = [(pos, slave, a, b) for pos, (slave, (a, b)) in enumerate(zip(slaves, self._in_offsets)) if b > a]
+        self._last_inputs = [b''] * len(self._in_tracked)
+        self._in_by_pos = {pos: (i, pos, slave, a, b) for i, (pos, slave, a, b) in enumerate(self._in_tracked)}
+        # Per slave position: 1 if refresh_changed() found new inputs
+        self.input_changed = bytearray(len(slaves))
+        # Incremented by every refresh that (possibly) changed the input image
+        self.input_generation = 0
+        # Slave copies saved by commit_changed() / refresh_changed()
+        self.outputs_skipped = 0
+        self.inputs_skipped = 0
+        # Whether slave.output accepts a buffer directly (pysoem may insist on bytes)
+        self._buffer_output = True
+        # Start from the current IOmap content
+        self.refresh_outputs()
+        self.refresh()
+
+    # Typed view on the outputs of the slave at position pos (fmt: struct format char, e.g. 'h' for int16 channels)
+    def output_view(self, pos, fmt='B'):
+        a, b = self._out_offsets[pos]
+        return self._outputs_view[a:b].cast(fmt)
+
+    # Typed view on the inputs of the slave at position pos
+    def input_view(self, pos, fmt='B'):
+        a, b = self._in_offsets[pos]
+        return self._inputs_view[a:b].cast(fmt)
+
+    # Byte offset of the outputs of the slave at position pos in the output image
+    def output_offset(self, pos):
+        return self._out_offsets[pos][0]
+
+    # Byte offset of the inputs of the slave at position pos in the input image
+    def input_offset(self, pos):
+        return self._in_offsets[pos][0]
+
+    # Bit access to the outputs of the slave at position pos
+    def output_bits(self, pos):
+        return BitField(self.output_view(pos))
+
+    # Bit access to the inputs of the slave at position pos
+    def input_bits(self, pos):
+        return BitField(self.input_view(pos))
+
+    # Copy the complete output image to the slaves
+    def commit(self):
+        self._committed[:] = self.outputs
+        if self._buffer_output:
+            try:
+                for slave, view in self._out_slices:
+                    slave.output = view
+                return
+            except TypeError:
+                self._buffer_output = False
+        for slave, view in self._out_slices:
+            slave.output = view.tobytes()
+
+    # Copy only the outputs of slaves that changed since the last commit, returns the number of slaves written.
+    # pysoem writes the output image of a slave as a whole, so a slave is the smallest unit copied.
+    def commit_changed(self):
+        if self.outputs == self._committed:
+            self.outputs_skipped += len(self._out_tracked)
+            return 0
+        written = 0
+        for slave, view, committed in self._out_tracked:
+            if view != committed:
+                if self._buffer_output:
+                    try:
+                        slave.output = view
+                    except TypeError:
+                        self._buffer_output = False
+                if not self._buffer_output:
+                    slave.output = view.tobytes()
+                committed[:] = view
+                written += 1
+        self.outputs_skipped += len(self._out_tracked) - written
+        return written
+
+    # Selection of the slaves at the given positions for commit_slaves() / refresh_slaves()
+    def select(self, positions):
+        return ([self._out_by_pos[pos] for pos in positions if pos in self._out_by_pos],
+                [self._in_by_pos[pos] for pos in positions if pos in self._in_by_pos])
+
+    # commit_changed() for the slaves of a selection only (e.g. one process data group)
+    def commit_slaves(self, selection):
+        written = 0
+        for slave, view, committed in selection[0]:
+            if view != committed:
+                if self._buffer_output:
+                    try:
+                        slave.output = view
+                    except TypeError:
+                        self._buffer_output = False
+                if not self._buffer_output:
+                    slave.output = view.tobytes()
+                committed[:] = view
+                written += 1
+            else:
+                self.outputs_skipped += 1
+        return written
+
+    # Copy the current outputs of all slaves (as in the IOmap) into the output image
+    def refresh_outputs(self):
+        for slave, view in self._out_slices:
+            view[:] = slave.output
+        self._committed[:] = self.outputs
+
+    # Copy the current outputs of all slaves (as in the IOmap) into out (bytearray of len(outputs)), e.g. to
+    # record them; the output image and its change detection are not touched
+    def read_outputs(self, out):
+        for (slave, view), (a, b) in zip(self._out_slices, self._out_slice_offsets):
+            out[a:b] = slave.output
+
+    # Copy the inputs of all slaves into the input image
+    def refresh(self):
+        inputs = self.inputs
+        for slave, a, b in self._in_slices:
+            inputs[a:b] = slave.input
+        self.input_generation += 1
+
+    # Copy the inputs of all slaves that changed since the last refresh_changed(), sets input_changed
+    # per slave position and returns the number of changed slaves
+    def refresh_changed(self):
+        inputs = self.inputs
+        flags = self.input_changed
+        last_inputs = self._last_inputs
+        changed = 0
+        for i, (pos, slave, a, b) in enumerate(self._in_tracked):
+            data = slave.input
+            if data == last_inputs[i]:
+                flags[pos] = 0
+            else:
+                last_inputs[i] = data
+                inputs[a:b] = data
+                flags[pos] = 1
+                changed += 1
+        self.inputs_skipped += len(self._in_tracked) - changed
+        if changed:
+            self.input_generation += 1
+        return changed
+
+    # refresh_changed() for the slaves of a selection only, the flags of other slaves are kept
+    def refresh_slaves(self, selection):
+        inputs = self.inputs
+        flags = self.input_changed
+        last_inputs = self._last_inputs
+        changed = 0
+        for i, pos, slave, a, b in selection[1]:
+            data = slave.input
+            if data == last_inputs[i]:
+                flags[pos] = 0
+                self.inputs_skipped += 1
+            else:
+                last_inputs[i] = data
+                inputs[a:b] = data
+                flags[pos] = 1
+                changed += 1
+        if changed:
+            self.input_generation += 1
+        return changed
+
+
+# Microbenchmark: struct.pack / unpack per slave vs. process image views (fake slaves, no NIC), and
+# commit + refresh + decode of all slaves vs. the changed slaves only on a 100 slave line
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import tracemalloc
+
+    from array import array
+
+    from fake_master import FakeMaster
+
+    n_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    master = FakeMaster()
+    master.config_init()
+    master.config_map()
+    slaves = master.slaves
+
+    def struct_cycle(toggle):
+        if toggle:
+            slaves[1].output = struct.pack('8h', 0x0CCD, 0x1999, 0x2666, 0x3332, 0x0CCD, 0x1999, 0x2666, 0x3332)
+            slaves[2].output = struct.pack('4h', 0x1999, 0x3332, 0x4CCC, 0x6666)
+            slaves[4].output = struct.pack('B', 0x05)
+            slaves[5].output = struct.pack('H', 0xAAAA)
+        else:
+            slaves[1].output = struct.pack('8h', 0x1333, 0x2000, 0x2CCC, 0x3999, 0x1333, 0x2000, 0x2CCC, 0x3999)
+            slaves[2].output = struct.pack('4h', 0x3332, 0x1999, 0x6666, 0x4CCC)
+            slaves[4].output = struct.pack('B', 0x0A)
+            slaves[5].output = struct.pack('H', 0x5555)
+        el3144 = struct.unpack('8h', slaves[3].input)
+        el1872 = struct.unpack('H', slaves[6].input)[0]
+        return el3144[1] + el1872
+
+    image = ProcessImage(slaves)
+    el4008 = image.output_view(1, 'h')
+    el4114 = image.output_view(2, 'h')
+    el3144 = image.input_view(3, 'h')
+    el2624 = image.output_view(4, 'B')
+    el2872 = image.output_view(5, 'H')
+    el1872 = image.input_view(6, 'H')
+    # Index 0: toggle == False, index 1: toggle == True
+    el4008_patterns = (array('h', [0x1333, 0x2000, 0x2CCC, 0x3999] * 2), array('h', [0x0CCD, 0x1999, 0x2666, 0x3332] * 2))
+    el4114_patterns = (array('h', [0x3332, 0x1999, 0x6666, 0x4CCC]), array('h', [0x1999, 0x3332, 0x4CCC, 0x6666]))
+
+    def view_cycle(toggle):
+        el4008[:] = el4008_patterns[toggle]
+        el4114[:] = el4114_patterns[toggle]
+        el2624[0] = 0x05 if toggle else 0x0A
+        el2872[0] = 0xAAAA if toggle else 0x5555
+        image.commit()
+        image.refresh()
+        return el3144[1] + el1872[0]
+
+    for name, cycle in (('struct', struct_cycle), ('view', view_cycle)):
+        start = time.perf_counter()
+        for i in range(n_cycles):
+            cycle(i & 1)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        for i in range(1000):
+            cycle(i & 1)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:7}: {:.3f} us/cycle, peak transient heap: {} bytes'.format(
+            name, elapsed / n_cycles * 1e6, peak - current))
+
+    # 100 slave line with slow-changing I/O: only one slave gets new outputs per cycle, inputs are static
+    from signal_map import compile_signal_map
+
+    master = FakeMaster([('EL2872', 0x0B383052, 0, 2), ('EL1872', 0x07503052, 2, 0)] * 50)
+    master.config_init()
+    master.config_map()
+    image = ProcessImage(master.slaves)
+    signal_map = compile_signal_map(image, master.slaves)
+    outputs = [image.output_view(pos, 'H') for pos in range(0, len(master.slaves), 2)]
+
+    def full_cycle(i):
+        outputs[i % len(outputs)][0] = i & 0xFFFF
+        image.commit()
+        image.refresh()
+        return signal_map.decode_inputs()
+
+    def changed_cycle(i):
+        outputs[i % len(outputs)][0] = i & 0xFFFF
+        image.commit_changed()
+        image.refresh_changed()
+        return signal_map.decode_inputs(skip_unchanged=True)
+
+    times = {}
+    for name, cycle in (('full', full_cycle), ('changed', changed_cycle)):
+        start = time.perf_counter()
+        for i in range(n_cycles // 10):
+            cycle(i)
+        times[name] = (time.perf_counter() - start) / (n_cycles // 10)
+    print('100 slaves, commit + refresh + decode: {:.2f} us/cycle, changed only: {:.2f} us/cycle (saved {:.2f} us)'.format(
+        times['full'] * 1e6, times['changed'] * 1e6, (times['full'] - times['changed']) * 1e6))
+    print('slave copies skipped: {} outputs, {} inputs'.format(image.outputs_skipped, image.inputs_skipped))
@@ -0,0 +1,180 @@
+"""High rate process data recorder writing chunked columnar files"""
+
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# Records the raw input / output image, timestamp and WKC of every cycle.
+# record() only copies into a preallocated ring buffer (called from the cycle thread),
+# a background thread writes full chunks of chunk_cycles cycles as one .npz file with one array per column.
+# Every recording gets its own session directory in directory (session_<date>_<time>_<n>, see path),
+# so recordings into the same directory never mix.
+class ProcessDataRecorder:
+
+    # Constructor
+    # capacity: cycles held in the ring buffer (cycles are dropped if the writer falls this far behind)
+    def __init__(self, directory, input_size, output_size, capacity=8192, chunk_cycles=1024):
+        if chunk_cycles > capacity:
+            raise ValueError('chunk_cycles must not exceed capacity')
+        self.directory = directory
+        # Session directory of this recording (set by start())
+        self.path = None
+        self.capacity = capacity
+        self.chunk_cycles = chunk_cycles
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        self._wkc = np.zeros(capacity, dtype=np.int32)
+        self._inputs = np.zeros((capacity, input_size), dtype=np.uint8)
+        self._outputs = np.zeros((capacity, output_size), dtype=np.uint8)
+        # One writable memoryview per row, so record() copies without creating arrays
+        self._input_rows = [memoryview(row) for row in self._inputs]
+        self._output_rows = [memoryview(row) for row in self._outputs]
+        self._timestamp_view = memoryview(self._timestamps)
+        self._wkc_view = memoryview(self._wkc)
+        # head: next slot written by record(), tail: next slot written to disk (single producer / single consumer)
+        self._head = 0
+        self._tail = 0
+        self.dropped = 0
+        self.chunks_written = 0
+        self._chunk_number = 0
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.path is None:
+            stamp = time.strftime('%Y%m%d_%H%M%S')
+            n = 0
+            while True:
+                path = os.path.join(self.directory, 'session_{}_{}'.format(stamp, n))
+                try:
+                    os.mkdir(path)
+                    break
+                except FileExistsError:
+                    n += 1
+            self.path = path
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self._thread.start()
+
+    # Stop the writer thread and flush the remaining cycles
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    # Called once per cycle by the cycle thread
+    def record(self, inputs, outputs, timestamp_ns, wkc):
+        head = self._head
+        if head - self._tail >= self.capacity:
+            self.dropped += 1
+            return
+        slot = head % self.capacity
+        self._input_rows[slot][:] = inputs
+        self._output_rows[slot][:] = outputs
+        self._timestamp_view[slot] = timestamp_ns
+        self._wkc_view[slot] = wkc
+        self._head = head + 1
+        if head + 1 - self._tail >= self.chunk_cycles:
+            self._wakeup.set()
+
+    def _writer_thread(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+            while self._head - self._tail >= self.chunk_cycles:
+                self._write_chunk(self.chunk_cycles)
+        if self._head > self._tail:
+            self._write_chunk(self._head - self._tail)
+
+    def _write_chunk(self, n_cycles):
+        slots = np.arange(self._tail, self._tail + n_cycles) % self.capacity
+        path = os.path.join(self.path, 'chunk_{:06d}.npz'.format(self._chunk_number))
+        np.savez(path, timestamp_ns=self._timestamps[slots], wkc=self._wkc[slots],
+                 inputs=self._inputs[slots], outputs=self._outputs[slots])
+        self._chunk_number += 1
+        self.chunks_written += 1
+        self._tail += n_cycles
+
+
+# Session directories of the recordings in directory, oldest first
+def recordings(directory):
+    return sorted(glob.glob(os.path.join(directory, 'session_*')),
+                  key=lambda path: (os.path.basename(path)[:23], int(path.rsplit('_', 1)[1])))
+
+
+# Load all chunks of a recording (its session directory, see recordings()), returns a dict of column
+# arrays (rows = cycles)
+def load_recording(directory):
+    columns = {'timestamp_ns': [], 'wkc': [], 'inputs': [], 'outputs': []}
+    for path in sorted(glob.glob(os.path.join(directory, 'chunk_*.npz'))):
+        with np.load(path) as chunk:
+            for name in columns:
+                columns[name].append(chunk[name])
+    return {name: np.concatenate(arrays) if arrays else np.zeros(0) for name, arrays in columns.items()}
+
+
+# Decode the input signals of all recorded cycles at once
+# Returns {signal name: array of values per cycle} for the given names (default: all input signals)
+def decode_recording(recording, signal_map, names=None):
+    values = signal_map.decode_inputs_batch(recording['inputs'])
+    if names is None:
+        names = [signal.name for signal in signal_map.signals if signal.is_input]
+    return {name: values[:, signal_map.input_index(name)] for name in names}
+
+
+# Recorder overhead in the cycle thread (fake master, no NIC required)
+if __name__ == '__main__':
+
+    import sys
+    import tempfile
+    import time
+
+    from cycle_timer import CycleTimer
+    from fake_master import FakeMaster
+    from process_image import ProcessImage
+    from signal_map import compile_signal_map
+
+    n_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    period_us = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    master = FakeMaster()
+    master.config_init()
+    master.config_map()
+    image = ProcessImage(master.slaves)
+    el3144 = image.input_view(3, 'h')
+
+    with tempfile.TemporaryDirectory() as directory:
+        recorder = ProcessDataRecorder(directory, len(image.inputs), len(image.outputs))
+        recorder.start()
+        timer = CycleTimer(period_us * 1000)
+        timer.start()
+        overhead = 0
+        for cycle in range(n_cycles):
+            timer.wait_next()
+            el3144[1] = cycle & 0x7FFF
+            t0 = time.perf_counter_ns()
+            recorder.record(image.inputs, image.outputs, t0, master.expected_wkc)
+            overhead += time.perf_counter_ns() - t0
+        recorder.stop()
+        print('record(): {:.2f} us/cycle, {} chunks, {} dropped'.format(
+            overhead / n_cycles / 1000, recorder.chunks_written, recorder.dropped))
+
+        start = time.perf_counter()
+        recording = load_recording(recorder.path)
+        signal_map = compile_signal_map(image, master.slaves)
+        values = decode_recording(recording, signal_map, ['EL3144.ch1.value'])
+        elapsed = time.perf_counter() - start
+        if recorder.dropped:
+            check = 'n/a (cycles dropped)'
+        else:
+            check = bool(np.all(values['EL3144.ch1.value'] == np.arange(n_cycles) & 0x7FFF))
+        print('replay + decode of {} cycles: {:.1f} ms, EL3144 ch1 matches: {}'.format(
+            len(recording['wkc']), elapsed * 1000, check))
@@ -0,0 +1,269 @@
+"""Non-blocking SDO access: a mailbox worker thread serving reads and writes from a bounded queue"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import Future
+
+import pysoem
+
+
+# Request priorities (lower is served first)
+URGENT = 0
+NORMAL = 1
+
+
+# One queued SDO transfer
+class _SdoRequest:
+
+    __slots__ = ('kind', 'pos', 'index', 'subindex', 'size', 'data', 'future', 'deadline', 'submitted')
+
+    # Constructor
+    def __init__(self, kind, pos, index, subindex, size, data, deadline):
+        self.kind = kind
+        self.pos = pos
+        self.index = index
+        self.subindex = subindex
+        self.size = size
+        self.data = data
+        self.future = Future()
+        self.deadline = deadline
+        self.submitted = time.monotonic()
+
+
+# Serves the SDO transfers of the application in its own thread, so a mailbox round trip never
+# blocks the caller (e.g. the control loop or the processdata thread):
+#   future = worker.read(3, 0x1C33, 0x0B)          # returns immediately
+#   ...
+#   if future.done(): value = future.result()      # bytes, or raises the pysoem error
+# - The queue is bounded: a request that does not fit raises SdoWorkerError instead of waiting.
+# - A read of an object that is already queued (not yet sent) returns the future of that read.
+#   A write to the object ends the coalescing, later reads see the written value.
+# - Writes with urgent=True are sent before all queued normal requests. Queued writes to the same object
+#   are cancelled (they would overwrite the urgent value afterwards), writes to one object keep their order.
+# - A request still queued when its timeout expired is not sent, its future raises TimeoutError.
+# All transfers run one after the other in the worker thread (one mailbox user at a time).
+class SdoWorker:
+
+    # Constructor
+    # master: pysoem.Master or a stand-in (requests address slaves by position in master.slaves)
+    # max_pending: queued requests (not counting the one being transferred)
+    # timeout: default time [s] a request may wait in the queue (None: no limit)
+    def __init__(self, master, max_pending=64, timeout=None):
+        self._master = master
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._queue = []
+        self._sequence = itertools.count()
+        self._pending_reads = {}
+        self._pending_writes = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+        # Statistics
+        self.requests = 0
+        self.transfers = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.rejected = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.max_queued = 0
+        self.max_wait_s = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._worker_thread, name='ethercat-mailbox', daemon=True)
+        self._thread.start()
+
+    # Stop the worker after the current transfer, the futures of queued requests are cancelled
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._lock:
+            self._stopping = True
+            queue, self._queue = self._queue, []
+            self._pending_reads.clear()
+            self._pending_writes.clear()
+            self._wakeup.notify()
+        for _, _, request in queue:
+            request.future.cancel()
+        self._thread.join()
+        self._thread = None
+
+    # Queued requests
+    def __len__(self):
+        return len(self._queue)
+
+    # Read index:subindex of the slave at pos, returns a Future of the data (bytes)
+    def read(self, pos, index, subindex, size=0, timeout=None):
+        key = (pos, index, subindex)
+        with self._lock:
+            request = self._pending_reads.get(key)
+            if request is not None and request.size == size:
+                self.requests += 1
+                self.coalesced += 1
+                return request.future
+            request = self._submit('read', pos, index, subindex, size, None, timeout, NORMAL)
+            self._pending_reads[key] = request
+        return request.future
+
+    # Write data (bytes) to index:subindex of the slave at pos, returns a Future (result None)
+    # urgent: send before all queued normal requests, the futures of queued writes to the object are cancelled
+    def write(self, pos, index, subindex, data, urgent=False, timeout=None):
+        key = (pos, index, subindex)
+        with self._lock:
+            queued = self._pending_writes.get(key)
+            request = self._submit('write', pos, index, subindex, 0, bytes(data), timeout, URGENT if urgent else NORMAL)
+            if queued and urgent:
+                for older in queued:
+                    older.future.cancel()
+                self.superseded += len(queued)
+                queued = None
+            if queued:
+                queued.append(request)
+            else:
+                self._pending_writes[key] = [request]
+            self._pending_reads.pop(key, None)
+        return request.future
+
+    # Called with the lock held
+    def _submit(self, kind, pos, index, subindex, size, data, timeout, priority):
+        if self._thread is None or self._stopping:
+            raise SdoWorkerError('SDO worker not running')
+        if len(self._queue) >= self.max_pending:
+            self.rejected += 1
+            raise SdoWorkerError('SDO queue full ({} requests)'.format(self.max_pending))
+        if timeout is None:
+            timeout = self.timeout
+        request = _SdoRequest(kind, pos, index, subindex, size, data,
+                              time.monotonic() + timeout if timeout is not None else None)
+        heapq.heappush(self._queue, (priority, next(self._sequence), request))
+        self.requests += 1
+        self.max_queued = max(self.max_queued, len(self._queue))
+        self._wakeup.notify()
+        return request
+
+    def _next_request(self):
+        with self._lock:
+            while not self._queue and not self._stopping:
+                self._wakeup.wait()
+            if self._stopping:
+                return None
+            request = heapq.heappop(self._queue)[2]
+            key = (request.pos, request.index, request.subindex)
+            if request.kind == 'read':
+                if self._pending_reads.get(key) is request:
+                    del self._pending_reads[key]
+            else:
+                queued = self._pending_writes.get(key)
+                if queued is not None and request in queued:
+                    queued.remove(request)
+                    if not queued:
+                        del self._pending_writes[key]
+            return request
+
+    def _worker_thread(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            now = time.monotonic()
+            self.max_wait_s = max(self.max_wait_s, now - request.submitted)
+            if request.deadline is not None and now > request.deadline:
+                self.timeouts += 1
+                request.future.set_exception(TimeoutError('SDO {:#06x}:{:02x} of slave {} not sent within its timeout'.format(
+                    request.index, request.subindex, request.pos)))
+                continue
+            try:
+                slave = self._master.slaves[request.pos]
+                # The mailbox round trip must not hold the GIL (pysoem default), the processdata thread keeps running
+                if request.kind == 'read':
+                    result = slave.sdo_read(request.index, request.subindex, request.size, release_gil=True)
+                else:
+                    result = slave.sdo_write(request.index, request.subindex, request.data, release_gil=True)
+            except Exception as exc:
+                self.errors += 1
+                request.future.set_exception(exc)
+            else:
+                request.future.set_result(result)
+            self.transfers += 1
+
+    # Summary (wait time in ms)
+    def stats(self):
+        return {'sdo_requests': self.requests,
+                'sdo_transfers': self.transfers,
+                'sdo_coalesced': self.coalesced,
+                'sdo_superseded': self.superseded,
+                'sdo_rejected': self.rejected,
+                'sdo_errors': self.errors,
+                'sdo_timeouts': self.timeouts,
+                'sdo_queued': len(self._queue),
+                'sdo_max_queued': self.max_queued,
+                'sdo_max_wait_ms': self.max_wait_s * 1000}
+
+
+# Separate class for errors
+class SdoWorkerError(Exception):
+    def __init__(self, message):
+        super(SdoWorkerError, self).__init__(message)
+        self.message = message
+
+
+# Cycle timing of a 1 ms processdata thread that polls SDOs itself vs. through the worker (fake slaves, no NIC)
+if __name__ == '__main__':
+
+    import sys
+
+    from cycle_timer import CycleTimer
+    from fake_master import FakeMaster
+
+    mailbox_time_s = float(sys.argv[1]) if len(sys.argv) > 1 else 0.002
+    n_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    def run(use_worker):
+        master = FakeMaster(mailbox_time_s=mailbox_time_s)
+        master.config_init()
+        master.config_map()
+        master.state = pysoem.OP_STATE
+        master.write_state()
+        worker = SdoWorker(master)
+        worker.start()
+        timer = CycleTimer(1000000)
+        timer.start()
+        values = 0
+        future = None
+        for i in range(n_cycles):
+            timer.wait_next()
+            master.send_processdata()
+            master.receive_processdata(10000)
+            # Every 10th cycle: SM event missed counter of the EL3144 and an urgent analog output write
+            if i % 10 == 0:
+                if use_worker:
+                    if future is not None and future.done():
+                        values += 1
+                    # The previous read may still be queued: coalesced instead of queued twice
+                    future = worker.read(3, 0x1C33, 0x0B)
+                    worker.write(1, 0x7000, 1, b'\x00\x08', urgent=True)
+                else:
+                    master.slaves[3].sdo_read(0x1C33, 0x0B)
+                    master.slaves[1].sdo_write(0x7000, 1, b'\x00\x08')
+                    values += 1
+            timer.cycle_done()
+        worker.stop()
+        return timer.stats(), values, worker.stats()
+
+    print('{} cycles of 1 ms, mailbox round trip {} ms'.format(n_cycles, mailbox_time_s * 1000))
+    for label, use_worker in (('in the cycle', False), ('SDO worker', True)):
+        stats, values, worker_stats = run(use_worker)
+        print('{:12}: overruns {}, missed cycles {}, latency max {:.0f} us, {} reads done'.format(
+            label, stats['overruns'], stats['missed_cycles'], stats['latency_max_us'], values))
+        if use_worker:
+            print('{:12}  {}'.format('', worker_stats))
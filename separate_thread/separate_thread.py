@@ -1,14 +1,34 @@
 """Example wirth separate thread for processdata"""
 
+import os
 import sys
-import struct
 import time
 import threading
 
+from array import array
 from collections import namedtuple
 
 import pysoem
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+from analog_pipeline import AnalogPipeline
+from config_profiles import ConfigProfile, ProfileEngine
+from cycle_pipeline import INPUT, OUTPUT, CyclePipeline
+from cycle_stats import CycleStats
+from cycle_timer import CycleTimer
+from dc_clock import DcController
+from event_log import EventLog
+from od_index import UNSIGNED16, codec_for
+from pd_groups import GroupScheduler
+from process_image import ProcessImage
+from recorder import ProcessDataRecorder
+from sdo_worker import SdoWorker
+from shm_image import ShmProcessImage
+from signal_map import compile_signal_map
+from startup_snapshot import StartupSnapshot, config_digest, topology_fingerprint
+from supervisor import SlaveSupervisor
+from topology_monitor import TopologyMonitor
+
 class ThreadingExample:
 
     BECKHOFF_VENDOR_ID = 0x0002
@@ -20,96 +40,184 @@ class ThreadingExample:
     EL2872_PRODUCT_CODE = 0x0B383052
     EL1872_PRODUCT_CODE = 0x07503052
 
+    # Application signal names -> (compiled signal name, scale)
+    # EL3144: current = value * 10 / 0x8000
+    SIGNAL_ALIASES = {'EL3144.ch{}.current'.format(ch): ('EL3144.ch{}.value'.format(ch), 10 / 0x8000) for ch in range(1, 5)}
+
+    # Scale of the raw values of the analog input terminals (see analog_pipeline.py)
+    ANALOG_SCALES = {'EL3144': 10 / 0x8000}
+
+    # Configuration per product code, applied to all slaves concurrently in PREOP (see config_profiles.py)
+    # EL2872: Set DC sync - Use / Purpose ??
+    CONFIG_PROFILES = {EL2872_PRODUCT_CODE: ConfigProfile(dc_sync=(10000000,))}
+
+    # Process data groups with their own period (see pd_groups.py), the other slaves every cycle
+    # EL4114 analog outputs and EL2624 relays: every 20 ms
+    PD_GROUPS = {'slow': ((2, 4), 20000000)}
+
+    # Default period of the processdata thread: 5 ms
+    CYCLE_TIME_NS = 5000000
+
     # Constructor
-    def __init__(self, ifname):
+    # cycle_time_ns: period of the processdata thread (e.g. 1000000 = 1 ms, 500000 = 500 us)
+    # cpu / rt_priority: optionally pin the processdata thread to a CPU and run it with SCHED_FIFO
+    # master: optional stand-in for pysoem.Master (e.g. fake_master.FakeMaster)
+    # shm_name: optionally publish the inputs of every cycle in a shared memory segment of this name
+    #           (and take outputs written there by other processes), see shm_image.py
+    # record_dir: optionally record the process image of every cycle into a new session directory in this
+    #             directory, see recorder.py
+    # metrics_port: optionally serve the cycle statistics on http://<host>:metrics_port/metrics (Prometheus text)
+    # snapshot_dir: optionally keep startup snapshots per topology fingerprint and configuration in this
+    #               directory (e.g. startup_snapshot.DEFAULT_SNAPSHOT_DIR): a restart with the same slave chain,
+    #               CONFIG_PROFILES and SIGNAL_ALIASES reuses the signal map instead of reading PDO mapping and
+    #               SDO info again
+    # dc: lock the processdata thread to SYNC0 of the distributed clocks (config_dc, the slaves with dc_sync
+    #     in CONFIG_PROFILES get SYNC0 with cycle_time_ns), see dc_clock.py
+    # pd_groups: optionally exchange the process image of the processdata thread in groups with their own
+    #            period, {name: (slave positions, period_ns)} (e.g. PD_GROUPS), see pd_groups.py
+    def __init__(self, ifname, cycle_time_ns=CYCLE_TIME_NS, cpu=None, rt_priority=None, master=None, shm_name=None,
+                 record_dir=None, metrics_port=None, snapshot_dir=None, dc=False, pd_groups=None):
         self._ifname = ifname
+        self._snapshot_dir = snapshot_dir
+        self._cycle_timer = CycleTimer(cycle_time_ns)
+        self._dc_controller = DcController(cycle_time_ns) if dc else None
+        self._stats = CycleStats(self._cycle_timer, dc_controller=self._dc_controller)
+        self._metrics_port = metrics_port
+        self._metrics_server = None
+        self._cpu = cpu
+        self._rt_priority = rt_priority
         self._pd_thread_stop_event = threading.Event()
-        self._ch_thread_stop_event = threading.Event()
+        # Messages of the processdata thread, the supervisor and the monitors (written by the event log's own thread)
+        self._events = EventLog()
         self._actual_wkc = 0
-        self._master = pysoem.Master()
+        self._process_image = None
+        self._signal_map = None
+        self._shm_name = shm_name
+        self._shm = None
+        self._record_dir = record_dir
+        self._recorder = None
+        self._recorded_outputs = None
+        # Process image owned by the processdata thread (only used for shared memory / recording / groups /
+        # stages). With a cycle image the processdata thread is the only one writing outputs to the slaves:
+        # the PDO update loop posts its output image (_post_outputs), the processdata thread commits it.
+        self._cycle_image = None
+        self._posted_outputs = None
+        self._outputs_posted = False
+        self._pd_groups = pd_groups
+        self._group_scheduler = None
+        # Application stages run by the processdata thread every cycle (see cycle_pipeline.py), register with
+        # pipeline.add_stage(name, func, budget_us) before run(). The stages work on cycle_values (all input
+        # signals of the current frame) and cycle_signals (signal access to the image of the processdata thread).
+        self.pipeline = CyclePipeline(log=self._events.message)
+        self.cycle_signals = None
+        self.cycle_values = None
+        self._master = master if master is not None else pysoem.Master()
         self._master.in_op = False
-        self._master.do_check_state = False
+        # Mailbox transfers (SDO worker, configuration) and config_init release the GIL, so they never stall
+        # the processdata thread (pysoem default: the GIL is held for the whole round trip)
+        self._master.always_release_gil = True
+        # Woken by the processdata thread on a WKC deficit (replaces the polling check thread)
+        self._supervisor = SlaveSupervisor(self._master, stats=self._stats, events=self._events)
+        # Watches the chain for unplugged / replaced / added slaves once in OP (see topology_monitor.py)
+        self._topology_monitor = None
+        # SDO transfers of the PDO update loop run in the mailbox worker (never blocking the loop)
+        self._sdo_worker = SdoWorker(self._master)
         SlaveSet = namedtuple('SlaveSet', 'name product_code config_func')
         self._expected_slave_layout = {0: SlaveSet('EK1100', self.EK1100_PRODUCT_CODE, None),
                                        1: SlaveSet('EL4008', self.EL4008_PRODUCT_CODE, None),
                                        2: SlaveSet('EL4114', self.EL4114_PRODUCT_CODE, None),
                                        3: SlaveSet('EL3144', self.EL3144_PRODUCT_CODE, None),
                                        4: SlaveSet('EL2624', self.EL2624_PRODUCT_CODE, None),
-                                       5: SlaveSet('EL2872', self.EL2872_PRODUCT_CODE, self.el2872_setup),
+                                       5: SlaveSet('EL2872', self.EL2872_PRODUCT_CODE, None),
                                        6: SlaveSet('EL1872', self.EL1872_PRODUCT_CODE, None)}
 
-    # Setup function for EL2872
-    def el2872_setup(self, slave_pos):
-        # Obtain relevant slave object from master
-        slave = self._master.slaves[slave_pos]
-
-        # Set DC sync - Use / Purpose ??
-        slave.dc_sync(1, 10000000)
-
-    # Static method to check state of slave (will be executed in separate thread)
+    # Static method to check state of slave
+    # (recovery step of the former polling check thread, see supervisor.py for the event driven version)
+    # log: function for messages (default: print)
     @staticmethod
-    def _check_slave(slave, pos):
+    def _check_slave(slave, pos, log=print):
         # SAFEOP && ERROR
         if slave.state == (pysoem.SAFEOP_STATE + pysoem.STATE_ERROR):
-            print('ERROR : Slave {} is in SAFE_OP + ERROR, attempting to acknowledge...'.format(pos))
+            log('ERROR : Slave {} is in SAFE_OP + ERROR, attempting to acknowledge...'.format(pos))
             slave.state = pysoem.SAFEOP_STATE + pysoem.STATE_ACK
             slave.write_state()
         # SAFEOP_STATE
         elif slave.state == pysoem.SAFEOP_STATE:
-            print('WARNING : Slave {} is in SAFE_OP, trying to change to OPERATIONAL...'.format(pos))
+            log('WARNING : Slave {} is in SAFE_OP, trying to change to OPERATIONAL...'.format(pos))
             slave.state = pysoem.OP_STATE
             slave.write_state()
         # NONE_STATE
         elif slave.state > pysoem.NONE_STATE:
             if slave.reconfig():
                 slave.is_lost = False
-                print('MESSAGE : Slave {} reconfigured...'.format(pos))
+                log('MESSAGE : Slave {} reconfigured...'.format(pos))
         # Check if slave is lost
         elif not slave.is_lost:
             slave.state_check(pysoem.OP_STATE)
             if slave.state == pysoem.NONE_STATE:
                 slave.is_lost = True
-                print('ERROR : Slave {} lost...'.format(pos))
+                log('ERROR : Slave {} lost...'.format(pos))
         # If lost, trying to recover
         if slave.is_lost:
             if slave.state == pysoem.NONE_STATE:
                 if slave.recover():
                     # Recovery successful
                     slave.is_lost = False
-                    print('MESSAGE : Slave {} recovered...'.format(pos))
+                    log('MESSAGE : Slave {} recovered...'.format(pos))
             else:
                 # ??
                 slave.is_lost = False
-                print('MESSAGE : Slave {} found...'.format(pos))
-    
-    # Thread for checking slave states
-    # Timing: 10 ms (+ execution time)
-    # (Pre-) Condition:
-    # - Master is IN_OP
-    # Trigger for check:
-    # - WKC counter less than expected
-    # - do_check_state is set to TRUE
-    def _check_thread(self):
-        # Check if thread stop event is set
-        while not self._ch_thread_stop_event.is_set():
-            if self._master.in_op and ((self._actual_wkc < self._master.expected_wkc) or self._master.do_check_state):
-                self._master.do_check_state = False
-                self._master.read_state()
-                for i, slave in enumerate(self._master.slaves):
-                    if slave.state != pysoem.OP_STATE:
-                        self._master.do_check_state = True
-                        ThreadingExample._check_slave(slave, i)
-                if not self._master.do_check_state:
-                    print('OK: All slaves resumed OPERATIONAL.')
-            time.sleep(0.01)
+                log('MESSAGE : Slave {} found...'.format(pos))
+
+    # Called by the group scheduler (in the processdata thread) when a process data group becomes faulted / healthy again
+    def _group_fault(self, group, faulted):
+        if faulted:
+            self._events.message('WARNING : Process data group {} (slaves {}) faulted, holding its outputs...'.format(
+                group.name, group.positions))
+        else:
+            self._events.message('MESSAGE : Process data group {} resumed...'.format(group.name))
 
     # Thread for continuously running the send and rec'v processdata cmds
-    # Timing: 10 ms (+ execution time)
+    # Timing: cycle_time_ns (absolute deadlines, overruns are counted by the cycle timer)
     def _processdata_thread(self):
+        CycleTimer.setup_realtime(self._cpu, self._rt_priority)
+        self._cycle_timer.start()
         # Check if thread stop event is set
         while not self._pd_thread_stop_event.is_set():
+            lateness_ns = self._cycle_timer.wait_next()
+            send_ns = time.monotonic_ns()
             self._master.send_processdata()
             self._actual_wkc = self._master.receive_processdata(10000)
+            receive_ns = time.monotonic_ns()
+            # Shift the next deadline so the frames keep their phase in the SYNC0 period
+            # (a lost frame carries no new reference clock sample: hold the drift correction)
+            if self._dc_controller is not None:
+                if self._actual_wkc > 0:
+                    self._cycle_timer.adjust(self._dc_controller.update(self._master.dc_time, lateness_ns))
+                else:
+                    self._cycle_timer.adjust(self._dc_controller.hold())
+
+            if self._cycle_image is not None:
+                # Outputs posted by the PDO update loop (shared memory outputs taken below override them)
+                if self._outputs_posted:
+                    self._outputs_posted = False
+                    self._cycle_image.outputs[:] = self._posted_outputs
+                if self._group_scheduler is not None:
+                    # Inputs of the groups due in this cycle only (their outputs are committed after the stages)
+                    self._group_scheduler.refresh(self._actual_wkc)
+                else:
+                    self._cycle_image.refresh_changed()
+                timestamp_ns = receive_ns
+                # Record the raw image of this cycle (copy into the recorder's ring buffer only)
+                # (the outputs as sent, read into their own buffer: the image keeps outputs not committed yet)
+                if self._recorder is not None:
+                    self._cycle_image.read_outputs(self._recorded_outputs)
+                    self._recorder.record(self._cycle_image.inputs, self._recorded_outputs, timestamp_ns, self._actual_wkc)
+                # Publish the inputs to other processes, take their outputs for the next cycle
+                if self._shm is not None:
+                    self._shm.publish_inputs(self._cycle_image.inputs, self._cycle_timer.cycles,
+                                             self._actual_wkc, timestamp_ns)
+                    self._shm.take_outputs(self._cycle_image.outputs)
             
             # Testing Toggle Bit an der EL3144
             # https://infosys.beckhoff.de/index.php?content=../content/1031/el31xx/1710364299.html&id=
@@ -118,14 +226,80 @@ class ThreadingExample:
             # el3144_ch_1_state_as_int16 = el3144_ch_all_current_as_int16_struct[0]
             # print('{:#06x}'.format(el3144_ch_1_state_as_int16))
             
-            if not self._actual_wkc == self._master.expected_wkc:
-                print('Incorrect WKC')
-            time.sleep(0.005)
+            # Application stages on the inputs of this frame, their outputs go out with the next one
+            if self.pipeline.stages:
+                self.pipeline.run(self._cycle_timer.cycles, self._cycle_timer.next_deadline_ns)
+            if self._group_scheduler is not None:
+                self._group_scheduler.commit()
+            elif self._cycle_image is not None and not self.pipeline.stages:
+                self._cycle_image.commit_changed()
+
+            wkc_ok = self._actual_wkc == self._master.expected_wkc
+            if not wkc_ok:
+                self._events.wkc_mismatch(self._actual_wkc, self._master.expected_wkc)
+                if self._master.in_op:
+                    self._supervisor.notify_wkc(self._actual_wkc)
+            else:
+                self._supervisor.notify_ok()
+            self._stats.record_cycle(send_ns, receive_ns - send_ns, lateness_ns, wkc_ok)
+            self._cycle_timer.cycle_done()
+
+    # Outputs of the PDO update loop: written to the slaves directly, or with a cycle image handed to the
+    # processdata thread, which commits them with its next frame (one owner of the slave outputs)
+    def _post_outputs(self, image):
+        if self._cycle_image is None:
+            image.commit_changed()
+        else:
+            self._posted_outputs[:] = image.outputs
+            self._outputs_posted = True
 
     # Continuously running loop toggling the DOs until interrupted with Ctrl + C
     def _pdo_update_loop(self):
         # Set MASTER to "in operation"
         self._master.in_op = True
+        # Console output through the event log (written by its thread, the loop never blocks on print)
+        log = self._events.message
+
+        # Typed views on the process image (no struct.pack / unpack in the loop)
+        image = self._process_image
+        el4008_outputs = image.output_view(1, 'h')
+        el4114_outputs = image.output_view(2, 'h')
+        el3144_inputs = image.input_view(3, 'h')
+        el2624_outputs = image.output_view(4, 'B')
+        el2872_outputs = image.output_view(5, 'H')
+
+        # Positions of the input signals in the decoded value array
+        signal_map = self._signal_map
+        # All analog input channels: scaling, status masks and moving average in one step per iteration
+        analog = AnalogPipeline(signal_map, self.ANALOG_SCALES)
+        el3144_channels = [analog.index('EL3144.ch{}'.format(ch)) for ch in range(1, 5)]
+        el1872_index = signal_map.input_index('EL1872.inputs')
+
+        # EL3144: SM event missed counter (0x1C33:0B), read through the SDO worker
+        el3144_missed_counter = None
+        missed_counter_codec = codec_for(UNSIGNED16)
+
+        # Output patterns, preallocated once
+        # Signed 16bit (Struct: shirt - "h"): -32768 .. 32767
+        # 1.0V: f3276.7 = d3277 = 0x0CCD
+        # 1.5V: f4915.05 = d4915 = 0x1333
+        # 2.0V: f6553,4 = d6553 = 0x1999
+        # 2.5V: f8191.75 = d8192 = 0x2000
+        # 3.0V: f9830,1 = d9830 = 0x2666
+        # 3.5V: f11468,45 = d11468 = 0x2CCC
+        # 4.0V: f13106,8 = d13106 = 0x3332
+        # 4.5V: f14745,15 = d14745 = 0x3999
+        # 7.5V: f24575.25 = d24575 = 0x5FFF
+        el4008_1v_to_4v = array('h', [0x0CCD, 0x1999, 0x2666, 0x3332, 0x0CCD, 0x1999, 0x2666, 0x3332])
+        el4008_1v5_to_4v5 = array('h', [0x1333, 0x2000, 0x2CCC, 0x3999, 0x1333, 0x2000, 0x2CCC, 0x3999])
+        # Signed 16bit (Struct: shirt - "h"): -32768 .. 32767
+        # 4 mA: f6553,4 = d6553 = 0x1999
+        # 8 mA: f13106,8 = d13106 = 0x3332
+        # 12 mA: f19660,2 = d19660 = 0x4CCC
+        # 16 mA: f26213,6 = d26214 = 0x6666
+        # 20 mA: f32767 = d32767 = 0x7FFF
+        el4114_ascending = array('h', [0x1999, 0x3332, 0x4CCC, 0x6666])
+        el4114_swapped = array('h', [0x3332, 0x1999, 0x6666, 0x4CCC])
 
         # Initialize toggle variable
         toggle = True
@@ -133,94 +307,75 @@ class ThreadingExample:
         # Try the permanent loop
         try:
             while 1:
-                # Struct erforderlich, da Bytes erwartet werden und keine Ints oder ähnliches
-                print('Setting:')
+                log('Setting:')
                 if toggle:
-                    # Signed 16bit (Struct: shirt - "h"): -32768 .. 32767
-                    # 1.0V: f3276.7 = d3277 = 0x0CCD
-                    # 1.5V: f4915.05 = d4915 = 0x1333
-                    # 2.0V: f6553,4 = d6553 = 0x1999
-                    # 2.5V: f8191.75 = d8192 = 0x2000
-                    # 3.0V: f9830,1 = d9830 = 0x2666
-                    # 3.5V: f11468,45 = d11468 = 0x2CCC
-                    # 4.0V: f13106,8 = d13106 = 0x3332
-                    # 4.5V: f14745,15 = d14745 = 0x3999
-                    # 7.5V: f24575.25 = d24575 = 0x5FFF
-                    self._master.slaves[1].output = struct.pack('8h', 0x0CCD, 0x1999, 0x2666, 0x3332, 0x0CCD, 0x1999, 0x2666, 0x3332)
-                    print('EL4008: 1V, 2V, 3V, 4V, 1V, 2V, 3V, 4V')
+                    el4008_outputs[:] = el4008_1v_to_4v
+                    log('EL4008: 1V, 2V, 3V, 4V, 1V, 2V, 3V, 4V')
                 else:
-                    self._master.slaves[1].output = struct.pack('8h', 0x1333, 0x2000, 0x2CCC, 0x3999, 0x1333, 0x2000, 0x2CCC, 0x3999)
-                    print('EL4008: 1.5V, 2.5V, 3.5V, 4.5V, 1.5V, 2.5V, 3.5V, 4.5V')
-                print('**********')
+                    el4008_outputs[:] = el4008_1v5_to_4v5
+                    log('EL4008: 1.5V, 2.5V, 3.5V, 4.5V, 1.5V, 2.5V, 3.5V, 4.5V')
+                log('**********')
                 if toggle:
-                    # Signed 16bit (Struct: shirt - "h"): -32768 .. 32767
-                    # 4 mA: f6553,4 = d6553 = 0x1999
-                    # 8 mA: f13106,8 = d13106 = 0x3332
-                    # 12 mA: f19660,2 = d19660 = 0x4CCC
-                    # 16 mA: f26213,6 = d26214 = 0x6666
-                    # 20 mA: f32767 = d32767 = 0x7FFF
-                    self._master.slaves[2].output = struct.pack('4h', 0x1999, 0x3332, 0x4CCC, 0x6666)
-                    print('EL4114: 4mA, 8mA, 12mA, 16mA')
+                    el4114_outputs[:] = el4114_ascending
+                    log('EL4114: 4mA, 8mA, 12mA, 16mA')
                 else:
-                    self._master.slaves[2].output = struct.pack('4h', 0x3332, 0x1999, 0x6666, 0x4CCC)
-                    print('EL4114: 8mA, 4mA, 16mA, 12mA')
-                print('**********')
+                    el4114_outputs[:] = el4114_swapped
+                    log('EL4114: 8mA, 4mA, 16mA, 12mA')
+                log('**********')
                 if toggle:
-                    self._master.slaves[4].output = struct.pack('B', 0x05)
-                    print('EL2624: 0x05 = Relais 1 + 3')
+                    el2624_outputs[0] = 0x05
+                    log('EL2624: 0x05 = Relais 1 + 3')
                 else:
-                    self._master.slaves[4].output = struct.pack('B', 0x0A)
-                    print('EL2624: 0x0A = Relais 2 + 4')
-                print('**********')
+                    el2624_outputs[0] = 0x0A
+                    log('EL2624: 0x0A = Relais 2 + 4')
+                log('**********')
                 # Toggle outputs between 1-3-5-7-9-11-13-15 and 2-4-6-8-10-12-14-16
                 if toggle:
-                    self._master.slaves[5].output = struct.pack('H', 0xAAAA)
-                    print('EL2872: 0xAAAA = all right')
+                    el2872_outputs[0] = 0xAAAA
+                    log('EL2872: 0xAAAA = all right')
                 else:
-                    self._master.slaves[5].output = struct.pack('H', 0x5555)
-                    print('EL2872: 0x5555 = all left')
+                    el2872_outputs[0] = 0x5555
+                    log('EL2872: 0x5555 = all left')
+
+                # Write the output image in one step (only the terminals whose outputs changed)
+                self._post_outputs(image)
 
-                print('=================================================')
+                log('=================================================')
                 # Wait for propagation of physical signals (especially DO to DI)
                 time.sleep(0.01)
-                print('Reading:')
+                log('Reading:')
 
-                # Read from INPUTs
-                # EL3144 - 4 Channels, je 16 Bit Analog Value und 16 Bit Status
-                # 16 Bit Status: erstes Bit toggelt zwischen jedem gelesenen Analog-Wert (also zwischen 0x8000 und 0x0000)
-                print('EL3144: {}'.format(self._master.slaves[3].input.hex()))
-                el3144_ch_all_current_as_bytes = self._master.slaves[3].input
-                el3144_ch_all_current_as_int16_struct = struct.unpack('8h', el3144_ch_all_current_as_bytes)
-
-                el3144_ch_1_state_as_int16 = el3144_ch_all_current_as_int16_struct[0]
-                el3144_ch_1_current_as_int16 = el3144_ch_all_current_as_int16_struct[1]
-                
-                el3144_ch_2_state_as_int16 = el3144_ch_all_current_as_int16_struct[2]
-                el3144_ch_2_current_as_int16 = el3144_ch_all_current_as_int16_struct[3]
-                
-                el3144_ch_3_state_as_int16 = el3144_ch_all_current_as_int16_struct[4]
-                el3144_ch_3_current_as_int16 = el3144_ch_all_current_as_int16_struct[5]
-                
-                el3144_ch_4_state_as_int16 = el3144_ch_all_current_as_int16_struct[6]
-                el3144_ch_4_current_as_int16 = el3144_ch_all_current_as_int16_struct[7]
-                
-                el3144_ch_1_current = el3144_ch_1_current_as_int16 * 10 / 0x8000
-                el3144_ch_2_current = el3144_ch_2_current_as_int16 * 10 / 0x8000
-                el3144_ch_3_current = el3144_ch_3_current_as_int16 * 10 / 0x8000
-                el3144_ch_4_current = el3144_ch_4_current_as_int16 * 10 / 0x8000
-
-                print('EL3144: Ch 1 PDO: {:#06x}; Current: {:.6}; State: {:#06x}'.format(el3144_ch_1_current_as_int16, el3144_ch_1_current, el3144_ch_1_state_as_int16))
-                print('EL3144: Ch 2 PDO: {:#06x}; Current: {:.6}; State: {:#06x}'.format(el3144_ch_2_current_as_int16, el3144_ch_2_current, el3144_ch_2_state_as_int16))
-                print('EL3144: Ch 3 PDO: {:#06x}; Current: {:.6}; State: {:#06x}'.format(el3144_ch_3_current_as_int16, el3144_ch_3_current, el3144_ch_3_state_as_int16))
-                print('EL3144: Ch 4 PDO: {:#06x}; Current: {:.6}; State: {:#06x}'.format(el3144_ch_4_current_as_int16, el3144_ch_4_current, el3144_ch_4_state_as_int16))
-
-                print('**********')
-
-                el1872_ch_all_as_bytes = self._master.slaves[6].input
-                el1872_ch_all_as_int16 = struct.unpack('H', el1872_ch_all_as_bytes)[0]
-                print('EL1872: {:#06x} - {:#018b}'.format(el1872_ch_all_as_int16, el1872_ch_all_as_int16))
+                # Read all INPUTs into the process image and decode all signals at once
+                # (the decode is skipped if no terminal delivered new inputs)
+                image.refresh_changed()
+                values = signal_map.decode_inputs(skip_unchanged=True)
 
-                print('===========================================================================================')
+                # EL3144 - 4 Channels, je 16 Bit Analog Value und 16 Bit Status
+                # 16 Bit Status: TxPDO Toggle toggelt zwischen jedem gelesenen Analog-Wert
+                log('EL3144: {}'.format(el3144_inputs.tobytes().hex()))
+                analog.update(values)
+                for ch, i in enumerate(el3144_channels):
+                    log('EL3144: Ch {} PDO: {:#06x}; Current: {:.6}; Average: {:.6}; Valid: {:d}; Stale: {:d}'.format(
+                        ch + 1, int(analog.raw[i]) & 0xFFFF, analog.scaled[i], analog.average[i], analog.valid[i], analog.stale[i]))
+                    if analog.underrange[i] or analog.overrange[i] or analog.error[i]:
+                        log('WARNING : EL3144 Ch {}: underrange {:d}, overrange {:d}, error {:d}'.format(
+                            ch + 1, analog.underrange[i], analog.overrange[i], analog.error[i]))
+
+                # Result of the read requested in the previous iteration (if already there), then request the next one
+                if el3144_missed_counter is not None and el3144_missed_counter.done():
+                    try:
+                        log('EL3144: SM event missed counter: {}'.format(
+                            missed_counter_codec.decode(el3144_missed_counter.result())))
+                    except (pysoem.SdoError, pysoem.MailboxError, pysoem.WkcError, pysoem.PacketError) as expt:
+                        log('WARNING : EL3144 SDO read failed: {}'.format(expt))
+                el3144_missed_counter = self._sdo_worker.read(3, 0x1C33, 0x0B)
+
+                log('**********')
+
+                el1872_ch_all_as_int16 = int(values[el1872_index])
+                log('EL1872: {:#06x} - {:#018b}'.format(el1872_ch_all_as_int16, el1872_ch_all_as_int16))
+
+                log('===========================================================================================')
 
                 # Invert value of toggle
                 toggle ^= True
@@ -229,8 +384,8 @@ class ThreadingExample:
 
         except KeyboardInterrupt:
             # Ctrl-C to abort handling
-            print('PDO_Update_Loop stopped')
-            print('===========================================================================================')
+            log('PDO_Update_Loop stopped')
+            log('===========================================================================================')
 
     # Run method of class > called from main()
     def run(self):
@@ -238,6 +393,7 @@ class ThreadingExample:
         print('===========================================================================================')
 
         # Start EtherCAT MASTER
+        start_time = time.monotonic()
         self._master.open(self._ifname)
         print("EtherCAT master created and started ...")
         print('===========================================================================================')
@@ -258,10 +414,68 @@ class ThreadingExample:
             slave.config_func = self._expected_slave_layout[i].config_func
             slave.is_lost = False
 
-        # ToDo: Add PDO config here ????
+        # Configure all slaves with a profile concurrently (instead of one config_func after the other in config_map)
+        profiles = self.CONFIG_PROFILES
+        if self._dc_controller is not None:
+            # Distributed clocks: SYNC0 with the period of the processdata thread instead of the profile value
+            if self._master.config_dc():
+                profiles = {product_code: profile._replace(dc_sync=(self._cycle_timer.period_ns,))
+                            if profile.dc_sync is not None else profile for product_code, profile in profiles.items()}
+            else:
+                print('WARNING : No slaves with DC found, processdata thread runs without DC')
+                self._dc_controller = None
+                self._stats.dc_controller = None
+        # Snapshot of an earlier start with the same slave chain (vendor / product / revision per position),
+        # the same configuration (PDO mapping) and the same signal aliases
+        config = config_digest(profiles, self.SIGNAL_ALIASES)
+        snapshot = None
+        if self._snapshot_dir is not None:
+            snapshot = StartupSnapshot.load(topology_fingerprint(self._master.slaves), self._snapshot_dir, config)
+        engine = ProfileEngine(profiles)
+        results = engine.apply(self._master.slaves)
+        for result in results:
+            for write, exc in result.errors:
+                print('ERROR : Slave {} SDO write {:#06x}:{:02x} failed: {}'.format(result.slave, write.index, write.subindex, exc))
+        print('Configured {} slaves ({} SDO writes)'.format(len(results), sum(result.written for result in results)))
 
         # Build IOMap > should bring all slaves to SAFEOP_STATE
         self._master.config_map()
+        # Reapply the profiles when the supervisor reconfigures a slave
+        engine.install(self._master.slaves)
+        self._process_image = ProcessImage(self._master.slaves)
+        if snapshot is not None and snapshot.matches(self._master.slaves, config):
+            # Warm start: same chain and IO map, reuse the signal map
+            self._signal_map = snapshot.signal_map(self._process_image)
+            print('Warm start: reusing startup snapshot {}'.format(snapshot.fingerprint))
+        else:
+            # Read the PDO mapping once and compile offset / mask / scale tables for all signals
+            self._signal_map = compile_signal_map(self._process_image, self._master.slaves, self.SIGNAL_ALIASES)
+            if self._snapshot_dir is not None:
+                StartupSnapshot.capture(self._master.slaves, self._signal_map, config).save(self._snapshot_dir)
+        if (self._shm_name is not None or self._record_dir is not None or self._pd_groups is not None or
+                self.pipeline.stages):
+            self._cycle_image = ProcessImage(self._master.slaves)
+            self._posted_outputs = bytearray(len(self._cycle_image.outputs))
+        if self._pd_groups is not None:
+            self._group_scheduler = GroupScheduler(self._master, self._cycle_image, self._pd_groups,
+                                                   self._cycle_timer.period_ns, on_fault=self._group_fault)
+        if self.pipeline.stages:
+            # Decode the inputs before and commit the outputs after the application stages
+            # (with process data groups the outputs are committed by the group exchange)
+            self.cycle_signals = self._signal_map.bind(self._cycle_image)
+            self.cycle_values = self.cycle_signals.values
+            self.pipeline.add_stage('decode inputs', lambda cycle: self.cycle_signals.decode_inputs(skip_unchanged=True),
+                                    100, INPUT)
+            if self._group_scheduler is None:
+                self.pipeline.add_stage('commit outputs', lambda cycle: self._cycle_image.commit_changed(), 100, OUTPUT)
+        if self._shm_name is not None:
+            self._shm = ShmProcessImage.create(self._shm_name, len(self._cycle_image.inputs), len(self._cycle_image.outputs))
+        if self._record_dir is not None:
+            self._recorder = ProcessDataRecorder(self._record_dir, len(self._cycle_image.inputs), len(self._cycle_image.outputs))
+            self._recorded_outputs = bytearray(len(self._cycle_image.outputs))
+            self._recorder.start()
+        if self._metrics_port is not None:
+            self._metrics_server = self._stats.serve(self._metrics_port)
 
         # Check if all slaves reached SAFEOP_STATE
         if self._master.state_check(pysoem.SAFEOP_STATE, 50000) != pysoem.SAFEOP_STATE:
@@ -275,9 +489,10 @@ class ThreadingExample:
         # Prepare transistion to OP_STATE (NO TRANSISTION YET, seperate threads will be started first)
         self._master.state = pysoem.OP_STATE
 
-        # Start Check_Thread
-        check_thread = threading.Thread(target=self._check_thread)
-        check_thread.start()
+        # Start event log, slave supervisor and SDO worker
+        self._events.start()
+        self._supervisor.start()
+        self._sdo_worker.start()
         # Start ProcessData_Thread
         proc_thread = threading.Thread(target=self._processdata_thread)
         proc_thread.start()
@@ -294,12 +509,16 @@ class ThreadingExample:
             self._master.state_check(pysoem.OP_STATE, 50000)
             if self._master.state == pysoem.OP_STATE:
                 all_slaves_reached_op_state = True
-                print('SYSTEM reached OP_STATE')
+                print('SYSTEM reached OP_STATE ({:.1f} ms after start)'.format((time.monotonic() - start_time) * 1000))
                 print('===========================================================================================')
                 break
 
-        # If system reached OP_STATE, start PDO_Update_Loop
+        # If system reached OP_STATE, start topology monitor and PDO_Update_Loop
+        # (the layout check above only runs at start-up, the monitor recovers a re-plugged segment in OP)
         if all_slaves_reached_op_state:
+            self._topology_monitor = TopologyMonitor(self._master, log=self._events.message,
+                                                     recovery_lock=self._supervisor.recovery_lock)
+            self._topology_monitor.start()
             self._pdo_update_loop()
 
         # Shutdown
@@ -309,11 +528,32 @@ class ThreadingExample:
         # After stopping PDO_Update_Loop with Ctrl+C, system will be shutdown by stopping seperate threads 
         # and transistioning to INIT_STATE
         self._pd_thread_stop_event.set()
-        self._ch_thread_stop_event.set()
-        # Blocking wait for threads to terminate after setting stop_event for both threads
-        # stop_event IS_SET stops while loops in threads
+        self._supervisor.stop()
+        self._sdo_worker.stop()
+        if self._topology_monitor is not None:
+            self._topology_monitor.stop()
+        # Blocking wait for thread to terminate after setting stop_event
+        # stop_event IS_SET stops while loop in thread
         proc_thread.join()
-        check_thread.join()
+        # Write the remaining events before the statistics
+        self._events.stop()
+        print('Cycle statistics: {}'.format(self._stats.snapshot()))
+        print('Event log: {}'.format(self._events.stats()))
+        if self._group_scheduler is not None:
+            for group in self._group_scheduler.stats():
+                print('Group {}: {} exchanges, {} faults'.format(group.name, group.exchanges, group.faults))
+        for stage in self.pipeline.stats():
+            print('Stage {}: {} runs, every {} cycles, {} over budget, max {:.0f} us{}'.format(
+                stage.name, stage.runs, stage.every, stage.overruns, stage.max_us, ', disabled after an error' if stage.disabled else ''))
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+        if self._shm is not None:
+            self._shm.close()
+        if self._recorder is not None:
+            self._recorder.stop()
+            print('Recorded {} chunks to {} ({} cycles dropped)'.format(self._recorder.chunks_written, self._recorder.path,
+                                                                       self._recorder.dropped))
 
         # Request INIT state for all slaves
         self._master.state = pysoem.INIT_STATE
@@ -341,11 +581,30 @@ if __name__ == '__main__':
     print('Threading example started')
 
     if len(sys.argv) > 1:
+        ifname = sys.argv[1]
+        if ifname == 'auto':
+            # The adapter whose chain has the expected layout, out of the candidate adapters given after "auto"
+            # (only ports reserved for EtherCAT: probing resets the chain on a port). Probed once, then cached
+            # per host; the cached adapter is checked again before it is used.
+            if len(sys.argv) < 3:
+                print('Usage: separate_thread auto ifname [ifname ...]')
+                sys.exit(1)
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'network_adapters'))
+            from adapter_discovery import AdapterDiscoveryError, find_ethercat_adapter
+            try:
+                ifname = find_ethercat_adapter([ThreadingExample.EK1100_PRODUCT_CODE, ThreadingExample.EL4008_PRODUCT_CODE,
+                                                ThreadingExample.EL4114_PRODUCT_CODE, ThreadingExample.EL3144_PRODUCT_CODE,
+                                                ThreadingExample.EL2624_PRODUCT_CODE, ThreadingExample.EL2872_PRODUCT_CODE,
+                                                ThreadingExample.EL1872_PRODUCT_CODE], sys.argv[2:])
+            except AdapterDiscoveryError as expt:
+                print('Threading example failed: ' + expt.message)
+                sys.exit(1)
+            print('Using adapter {}'.format(ifname))
         try:
-            ThreadingExample(sys.argv[1]).run()
+            ThreadingExample(ifname).run()
         except ThreadingExampleError as expt:
             print('Threading example failed: ' + expt.message)
             sys.exit(1)
     else:
-        print('Usage: separate_thread ifname')
+        print('Usage: separate_thread ifname|auto ifname [ifname ...]')
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""Process image in shared memory for consumers in other processes (seqlock protected)"""
+
+import multiprocessing
+import struct
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+
+# Segment layout:
+#   0: magic, input size, output size
+#  16: input sequence, cycle, wkc, timestamp [ns]
+#  48: output sequence
+#  64: inputs, then outputs
+# A sequence number is odd while its area is written. Readers copy the area and retry if the
+# sequence was odd or changed meanwhile, so neither side ever waits for a lock held by the other.
+_MAGIC = 0x45434950  # 'ECIP'
+_LAYOUT = struct.Struct('<III')
+_INPUT_HEADER = struct.Struct('<QQqq')
+_SEQ = struct.Struct('<Q')
+_INPUT_HEADER_OFFSET = 16
+_OUTPUT_SEQ_OFFSET = 48
+_DATA_OFFSET = 64
+
+
+class ShmProcessImage:
+
+    # Constructor - use ShmProcessImage.create() in the cycle process and ShmProcessImage.attach() in consumers
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        self._buf = shm.buf
+        magic, self.input_size, self.output_size = _LAYOUT.unpack_from(self._buf, 0)
+        if magic != _MAGIC:
+            raise ValueError('{} is not a process image segment'.format(shm.name))
+        self._in_start = _DATA_OFFSET
+        self._out_start = _DATA_OFFSET + self.input_size
+        self._in_seq = 0
+        self._last_out_seq = 0
+        # Outputs are copied here first and only taken after the sequence check (no torn data in out)
+        self._out_scratch = bytearray(self.output_size)
+        self.retries = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    # Create the segment (cycle process)
+    @classmethod
+    def create(cls, name, input_size, output_size):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_DATA_OFFSET + input_size + output_size)
+        shm.buf[:_DATA_OFFSET] = bytes(_DATA_OFFSET)
+        _LAYOUT.pack_into(shm.buf, 0, _MAGIC, input_size, output_size)
+        return cls(shm, True)
+
+    # Attach to an existing segment (consumer process)
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # The segment belongs to the cycle process, the resource tracker of an independent consumer
+        # process must not unlink it at exit (children of the cycle process share its tracker)
+        if multiprocessing.parent_process() is None:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm, False)
+
+    def close(self):
+        self._buf.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    # --- cycle process side ---
+
+    # Publish the inputs of one cycle (data: bytes-like of input_size bytes)
+    def publish_inputs(self, data, cycle, wkc, timestamp_ns):
+        buf = self._buf
+        seq = self._in_seq + 1
+        # Metadata and data while the sequence is odd, the even sequence is stored last on its own
+        _SEQ.pack_into(buf, _INPUT_HEADER_OFFSET, seq)
+        _INPUT_HEADER.pack_into(buf, _INPUT_HEADER_OFFSET, seq, cycle, wkc, timestamp_ns)
+        buf[self._in_start:self._out_start] = data
+        _SEQ.pack_into(buf, _INPUT_HEADER_OFFSET, seq + 1)
+        self._in_seq = seq + 1
+
+    # Copy the outputs into the bytearray out if a consumer wrote new ones since the last call.
+    # Returns False (out unchanged) if there is nothing new or a write is in progress.
+    def take_outputs(self, out):
+        buf = self._buf
+        seq = _SEQ.unpack_from(buf, _OUTPUT_SEQ_OFFSET)[0]
+        if seq == self._last_out_seq or seq & 1:
+            return False
+        scratch = self._out_scratch
+        scratch[:] = buf[self._out_start:self._out_start + self.output_size]
+        if _SEQ.unpack_from(buf, _OUTPUT_SEQ_OFFSET)[0] != seq:
+            self.retries += 1
+            return False
+        out[:] = scratch
+        self._last_out_seq = seq
+        return True
+
+    # --- consumer side ---
+
+    # Copy a consistent snapshot of the inputs into the bytearray out, returns (cycle, wkc, timestamp_ns)
+    def read_inputs(self, out):
+        buf = self._buf
+        while True:
+            seq = _SEQ.unpack_from(buf, _INPUT_HEADER_OFFSET)[0]
+            if not seq & 1:
+                out[:] = buf[self._in_start:self._out_start]
+                seq_after, cycle, wkc, timestamp_ns = _INPUT_HEADER.unpack_from(buf, _INPUT_HEADER_OFFSET)
+                if seq_after == seq:
+                    return cycle, wkc, timestamp_ns
+            self.retries += 1
+
+    # Write new outputs (single writer per segment), picked up by the next cycle
+    def write_outputs(self, data):
+        buf = self._buf
+        seq = _SEQ.unpack_from(buf, _OUTPUT_SEQ_OFFSET)[0] | 1
+        _SEQ.pack_into(buf, _OUTPUT_SEQ_OFFSET, seq)
+        buf[self._out_start:self._out_start + self.output_size] = data
+        _SEQ.pack_into(buf, _OUTPUT_SEQ_OFFSET, seq + 1)
+
+
+# Reader process of the benchmark
+def _benchmark_reader(name, duration, results):
+    image = ShmProcessImage.attach(name)
+    inputs = bytearray(image.input_size)
+    reads = 0
+    torn = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        cycle, wkc, timestamp_ns = image.read_inputs(inputs)
+        # Every published image is filled with one value, a mix would be a torn read
+        if inputs.count(inputs[0]) != len(inputs):
+            torn += 1
+        reads += 1
+    results.put((reads, image.retries, torn))
+    image.close()
+
+
+# Writer / reader throughput with the process image of the fake master (no NIC required)
+if __name__ == '__main__':
+
+    import os
+
+    from fake_master import FakeMaster
+    from process_image import ProcessImage
+
+    duration = 2.0
+
+    master = FakeMaster()
+    master.config_init()
+    master.config_map()
+    process_image = ProcessImage(master.slaves)
+
+    name = 'ecat_pi_{}'.format(os.getpid())
+    image = ShmProcessImage.create(name, len(process_image.inputs), len(process_image.outputs))
+    results = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=_benchmark_reader, args=(name, duration, results))
+    reader.start()
+
+    writes = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        process_image.inputs[:] = bytes([writes & 0xFF]) * len(process_image.inputs)
+        image.publish_inputs(process_image.inputs, writes, master.expected_wkc, time.monotonic_ns())
+        image.take_outputs(process_image.outputs)
+        writes += 1
+    reads, retries, torn = results.get()
+    reader.join()
+    image.close()
+    print('writer: {:.0f} publishes/s ({:.2f} us each)'.format(writes / duration, duration / writes * 1e6))
+    print('reader: {:.0f} snapshots/s, {} retries, {} torn snapshots'.format(reads / duration, retries, torn))
@@ -0,0 +1,364 @@
+"""PDO signal map compiled from the RxPDO / TxPDO mapping objects of the slaves"""
+
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+import pysoem
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+from od_index import INTEGER_TYPES, REAL32, REAL64, ODIndex
+
+
+# CoE data types (ETG.1000.6) that are decoded as signed integers
+SIGNED_TYPES = frozenset(data_type for data_type, signed in INTEGER_TYPES.items() if signed)
+
+# Widest signal in the vectorized decode (gathered as one uint64 at any bit offset, sign extended in int64).
+# Wider signals (e.g. INTEGER64 / UNSIGNED64 / REAL64) are decoded one by one as Python ints; in the
+# float64 value array they are exact up to 2 ** 53.
+VECTOR_BITS = 32
+
+# PDO assign objects of sync manager 2 (outputs) and 3 (inputs)
+RXPDO_ASSIGN = 0x1C12
+TXPDO_ASSIGN = 0x1C13
+
+# Errors that mean the slave has no (readable) CoE PDO mapping
+_NO_MAPPING_ERRORS = (pysoem.SdoError, pysoem.MailboxError, pysoem.WkcError, pysoem.PacketError)
+
+
+# One mapped PDO entry of a slave
+class Signal:
+
+    __slots__ = ('name', 'slave_pos', 'is_input', 'bit_offset', 'bit_length', 'data_type', 'scale')
+
+    # Constructor - bit_offset is relative to the start of the input or output image
+    def __init__(self, name, slave_pos, is_input, bit_offset, bit_length, data_type=0, scale=1.0):
+        self.name = name
+        self.slave_pos = slave_pos
+        self.is_input = is_input
+        self.bit_offset = bit_offset
+        self.bit_length = bit_length
+        self.data_type = data_type
+        self.scale = scale
+
+
+# Lookup table of all signals of a process image.
+# Every signal is reduced to (byte offset, shift, mask, sign, scale), so a single signal is read
+# by name in O(1) and all input signals are decoded at once with a few vectorized NumPy operations.
+class SignalMap:
+
+    # Constructor
+    # image: process_image.ProcessImage the bit offsets refer to
+    # names: additional names {name: position in signals}
+    def __init__(self, image, signals, names=None):
+        self._image = image
+        self.signals = signals
+        self._by_name = dict(names or {})
+        self._scalar = []
+        for i, signal in enumerate(signals):
+            self._by_name[signal.name] = i
+            self._scalar.append(self._scalar_entry(signal))
+
+        # Vectorized tables (input signals only)
+        self._inputs = [i for i, signal in enumerate(signals) if signal.is_input]
+        self._input_pos = {i: n for n, i in enumerate(self._inputs)}
+        n = len(self._inputs)
+        inputs = [signals[i] for i in self._inputs]
+        byte_offset = np.array([signal.bit_offset >> 3 for signal in inputs], dtype=np.intp)
+        self._gather = byte_offset[:, None] + np.arange(8, dtype=np.intp)
+        self._shift = np.array([signal.bit_offset & 7 for signal in inputs], dtype=np.uint64)
+        # (mask 0 and no sign extension for the signals wider than VECTOR_BITS, see _wide)
+        self._mask = np.array([(1 << signal.bit_length) - 1 if signal.bit_length <= VECTOR_BITS else 0
+                               for signal in inputs], dtype=np.uint64)
+        self._sign_shift = np.array([max(signal.bit_length - 1, 0) for signal in inputs], dtype=np.int64)
+        self._sign_flag = np.array([signal.data_type in SIGNED_TYPES and signal.bit_length <= VECTOR_BITS
+                                    for signal in inputs], dtype=np.int64)
+        self._bits = np.array([signal.bit_length for signal in inputs], dtype=np.int64)
+        self._scale = np.array([signal.scale for signal in inputs], dtype=np.float64)
+        self._real32 = np.flatnonzero([signal.data_type == REAL32 and signal.bit_length == 32 for signal in inputs])
+        # Signals wider than VECTOR_BITS: (position in values, scalar entry)
+        self._wide = [(n, self._scalar[i]) for n, i in enumerate(self._inputs)
+                      if signals[i].bit_length > VECTOR_BITS]
+        # Preallocated work buffers (8 bytes of padding so every signal can be gathered as one uint64)
+        self._padded = np.zeros(len(image.inputs) + 8, dtype=np.uint8)
+        self._gathered = np.zeros((n, 8), dtype=np.uint8)
+        self._raw = np.zeros(n, dtype=np.uint64)
+        self._sign = np.zeros(n, dtype=np.int64)
+        self.values = np.zeros(n, dtype=np.float64)
+        # input_generation of the image at the last decode
+        self._generation = -1
+
+    # Same signals on another process image of the same slaves (e.g. the image of the processdata thread)
+    def bind(self, image):
+        return SignalMap(image, self.signals, self._by_name)
+
+    # Precomputed tuple for reading / writing a single signal
+    # (real: struct format of a REAL32 / REAL64 signal, None for integers)
+    @staticmethod
+    def _scalar_entry(signal):
+        first = signal.bit_offset >> 3
+        last = (signal.bit_offset + signal.bit_length - 1) >> 3
+        signed_bits = signal.bit_length if signal.data_type in SIGNED_TYPES else 0
+        if signal.data_type == REAL32 and signal.bit_length == 32:
+            real = '<f'
+        elif signal.data_type == REAL64 and signal.bit_length == 64:
+            real = '<d'
+        else:
+            real = None
+        return (signal.is_input, first, last + 1, signal.bit_offset & 7, (1 << signal.bit_length) - 1,
+                signed_bits, signal.scale, real)
+
+    # Value of a signal in buffer (any width)
+    @staticmethod
+    def _scalar_value(entry, buffer):
+        is_input, first, end, shift, mask, signed_bits, scale, real = entry
+        raw = (int.from_bytes(buffer[first:end], 'little') >> shift) & mask
+        if real is not None:
+            return struct.unpack(real, raw.to_bytes(struct.calcsize(real), 'little'))[0] * scale
+        if signed_bits and raw >> (signed_bits - 1):
+            raw -= 1 << signed_bits
+        return raw * scale
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __len__(self):
+        return len(self.signals)
+
+    # All names (including alternative names of the same signal)
+    def names(self):
+        return list(self._by_name)
+
+    # Position of a signal in self.signals
+    def index(self, name):
+        return self._by_name[name]
+
+    # Position of an input signal in the array returned by decode_inputs()
+    def input_index(self, name):
+        return self._input_pos[self._by_name[name]]
+
+    # Current (scaled) value of one signal
+    def __getitem__(self, name):
+        entry = self._scalar[self._by_name[name]]
+        return self._scalar_value(entry, self._image.inputs if entry[0] else self._image.outputs)
+
+    # Write one output signal (value is divided by the signal's scale)
+    def __setitem__(self, name, value):
+        is_input, first, end, shift, mask, signed_bits, scale, real = self._scalar[self._by_name[name]]
+        if is_input:
+            raise KeyError('{} is an input signal'.format(name))
+        if real is not None:
+            raw = int.from_bytes(struct.pack(real, value / scale), 'little')
+        else:
+            raw = int(round(value / scale)) & mask
+        buffer = self._image.outputs
+        word = int.from_bytes(buffer[first:end], 'little')
+        word = (word & ~(mask << shift)) | (raw << shift)
+        buffer[first:end] = word.to_bytes(end - first, 'little')
+
+    # Decode all input signals of the current input image, returns the preallocated value array
+    # skip_unchanged: return the values of the last decode if the image has no new inputs since then
+    def decode_inputs(self, skip_unchanged=False):
+        if skip_unchanged and self._generation == self._image.input_generation:
+            return self.values
+        self._generation = self._image.input_generation
+        inputs = self._image.inputs
+        self._padded[:len(inputs)] = np.frombuffer(inputs, dtype=np.uint8)
+        np.take(self._padded, self._gather, out=self._gathered)
+        raw = self._raw
+        raw[:] = self._gathered.view('<u8')[:, 0]
+        np.right_shift(raw, self._shift, out=raw)
+        np.bitwise_and(raw, self._mask, out=raw)
+        # Sign extension (the tables only hold signals <= VECTOR_BITS, so the int64 view is safe)
+        signed = raw.view(np.int64)
+        np.right_shift(signed, self._sign_shift, out=self._sign)
+        np.bitwise_and(self._sign, self._sign_flag, out=self._sign)
+        np.left_shift(self._sign, self._bits, out=self._sign)
+        np.subtract(signed, self._sign, out=signed)
+        np.multiply(signed, self._scale, out=self.values)
+        if len(self._real32):
+            self.values[self._real32] = raw[self._real32].astype(np.uint32).view(np.float32) * self._scale[self._real32]
+        for n, entry in self._wide:
+            self.values[n] = self._scalar_value(entry, inputs)
+        return self.values
+
+    # Decode the input signals of many input images at once (rows of a 2D uint8 array, e.g. a recording)
+    # Returns an array of shape (rows, input signals)
+    def decode_inputs_batch(self, inputs):
+        inputs = np.asarray(inputs, dtype=np.uint8)
+        padded = np.zeros((inputs.shape[0], len(self._image.inputs) + 8), dtype=np.uint8)
+        padded[:, :inputs.shape[1]] = inputs
+        raw = np.ascontiguousarray(padded[:, self._gather]).view('<u8')[..., 0]
+        raw = (raw >> self._shift) & self._mask
+        signed = raw.view(np.int64)
+        sign = ((signed >> self._sign_shift) & self._sign_flag) << self._bits
+        values = (signed - sign) * self._scale
+        if len(self._real32):
+            values[:, self._real32] = raw[:, self._real32].astype(np.uint32).view(np.float32) * self._scale[self._real32]
+        for n, entry in self._wide:
+            for row in range(inputs.shape[0]):
+                values[row, n] = self._scalar_value(entry, inputs[row].tobytes())
+        return values
+
+
+# Read the PDO entries (index, subindex, bit length) assigned to a sync manager
+def read_pdo_assignment(slave, assign_index):
+    entries = []
+    n_pdos = slave.sdo_read(assign_index, 0)[0]
+    for i in range(1, n_pdos + 1):
+        pdo_index = struct.unpack('<H', slave.sdo_read(assign_index, i)[:2])[0]
+        n_entries = slave.sdo_read(pdo_index, 0)[0]
+        for j in range(1, n_entries + 1):
+            mapping = struct.unpack('<I', slave.sdo_read(pdo_index, j)[:4])[0]
+            entries.append((mapping >> 16, (mapping >> 8) & 0xFF, mapping & 0xFF))
+    return entries
+
+
+# Lower case name without special characters, e.g. "TxPDO Toggle" -> "txpdo_toggle"
+def _normalize(name):
+    return re.sub(r'[^0-9a-z]+', '_', name.lower()).strip('_')
+
+
+# ODIndex of the object entries (names and data types) - empty without SDO info
+def _entry_info(slave):
+    try:
+        return ODIndex(slave.od)
+    except pysoem.SdoInfoError:
+        return ODIndex(())
+
+
+# Signal names of one PDO entry: "<slave>.<index>:<subindex>" and, for the channel based
+# objects 0x6000 / 0x7000 (channel n at 0x10 * (n - 1)), "<slave>.ch<n>.<entry name>"
+def _signal_names(prefix, index, subindex, info):
+    names = ['{}.{:04x}:{:02x}'.format(prefix, index, subindex)]
+    entry = info.get((index, subindex))
+    if entry is not None and (index & 0xE000) == 0x6000:
+        names.insert(0, '{}.ch{}.{}'.format(prefix, ((index & 0x0FF0) >> 4) + 1, _normalize(entry.name)))
+    return names
+
+
+# Build the signal map of all slaves of a process image
+# aliases: {alias: (signal name, scale)} - declarative application names, e.g.
+#          {'EL3144.ch1.current': ('EL3144.ch1.value', 10 / 0x8000)}
+def compile_signal_map(image, slaves, aliases=None):
+    counts = {}
+    for slave in slaves:
+        counts[slave.name] = counts.get(slave.name, 0) + 1
+
+    signals = []
+    names = {}
+    for pos, slave in enumerate(slaves):
+        # Terminals with the same name get the position as suffix
+        prefix = slave.name if counts[slave.name] == 1 else '{}_{}'.format(slave.name, pos)
+        info = None
+        for is_input, assign_index, size, base in ((False, RXPDO_ASSIGN, len(slave.output), image.output_offset(pos)),
+                                                   (True, TXPDO_ASSIGN, len(slave.input), image.input_offset(pos))):
+            if size == 0:
+                continue
+            try:
+                entries = read_pdo_assignment(slave, assign_index)
+            except _NO_MAPPING_ERRORS:
+                entries = None
+            if entries is not None and sum(entry[2] for entry in entries) > 8 * size:
+                entries = None
+            if entries is None:
+                # No CoE mapping: one signal for the whole image part (up to 32 bit) plus one per bit
+                word = 'inputs' if is_input else 'outputs'
+                if size <= 4:
+                    signals.append(Signal('{}.{}'.format(prefix, word), pos, is_input, 8 * base, 8 * size))
+                for bit in range(8 * size):
+                    signals.append(Signal('{}.ch{}'.format(prefix, bit + 1), pos, is_input, 8 * base + bit, 1))
+                continue
+            if info is None:
+                info = _entry_info(slave)
+            bit_offset = 8 * base
+            for index, subindex, bit_length in entries:
+                # Index 0 is padding
+                if index != 0:
+                    entry = info.get((index, subindex))
+                    data_type = entry.data_type if entry is not None else 0
+                    entry_names = _signal_names(prefix, index, subindex, info)
+                    for name in entry_names[1:]:
+                        names[name] = len(signals)
+                    signals.append(Signal(entry_names[0], pos, is_input, bit_offset, bit_length, data_type))
+                bit_offset += bit_length
+
+    for signal_pos, signal in enumerate(signals):
+        names[signal.name] = signal_pos
+    for alias, (name, scale) in (aliases or {}).items():
+        if name not in names:
+            raise SignalMapError('Alias {} refers to the unknown signal {}'.format(alias, name))
+        target = signals[names[name]]
+        if scale == 1:
+            names[alias] = names[name]
+        else:
+            signals.append(Signal(alias, target.slave_pos, target.is_input, target.bit_offset,
+                                  target.bit_length, target.data_type, target.scale * scale))
+
+    return SignalMap(image, signals, names)
+
+
+# Separate class for errors
+class SignalMapError(Exception):
+    def __init__(self, message):
+        super(SignalMapError, self).__init__(message)
+        self.message = message
+
+
+# Benchmark: per signal struct decoding vs. vectorized decoding of the whole input image (fake slaves, no NIC)
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    from fake_master import FakeMaster
+    from process_image import ProcessImage
+
+    n_el3144 = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    n_cycles = 2000
+
+    layout = [('EK1100', 0x044c2c52, 0, 0)] + [('EL3144', 0x0C483052, 16, 0)] * n_el3144
+    master = FakeMaster(layout)
+    master.config_init()
+    master.config_map()
+    image = ProcessImage(master.slaves)
+    aliases = {}
+    for pos in range(1, n_el3144 + 1):
+        for ch in range(1, 5):
+            aliases['EL3144_{}.ch{}.current'.format(pos, ch)] = ('EL3144_{}.ch{}.value'.format(pos, ch), 10 / 0x8000)
+    signal_map = compile_signal_map(image, master.slaves, aliases)
+    print('{} terminals, {} signals'.format(n_el3144, len(signal_map)))
+
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        for slave in master.slaves[1:]:
+            values = struct.unpack('8h', slave.input)
+            currents = [values[2 * ch + 1] * 10 / 0x8000 for ch in range(4)]
+    print('struct per terminal (4 currents / terminal): {:.1f} us/cycle'.format((time.perf_counter() - start) / n_cycles * 1e6))
+
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        image.refresh()
+    refresh_time = (time.perf_counter() - start) / n_cycles
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        signal_map.decode_inputs()
+    decode_time = (time.perf_counter() - start) / n_cycles
+    print('signal map (all {} signals): {:.1f} us/cycle (refresh {:.1f} us + decode {:.1f} us, {:.1f} ns/signal)'.format(
+        len(signal_map), (refresh_time + decode_time) * 1e6, refresh_time * 1e6, decode_time * 1e6,
+        decode_time / len(signal_map) * 1e9))
+
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        signal_map['EL3144_1.ch1.current']
+    print('single signal by name: {:.2f} us'.format((time.perf_counter() - start) / n_cycles * 1e6))
+
+    # Signed integers wider than VECTOR_BITS: a negative INTEGER48 (0x0013) in the first input bytes
+    int48_map = SignalMap(image, [Signal('int48', 1, True, 0, 48, 0x0013)])
+    image.inputs[:6] = (-123456789012).to_bytes(6, 'little', signed=True)
+    int48 = (int48_map['int48'], int48_map.decode_inputs()[0])
+    print('INTEGER48 -123456789012 decoded as {:.0f} / {:.0f}'.format(*int48))
+    if int48 != (-123456789012, -123456789012):
+        sys.exit(1)
@@ -0,0 +1,222 @@
+"""Topology monitor: detects removed, replaced and added slaves in OP and recovers only the affected segment"""
+
+import threading
+import time
+
+from collections import namedtuple
+
+import pysoem
+
+
+# Slaves that start a segment (the coupler and its terminals are plugged / unplugged together)
+EK1100_PRODUCT_CODE = 0x044c2c52
+COUPLER_PRODUCT_CODES = frozenset([EK1100_PRODUCT_CODE])
+
+# ESC DL status register: communication on port 1 (a device is connected behind the slave)
+DL_STATUS = 0x0110
+DL_STATUS_COM_PORT1 = 0x0800
+
+# Timeout of one state check while waiting for OP after a recovery [us] (state_check holds the GIL)
+STATE_POLL_US = 2000
+
+# One detected change
+# kind: 'removed' (slaves do not answer), 'restored' (same slaves back and in OP again),
+#       'replaced' (another terminal at the position), 'added' (new slave behind the last one)
+# positions: affected slave positions, segment: positions of the segment (empty for 'added')
+# restart_required: the IO map has to be rebuilt (config_init / config_map) to include the change
+TopologyChange = namedtuple('TopologyChange', 'kind positions segment restart_required')
+
+
+# Segments of the chain: a new segment starts at every coupler
+def segments(slaves, coupler_ids=COUPLER_PRODUCT_CODES):
+    result = []
+    for pos, slave in enumerate(slaves):
+        if not result or slave.id in coupler_ids:
+            result.append([])
+        result[-1].append(pos)
+    return [tuple(segment) for segment in result]
+
+
+# Watches the configured chain while the processdata thread keeps cycling (no config_init):
+# - every interval_s one broadcast state read (read_state, single slave reads only if the states differ)
+# - slaves that do not answer at their configured address (state NONE, e.g. a re-plugged coupler) are
+#   reported per segment and recovered segment by segment: recover() (SOEM compares vendor / product /
+#   revision at the position before it reassigns the address), reconfig() (config_func, PDO mapping into
+#   the unchanged IO map) and OP. The other segments are not touched.
+# - a slave whose recover() fails while a slave behind it in the same segment answers again is
+#   physically there, but with another identity: replaced
+# - with the last slave answering, its DL status shows whether something was plugged behind it
+# Replaced and added slaves need a new IO map (restart_required).
+# recover() / reconfig() readdress slaves through SOEM's temporary station address: the monitor holds
+# recovery_lock (the SlaveSupervisor's, shared) for the whole recovery of a segment, so the two never
+# recover at the same time.
+# GIL: pysoem holds it for read_state(), _fprd() and the recovery calls. A scan without changes holds it for
+# one read_state() (one broadcast frame, one frame per slave only if the states differ) and one DL status read.
+# A recovery holds it per recover() / reconfig() call, the wait for OP is split into checks of STATE_POLL_US.
+class TopologyMonitor:
+
+    # Constructor
+    # interval_s: time between two scans
+    # on_change: function called with every TopologyChange (in the monitor thread)
+    # coupler_ids: product codes that start a segment
+    # log: function for messages (default: print)
+    # recovery_lock: lock shared with other code that recovers slaves (e.g. SlaveSupervisor.recovery_lock)
+    # state_timeout_us: time to wait for OP after the recovery of a segment
+    def __init__(self, master, interval_s=1.0, on_change=None, coupler_ids=COUPLER_PRODUCT_CODES, log=print,
+                 recovery_lock=None, state_timeout_us=50000):
+        self._master = master
+        self._recovery_lock = recovery_lock if recovery_lock is not None else threading.Lock()
+        self.state_timeout_us = state_timeout_us
+        self.interval_s = interval_s
+        self._on_change = on_change
+        self._log = log
+        self.segments = segments(master.slaves, coupler_ids)
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Known deviations from the configured chain
+        self.missing = set()
+        self.replaced = set()
+        self.added = False
+        # Statistics
+        self.scans = 0
+        self.changes = []
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._monitor_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _monitor_thread(self):
+        while not self._stop_event.wait(self.interval_s):
+            self.scan()
+
+    # One scan, returns the changes found
+    def scan(self):
+        self.scans += 1
+        master = self._master
+        slaves = master.slaves
+        changes = []
+        master.read_state()
+        missing = set(pos for pos, slave in enumerate(slaves) if slave.state == pysoem.NONE_STATE)
+        for segment in self.segments:
+            lost = [pos for pos in segment if pos in missing]
+            if not lost:
+                continue
+            new = [pos for pos in lost if pos not in self.missing and pos not in self.replaced]
+            if new:
+                changes.append(TopologyChange('removed', tuple(new), segment, False))
+                self.missing.update(new)
+            with self._recovery_lock:
+                changes += self._recover_segment(segment, lost)
+        if not self.added and len(slaves) - 1 not in missing:
+            try:
+                dl_status = int.from_bytes(slaves[-1]._fprd(DL_STATUS, 2), 'little')
+            except pysoem.WkcError:
+                dl_status = 0
+            if dl_status & DL_STATUS_COM_PORT1:
+                self.added = True
+                changes.append(TopologyChange('added', (len(slaves),), (), True))
+        for change in changes:
+            self.changes.append(change)
+            self._log('{} : Slaves {} {}{}'.format('MESSAGE' if change.kind == 'restored' else 'WARNING', change.positions,
+                                                  change.kind, ', restart required' if change.restart_required else ''))
+            if self._on_change is not None:
+                self._on_change(change)
+        return changes
+
+    # State check in steps of STATE_POLL_US until the slave is in OP or state_timeout_us passed
+    def _wait_op(self, slave):
+        deadline = time.monotonic() + self.state_timeout_us / 1e6
+        while True:
+            state = slave.state_check(pysoem.OP_STATE, STATE_POLL_US)
+            if state == pysoem.OP_STATE or time.monotonic() >= deadline:
+                return state
+            time.sleep(0.0005)
+
+    # Recover the lost slaves of one segment in bus order, then bring them back to OP
+    def _recover_segment(self, segment, lost):
+        slaves = self._master.slaves
+        recovered = []
+        failed = []
+        for pos in lost:
+            if pos in self.replaced:
+                continue
+            if slaves[pos].recover():
+                recovered.append(pos)
+            else:
+                failed.append(pos)
+        changes = []
+        # A failed slave in front of a slave that answers (again) is there, but not the configured one
+        answering = [pos for pos in segment if pos not in lost or pos in recovered]
+        replaced = tuple(pos for pos in failed if answering and pos < answering[-1])
+        if replaced:
+            self.replaced.update(replaced)
+            self.missing.difference_update(replaced)
+            changes.append(TopologyChange('replaced', replaced, segment, True))
+        for pos in recovered:
+            slave = slaves[pos]
+            slave.reconfig()
+            slave.state = pysoem.OP_STATE
+            slave.write_state()
+            slave.is_lost = False
+        back = tuple(pos for pos in recovered if self._wait_op(slaves[pos]) == pysoem.OP_STATE)
+        if back and not [pos for pos in lost if pos not in back and pos not in self.replaced]:
+            self.missing.difference_update(back)
+            changes.append(TopologyChange('restored', back, segment, False))
+        return changes
+
+
+# Hot plug while the process data keeps cycling: a segment is unplugged and plugged again, a terminal is
+# replaced by another type, a slave is added at the end (fake slaves, no NIC)
+if __name__ == '__main__':
+
+    from fake_master import DEFAULT_LAYOUT, FakeMaster
+
+    master = FakeMaster(DEFAULT_LAYOUT * 3, access_time_s=0.0002)
+    master.config_init()
+    master.config_map()
+    master.state = pysoem.OP_STATE
+    master.write_state()
+    stop_event = threading.Event()
+    cycles = {'total': 0, 'wkc_ok': 0}
+
+    def cycle_thread():
+        while not stop_event.is_set():
+            master.send_processdata()
+            if master.receive_processdata() == master.expected_wkc:
+                cycles['wkc_ok'] += 1
+            cycles['total'] += 1
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=cycle_thread)
+    thread.start()
+    monitor = TopologyMonitor(master, interval_s=0.05)
+    print('segments: {}'.format(monitor.segments))
+    steps = [('segment 2 unplugged for 0.2 s', lambda: [master.dropout(pos, 0.2) for pos in monitor.segments[1]]),
+             ('slave 16 replaced by another terminal', lambda: master.replace(16)),
+             ('EL1872 plugged behind the last slave', lambda: master.plug('EL1872', 0x07503052, 2, 0))]
+    monitor.start()
+    for label, action in steps:
+        before = len(monitor.changes)
+        scans = monitor.scans
+        start = time.monotonic()
+        action()
+        while len(monitor.changes) == before or monitor.scans < scans + 2:
+            time.sleep(0.01)
+        time.sleep(0.3)
+        print('{}: {} ({:.0f} ms)'.format(label, [(change.kind, change.positions) for change in monitor.changes[before:]],
+                                          (time.monotonic() - start) * 1000))
+    monitor.stop()
+    stop_event.set()
+    thread.join()
+    print('{} cycles during the scans ({} with full WKC), {} scans, {} state reads'.format(
+        cycles['total'], cycles['wkc_ok'], monitor.scans, master.bus_reads))
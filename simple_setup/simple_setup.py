@@ -1,13 +1,22 @@
 """Read from modules"""
 
+import os
 import sys
 import time
-import struct
 import pysoem
 
+# Process image helpers live next to the separate_thread example, the OD cache next to read_sdo_from_slaves
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'separate_thread'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'read_sdo_from_slaves'))
+from process_image import ProcessImage
+from od_cache import ODCache
+from event_log import EventLog
+
 SDO_Info_Check = False
 
-def read_values(ifname):
+# od_cache_dir: optionally keep the object dictionaries of the SDO info check in this directory
+#               (e.g. od_cache.DEFAULT_CACHE_DIR)
+def read_values(ifname, od_cache_dir=None):
 
     # Create EtherCAT master instance
     master = pysoem.Master()
@@ -24,6 +33,9 @@ def read_values(ifname):
         # Read state of all slaves at start-up
         master.read_state()
 
+        # Object dictionaries are only read from the slaves if not cached yet
+        od_cache = ODCache(od_cache_dir)
+
         # Iterate over all slves found
         for slave in master.slaves:
             # Print info on slave
@@ -35,7 +47,7 @@ def read_values(ifname):
             if (SDO_Info_Check):
                 # Check if SDO info is available
                 try:
-                    od = slave.od
+                    od = od_cache.get_od(slave)
                 except pysoem.SdoInfoError:
                     print('\tno SDO info')
                 else:
@@ -137,39 +149,53 @@ def read_values(ifname):
         print('Waiting 3 secs...')
         time.sleep(3)
 
-        for ii in range(50000):
-            print('===========================================================================================')
-            print(ii)
+        # Typed views on the process image instead of struct.pack / slave.input per iteration
+        # (commit_changed() / refresh_changed() only copy the slaves whose data changed)
+        image = ProcessImage(master.slaves)
+        outputs_3 = image.output_view(3, 'H')
+        inputs_4 = image.input_view(4)
+
+        # Console output of the loop goes through the event log (formatted and written by its own thread,
+        # repeated states are only counted)
+        events = EventLog()
+        events.start()
+        states = [slave.state for slave in master.slaves]
+
+        # Stop the writer in any case, it writes the queued events first (Ctrl + C, errors)
+        try:
+            for ii in range(50000):
+                outputs_3[0] = 0xAAAA
+                image.commit_changed()
+                master.send_processdata()
+                actual_wkc = master.receive_processdata(2000)
+                if not actual_wkc == master.expected_wkc:
+                    events.wkc_mismatch(actual_wkc, master.expected_wkc)
+                image.refresh_changed()
+                events.message('{}: outputs {} inputs {}'.format(ii, outputs_3.tobytes().hex(), inputs_4.tobytes().hex()))
+
+                master.read_state()
+                # State transitions of all slaves (AL status code of slaves with error flag)
+                for pos, slave in enumerate(master.slaves):
+                    if slave.state != states[pos]:
+                        events.state_change(pos, states[pos], slave.state)
+                        if slave.state & pysoem.STATE_ERROR:
+                            events.al_status(pos, slave.state, slave.al_status)
+                        states[pos] = slave.state
+
+                time.sleep(1)
             
-            master.slaves[3].output = struct.pack('H', 0xAAAA)
-            master.send_processdata()
-            actual_wkc = master.receive_processdata(2000)
-            if not actual_wkc == master.expected_wkc:
-                print('incorrect wkc')
-            print(master.slaves[3].output.hex())
-            print(master.slaves[4].input.hex())
-
-            master.read_state()
-            # Iterate over all slves found
-            for slave in master.slaves:
-                # Print info on slave
-                print('{}:'.format(slave.name))
-
-                # Read state of slave
-                print('\tState: {}'.format(hex(slave.state)))
-
-            time.sleep(1)
+                outputs_3[0] = 0x5555
+                image.commit_changed()
+                master.send_processdata()
+                actual_wkc = master.receive_processdata(2000)
+                if not actual_wkc == master.expected_wkc:
+                    events.wkc_mismatch(actual_wkc, master.expected_wkc)
+                image.refresh_changed()
+                events.message('{}: outputs {} inputs {}'.format(ii, outputs_3.tobytes().hex(), inputs_4.tobytes().hex()))
             
-            master.slaves[3].output = struct.pack('H', 0x5555)
-            master.send_processdata()
-            master.receive_processdata(2000)
-            if not actual_wkc == master.expected_wkc:
-                print('incorrect wkc')
-            print(master.slaves[3].output.hex())
-            print(master.slaves[4].input.hex())
-            
-            time.sleep(1)
-
+                time.sleep(1)
+        finally:
+            events.stop()
 
         #for _ in range(5):
         #    # Write to 1010 1010 1010 1010
@@ -221,6 +247,6 @@ if __name__ == '__main__':
     print('script started')
 
     if len(sys.argv) > 1:
-        read_values(sys.argv[1])
+        read_values(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
     else:
-        print('give ifname as script argument')
\ No newline at end of file
+        print('give ifname [OD cache directory] as script arguments')
\ No newline at end of file